@@ -1,12 +1,20 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
-from datetime import datetime, timezone
+from datetime import datetime, date, timezone, timedelta
 import os
+import sys
+import json
+import atexit
+import threading
+import time
+import heapq
+import bisect
 from dotenv import load_dotenv
 from supabase import create_client, Client
 import hashlib
 import csv
-from io import StringIO
+import re
+from io import StringIO, TextIOWrapper
 from functools import wraps
 
 # Load environment variables
@@ -51,6 +59,54 @@ def sb_single(table: str, columns="*", **filters):
     data = q.limit(1).execute().data
     return data[0] if data else None
 
+_missing_rpcs = set()
+# (table, on_conflict) pairs whose unique index is not installed yet (Postgres 42P10)
+_missing_unique_keys = set()
+
+def sb_rpc(name: str, params: dict):
+    """Call a database function from migrations.sql.
+
+    Returns None (and remembers it) if the function is not installed yet, so
+    callers can fall back to plain table queries.
+    """
+    if name in _missing_rpcs:
+        return None
+    try:
+        data = supabase.rpc(name, params).execute().data
+    except Exception as e:
+        if getattr(e, 'code', None) != 'PGRST202' and 'Could not find the function' not in str(e):
+            raise
+        print(f"DEBUG: {name}() not installed, using fallback")
+        _missing_rpcs.add(name)
+        return None
+    return data if data is not None else []
+
+def sb_in(table: str, columns, column, values, chunk_size=200, **filters):
+    """Select rows whose column is in values, batching the in_() list to keep URLs short"""
+    values = list(dict.fromkeys(v for v in values if v is not None))
+    rows = []
+    for start in range(0, len(values), chunk_size):
+        q = supabase.table(table).select(columns).in_(column, values[start:start + chunk_size])
+        for k, v in filters.items():
+            q = q.eq(k, v)
+        rows.extend(q.execute().data or [])
+    return rows
+
+def sb_iter(table: str, columns="*", page_size=1000, **filters):
+    """Yield every matching row, paging by id so memory stays flat on big tables"""
+    last_id = None
+    while True:
+        q = supabase.table(table).select(columns).order('id').limit(page_size)
+        for k, v in filters.items():
+            q = q.eq(k, v)
+        if last_id is not None:
+            q = q.gt('id', last_id)
+        rows = q.execute().data or []
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]['id']
+
 def summary_counts():
     # Get users from users table
     users = sb_select("users", "id,role")
@@ -77,11 +133,11 @@ def summary_counts():
             # (their tables don't have status columns)
             active_users += 1
     
-    # Get inventory from inventory table
-    inv = sb_select("inventory", "id,blood_type,quantity")
-    total_inventory_types = len(inv)
-    total_inventory_ml = sum(int(i.get("quantity") or 0) for i in inv) * 450  # Convert units to ml (approx)
-    low_stock = [i for i in inv if int(i.get("quantity") or 0) < 2]
+    # Inventory totals across all hospitals, kept current by every inventory write
+    by_type = inventory_totals.by_type()
+    total_inventory_types = len(by_type)
+    total_inventory_ml = sum(by_type.values()) * 450  # Convert units to ml (approx)
+    low_stock = [dict(a, quantity_ml=a["quantity"] * 450) for a in stock_alerts.active()]
 
     # Get requests from urgent_request table
     reqs = sb_select("urgent_request", "id,status")
@@ -103,6 +159,287 @@ def summary_counts():
         "fulfilled_requests": fulfilled_requests,
     }
 
+# -------------------------
+# Blood Type Compatibility
+# -------------------------
+BLOOD_TYPES = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+BLOOD_TYPE_BITS = {blood_type: 1 << i for i, blood_type in enumerate(BLOOD_TYPES)}
+
+# "exact" = same type only, "compatible" = any compatible type,
+# "exact_first" = compatible types, but exact-type donors are used first
+DONOR_MATCH_MODES = ('exact', 'compatible', 'exact_first')
+DONOR_MATCH_MODE = os.environ.get("DONOR_MATCH_MODE", "exact_first")
+
+_RH_WORDS = {'+': '+', 'POS': '+', 'POSITIVE': '+', 'PLUS': '+',
+             '-': '-', 'NEG': '-', 'NEGATIVE': '-', 'MINUS': '-'}
+
+def normalize_blood_type(value):
+    """Canonical form ('A+', 'O-', ...) of a free-text blood type, or None if unrecognised.
+
+    Accepts the spellings found in donor rows, e.g. "a positive", "AB NEG",
+    "O Rh+", "0+ve".
+    """
+    if not value:
+        return None
+    text = str(value).upper()
+    text = re.sub(r'([+-])VE\b', r'\1', text)   # "+ve" / "-ve"
+    text = re.sub(r'\bRH|RH(?=[+-])', ' ', text)  # "Rh+", "RH NEGATIVE"
+    text = text.replace('+', ' + ').replace('-', ' - ')
+    tokens = text.split()
+    if not tokens:
+        return None
+    abo = tokens[0].replace('0', 'O')
+    if abo not in ('A', 'B', 'AB', 'O'):
+        return None
+    rh = [_RH_WORDS[t] for t in tokens[1:] if t in _RH_WORDS]
+    if len(rh) != 1 or len(tokens) != 2:
+        return None
+    return abo + rh[0]
+
+def normalize_existing_blood_types(tables=('donors', 'urgent_request'), page_size=1000):
+    """One-time batch migration: rewrite stored blood types into canonical form.
+
+    Pages through each table by id and issues one update per (canonical type,
+    id chunk) instead of one per row. Rows that cannot be parsed are left alone
+    and reported. Returns {table: {'updated': n, 'unrecognised': [values]}}.
+    """
+    report = {}
+    for table in tables:
+        changes = {}
+        unrecognised = set()
+        last_id = None
+        while True:
+            q = supabase.table(table).select('id, blood_type').order('id').limit(page_size)
+            if last_id is not None:
+                q = q.gt('id', last_id)
+            rows = q.execute().data or []
+            for row in rows:
+                current = row.get('blood_type')
+                canonical = normalize_blood_type(current)
+                if canonical and canonical != current:
+                    changes.setdefault(canonical, []).append(row['id'])
+                elif not canonical and current not in (None, '', 'Unknown'):
+                    unrecognised.add(current)
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1]['id']
+
+        updated = 0
+        for canonical, ids in changes.items():
+            for start in range(0, len(ids), 200):
+                chunk = ids[start:start + 200]
+                supabase.table(table).update({'blood_type': canonical}).in_('id', chunk).execute()
+                updated += len(chunk)
+
+        report[table] = {'updated': updated, 'unrecognised': sorted(unrecognised)}
+        print(f"Normalized {updated} {table} blood types; unrecognised values: {sorted(unrecognised)}")
+    return report
+
+def _red_cell_compatible(donor_type, recipient_type):
+    """Donor red cells carry no ABO antigen the recipient lacks, and Rh+ only goes to Rh+"""
+    donor_abo, donor_rh = donor_type[:-1], donor_type[-1]
+    recipient_abo, recipient_rh = recipient_type[:-1], recipient_type[-1]
+    antigens = {'O': set(), 'A': {'A'}, 'B': {'B'}, 'AB': {'A', 'B'}}
+    return antigens[donor_abo] <= antigens[recipient_abo] and (donor_rh == '-' or recipient_rh == '+')
+
+# Precomputed 8x8 matrix, one bitmask row per type:
+# DONATES_TO[d] has bit r set if d can donate to r, RECEIVES_FROM[r] is its transpose
+DONATES_TO = {
+    d: sum(BLOOD_TYPE_BITS[r] for r in BLOOD_TYPES if _red_cell_compatible(d, r))
+    for d in BLOOD_TYPES
+}
+RECEIVES_FROM = {
+    r: sum(BLOOD_TYPE_BITS[d] for d in BLOOD_TYPES if DONATES_TO[d] & BLOOD_TYPE_BITS[r])
+    for r in BLOOD_TYPES
+}
+
+def _donor_preference(recipient_type):
+    """Order compatible donor types: exact match first, universal O- last (it is the scarcest)"""
+    def key(donor_type):
+        return (
+            donor_type != recipient_type,
+            donor_type[:-1] != recipient_type[:-1],  # same ABO group, other Rh
+            donor_type == 'O-',
+            bin(DONATES_TO[donor_type]).count('1'),  # keep more universal types for later
+        )
+    return key
+
+def compatible_donor_types(recipient_type, mode=None):
+    """Donor blood types that can supply recipient_type, in preference order"""
+    mode = mode or DONOR_MATCH_MODE
+    recipient_type = normalize_blood_type(recipient_type) or recipient_type
+    if recipient_type not in RECEIVES_FROM or mode == 'exact':
+        return [recipient_type]
+    mask = RECEIVES_FROM[recipient_type]
+    types = [t for t in BLOOD_TYPES if mask & BLOOD_TYPE_BITS[t]]
+    return sorted(types, key=_donor_preference(recipient_type))
+
+def can_donate(donor_type, recipient_type):
+    bit = BLOOD_TYPE_BITS.get(recipient_type)
+    return bool(bit and DONATES_TO.get(donor_type, 0) & bit)
+
+def find_compatible_donors(recipient_type, mode=None, columns='id, user_id, donor_name, blood_type, eligibility_status, email, last_donation_date'):
+    """Eligible donors who can give to recipient_type, in one indexed in_() query.
+
+    Rows are ordered by type preference (exact type first), so callers that take
+    donors from the front get "exact first, then compatible".
+    """
+    types = compatible_donor_types(recipient_type, mode)
+    rank = {t: i for i, t in enumerate(types)}
+    donors = supabase.table('donors')\
+        .select(columns)\
+        .in_('blood_type', types)\
+        .eq('eligibility_status', True)\
+        .execute().data or []
+    donors.sort(key=lambda d: rank.get(d.get('blood_type'), len(rank)))
+    return donors
+
+def find_inventory_sources(recipient_type, mode=None, hospital_name=None):
+    """In-stock inventory rows that can supply recipient_type, in preference order"""
+    types = compatible_donor_types(recipient_type, mode)
+    rank = {t: i for i, t in enumerate(types)}
+    q = supabase.table('inventory')\
+        .select('id, hospital_name, blood_type, quantity')\
+        .in_('blood_type', types)\
+        .gt('quantity', 0)
+    if hospital_name:
+        q = q.eq('hospital_name', hospital_name)
+    rows = q.execute().data or []
+    rows.sort(key=lambda r: rank.get(r.get('blood_type'), len(rank)))
+    return rows
+
+# -------------------------
+# Eligible Donor Index
+# -------------------------
+DONOR_INDEX_CHECK_SECONDS = int(os.environ.get("DONOR_INDEX_CHECK_SECONDS", "300"))
+
+class DonorIndex:
+    """In-memory map of blood type -> ids of eligible donors.
+
+    Built in bulk once, then kept current by the donor write routes calling
+    apply()/remove(). A background thread compares a checksum with the
+    database every DONOR_INDEX_CHECK_SECONDS and rebuilds on drift.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_type = {}
+        self._donors = {}  # donor id -> (blood_type, eligible)
+        self._built = False
+        self._checker = None
+
+    def rebuild(self, page_size=1000):
+        by_type, donors = {}, {}
+        last_id = None
+        while True:
+            q = supabase.table('donors').select('id, blood_type, eligibility_status').order('id').limit(page_size)
+            if last_id is not None:
+                q = q.gt('id', last_id)
+            rows = q.execute().data or []
+            for row in rows:
+                eligible = row.get('eligibility_status') is True
+                donors[str(row['id'])] = (row.get('blood_type'), eligible)
+                if eligible:
+                    by_type.setdefault(row.get('blood_type'), set()).add(str(row['id']))
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1]['id']
+
+        with self._lock:
+            self._by_type, self._donors, self._built = by_type, donors, True
+        print(f"DEBUG: Donor index built with {len(donors)} donors")
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def apply(self, row):
+        """Record the current state of a donor row (after insert/update)"""
+        if not row or row.get('id') is None:
+            return
+        donor_id = str(row['id'])
+        with self._lock:
+            old_type, old_eligible = self._donors.get(donor_id, (None, False))
+            blood_type = row.get('blood_type', old_type)
+            eligible = row['eligibility_status'] is True if 'eligibility_status' in row else old_eligible
+            if old_eligible:
+                self._by_type.get(old_type, set()).discard(donor_id)
+            if eligible:
+                self._by_type.setdefault(blood_type, set()).add(donor_id)
+            self._donors[donor_id] = (blood_type, eligible)
+
+    def remove(self, donor_id):
+        donor_id = str(donor_id)
+        with self._lock:
+            blood_type, eligible = self._donors.pop(donor_id, (None, False))
+            if eligible:
+                self._by_type.get(blood_type, set()).discard(donor_id)
+
+    def count(self, blood_type):
+        self._ensure_built()
+        with self._lock:
+            return len(self._by_type.get(blood_type, ()))
+
+    def members(self, blood_type):
+        self._ensure_built()
+        with self._lock:
+            return list(self._by_type.get(blood_type, ()))
+
+    def checksums(self):
+        """{blood_type: (count, md5 of sorted ids)} - same shape as the SQL side"""
+        self._ensure_built()
+        with self._lock:
+            snapshot = {t: sorted(ids) for t, ids in self._by_type.items() if ids}
+        return {t: (len(ids), hashlib.md5(','.join(ids).encode()).hexdigest()) for t, ids in snapshot.items()}
+
+    def _database_checksums(self):
+        """(checksums, blood types they cover); None covers every blood type, NULL included"""
+        rows = sb_rpc('eligible_donor_checksums', {})
+        if rows is not None:
+            return {r['blood_type']: (int(r['donor_count']), r['id_hash']) for r in rows}, None
+
+        # Function not installed: fall back to comparing counts only. eq() cannot
+        # match a NULL blood type, so only the canonical types are compared.
+        counts = {}
+        for blood_type in BLOOD_TYPES:
+            response = supabase.table('donors').select('id', count='exact')\
+                .eq('blood_type', blood_type).eq('eligibility_status', True).limit(1).execute()
+            if response.count:
+                counts[blood_type] = (response.count, None)
+        return counts, set(BLOOD_TYPES)
+
+    def verify(self):
+        """Compare with the database and rebuild if they disagree. Returns True if in sync."""
+        local = self.checksums()
+        remote, covered = self._database_checksums()
+        if covered is not None:
+            # Keys the database side cannot see would read as drift on every check
+            local = {t: v for t, v in local.items() if t in covered}
+        in_sync = set(local) == set(remote) and all(
+            local[t][0] == remote[t][0] and (remote[t][1] is None or local[t][1] == remote[t][1])
+            for t in remote
+        )
+        if not in_sync:
+            print("DEBUG: Donor index drift detected, rebuilding")
+            self.rebuild()
+        return in_sync
+
+    def start(self):
+        """Build now and keep verifying in a background thread"""
+        self.rebuild()
+        if self._checker is None:
+            def loop():
+                while True:
+                    time.sleep(DONOR_INDEX_CHECK_SECONDS)
+                    try:
+                        self.verify()
+                    except Exception as e:
+                        print(f"ERROR verifying donor index: {e}")
+            self._checker = threading.Thread(target=loop, daemon=True)
+            self._checker.start()
+
+donor_index = DonorIndex()
+
 # -------------------------
 # Notification Functions
 # -------------------------
@@ -187,6 +524,92 @@ def create_simple_notification(user_id, title, message):
     
     return None
 
+NOTIFICATION_CONFLICT_KEY = "user_id,related_id,notification_type"
+NOTIFICATION_BATCH_SIZE = 500
+
+def notify_users(user_ids, title, message, notification_type="info", related_id=None):
+    """Create the same notification for many users in bulk.
+
+    Rows are keyed on (user_id, related_id, notification_type), so calling this
+    twice for the same request skips users who were already notified.
+    Returns only the rows that were newly inserted.
+    """
+    import uuid
+
+    user_ids = list(dict.fromkeys(str(u) for u in user_ids if u))
+    if not user_ids:
+        return []
+
+    sent_at = now_iso()
+    rows = [{
+        'id': str(uuid.uuid4()),
+        'user_id': user_id,
+        'title': title[:100] if title else 'Notification',
+        'message': message[:500] if message else '',
+        'status': False,
+        'created_at': sent_at,
+        'last_sent_at': sent_at,
+        'send_count': 1,
+        'notification_type': notification_type,
+        'related_id': str(related_id) if related_id else None,
+    } for user_id in user_ids]
+
+    inserted = []
+    for start in range(0, len(rows), NOTIFICATION_BATCH_SIZE):
+        chunk = rows[start:start + NOTIFICATION_BATCH_SIZE]
+        try:
+            result = supabase.table('notifications')\
+                .upsert(chunk, on_conflict=NOTIFICATION_CONFLICT_KEY, ignore_duplicates=True)\
+                .execute()
+            inserted.extend(result.data or [])
+        except Exception as e:
+            print(f"ERROR bulk creating notifications: {e}")
+
+    print(f"DEBUG: notify_users inserted {len(inserted)} of {len(rows)} notifications (related_id={related_id})")
+    return inserted
+
+def resend_notifications(related_id, notification_type="alert", user_ids=None, title=None, message=None):
+    """Re-send existing notifications for related_id without adding rows.
+
+    Bumps send_count and last_sent_at and marks the notification unread again;
+    title / message, when given, replace the stored text. Returns the updated rows.
+    """
+    if not related_id:
+        return []
+
+    query = supabase.table('notifications')\
+        .select('id, user_id, title, message, notification_type, related_id, send_count')\
+        .eq('related_id', str(related_id))\
+        .eq('notification_type', notification_type)
+    if user_ids is not None:
+        query = query.in_('user_id', [str(u) for u in user_ids if u])
+    existing = query.execute().data or []
+    if not existing:
+        return []
+
+    sent_at = now_iso()
+    # Full rows so the upsert never trips NOT NULL checks on the insert side
+    rows = [{
+        'id': n['id'],
+        'user_id': n['user_id'],
+        'title': title[:100] if title else n.get('title'),
+        'message': message[:500] if message else n.get('message'),
+        'notification_type': n.get('notification_type'),
+        'related_id': n.get('related_id'),
+        'send_count': int(n.get('send_count') or 1) + 1,
+        'last_sent_at': sent_at,
+        'status': False,
+    } for n in existing]
+
+    updated = []
+    for start in range(0, len(rows), NOTIFICATION_BATCH_SIZE):
+        chunk = rows[start:start + NOTIFICATION_BATCH_SIZE]
+        result = supabase.table('notifications').upsert(chunk, on_conflict='id').execute()
+        updated.extend(result.data or [])
+
+    print(f"DEBUG: Re-sent {len(updated)} notifications for related_id={related_id}")
+    return updated
+
 def get_unread_notification_count(user_id):
     """Get count of unread notifications for a user"""
     try:
@@ -196,25 +619,2943 @@ def get_unread_notification_count(user_id):
         print(f"Error getting unread count: {e}")
         return 0
 
+# -------------------------
+# Audit Log Writer
+# -------------------------
+AUDIT_LOG_SPILL_PATH = os.environ.get(
+    "AUDIT_LOG_SPILL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "audit_log_spill.jsonl")
+)
+AUDIT_LOG_BATCH_SIZE = int(os.environ.get("AUDIT_LOG_BATCH_SIZE", "100"))
+AUDIT_LOG_FLUSH_SECONDS = float(os.environ.get("AUDIT_LOG_FLUSH_SECONDS", "2"))
+AUDIT_LOG_MAX_BUFFER = int(os.environ.get("AUDIT_LOG_MAX_BUFFER", "5000"))
+AUDIT_LOG_MAX_ATTEMPTS = int(os.environ.get("AUDIT_LOG_MAX_ATTEMPTS", "3"))
+
+class AuditLogWriter:
+    """Write-behind buffer for inventory_logs / request_logs rows.
+
+    Rows are appended to a local spill file first (so they survive a crash),
+    then inserted in multi-row batches by a background thread once
+    AUDIT_LOG_BATCH_SIZE rows are waiting or every AUDIT_LOG_FLUSH_SECONDS.
+    A checkpoint file records the last flushed sequence number per table; on
+    start() anything in the spill file past its table's checkpoint is
+    re-queued. If the buffer reaches AUDIT_LOG_MAX_BUFFER the caller flushes
+    synchronously, unless the last flush failed less than
+    AUDIT_LOG_FLUSH_SECONDS ago. enqueue() never raises.
+
+    A batch the database rejects is retried row by row. A row rejected
+    AUDIT_LOG_MAX_ATTEMPTS times is moved to the dead-letter file
+    (<spill>.dead) so it cannot hold up the rows behind it.
+    """
+
+    def __init__(self, spill_path, batch_size=100, flush_seconds=2.0, max_buffer=5000, max_attempts=3):
+        self.spill_path = spill_path
+        self.checkpoint_path = spill_path + ".checkpoint"
+        self.dead_letter_path = spill_path + ".dead"
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.max_attempts = max_attempts
+        self._buffer = []  # [(seq, table, row)]
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._spill = None
+        self._flushed = {}  # table -> last seq written to the database
+        self._attempts = {}  # seq -> times the database rejected the row
+        self._last_failure = 0.0
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_checkpoint(self):
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._flushed, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def _open_spill(self, mode):
+        try:
+            self._spill = open(self.spill_path, mode)
+        except OSError as e:
+            print(f"ERROR opening audit log spill file, rows are kept in memory only: {e}")
+            self._spill = None
+
+    def start(self):
+        """Recover unflushed rows from the spill file and start the flusher"""
+        with self._lock:
+            if self._thread is None:
+                self._start()
+
+    def _start(self):
+        """start() without the lock (call with _lock held)"""
+        self._flushed = self._read_checkpoint()
+        self._seq = max(self._flushed.values(), default=0)
+        if os.path.exists(self.spill_path):
+            with open(self.spill_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from a crash
+                    self._seq = max(self._seq, record["seq"])
+                    if record["seq"] > self._flushed.get(record["table"], 0):
+                        self._buffer.append((record["seq"], record["table"], record["row"]))
+            if self._buffer:
+                print(f"DEBUG: Recovered {len(self._buffer)} unflushed audit log rows")
+        self._open_spill("a")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        if self._buffer:
+            self._wake.set()
+
+    def enqueue(self, table, row):
+        with self._lock:
+            if self._thread is None:
+                self._start()  # not started at startup (e.g. under a WSGI server)
+            self._seq += 1
+            if self._spill is not None:
+                try:
+                    self._spill.write(json.dumps({"seq": self._seq, "table": table, "row": row}) + "\n")
+                    self._spill.flush()
+                except OSError as e:
+                    print(f"ERROR writing audit log spill file, row {self._seq} is kept in memory only: {e}")
+            self._buffer.append((self._seq, table, row))
+            pending = len(self._buffer)
+
+        if pending >= self.max_buffer and time.time() - self._last_failure >= self.flush_seconds:
+            try:
+                self.flush()  # backpressure: the caller pays for the flush
+            except Exception as e:
+                print(f"ERROR flushing audit logs (will retry): {e}")
+        elif pending >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """Insert everything buffered so far. Rows stay queued if the insert fails."""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._buffer)
+            if not batch:
+                return 0
+
+            by_table = {}
+            for item in batch:
+                by_table.setdefault(item[1], []).append(item)
+
+            try:
+                for table, items in by_table.items():
+                    self._flush_table(table, items)
+            except Exception:
+                self._last_failure = time.time()
+                raise
+
+            with self._lock:
+                if not self._buffer:
+                    # Everything is in the database - start a fresh spill file
+                    if self._spill is not None:
+                        self._spill.close()
+                    self._open_spill("w")
+            return len(batch)
+
+    def _flush_table(self, table, items):
+        """Insert one table's rows in order, stopping at a row that is still being retried.
+
+        Each chunk is checkpointed as soon as it lands, so a failure part-way
+        through never re-inserts rows that already made it. Network errors
+        (no database error code) propagate and the rows wait for the next flush.
+        """
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start:start + self.batch_size]
+            try:
+                supabase.table(table).insert([row for _, _, row in chunk]).execute()
+            except Exception as e:
+                if getattr(e, 'code', None) is None:
+                    raise
+                # The database rejected some row: find it by inserting one at a time
+                for item in chunk:
+                    if not self._insert_one(table, item):
+                        return
+                continue
+            self._mark_done(table, chunk)
+
+    def _insert_one(self, table, item):
+        seq, _, row = item
+        try:
+            supabase.table(table).insert(row).execute()
+        except Exception as e:
+            if getattr(e, 'code', None) is None:
+                raise
+            attempts = self._attempts.get(seq, 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[seq] = attempts
+                print(f"ERROR: {table} row {seq} rejected ({attempts}/{self.max_attempts}, will retry): {e}")
+                return False
+            self._dead_letter(table, item, e)
+        self._mark_done(table, [item])
+        return True
+
+    def _dead_letter(self, table, item, error):
+        seq, _, row = item
+        print(f"ERROR: {table} row {seq} rejected {self.max_attempts} times, moved to {self.dead_letter_path}: {error}")
+        try:
+            with open(self.dead_letter_path, "a") as f:
+                f.write(json.dumps({"seq": seq, "table": table, "row": row, "error": str(error)}) + "\n")
+        except OSError as e:
+            print(f"ERROR writing audit log dead-letter file, row {seq} dropped: {e}")
+
+    def _mark_done(self, table, items):
+        done = {seq for seq, _, _ in items}
+        with self._lock:
+            self._buffer = [item for item in self._buffer if item[0] not in done]
+            self._flushed[table] = items[-1][0]
+            for seq in done:
+                self._attempts.pop(seq, None)
+            try:
+                self._write_checkpoint()
+            except OSError as e:
+                print(f"ERROR writing audit log checkpoint: {e}")
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"ERROR flushing audit logs (will retry): {e}")
+
+    def close(self):
+        """Stop the flusher and write out whatever is left (registered with atexit)"""
+        self._stopping = True
+        self._wake.set()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"ERROR flushing audit logs on shutdown, kept in {self.spill_path}: {e}")
+
+audit_log = AuditLogWriter(AUDIT_LOG_SPILL_PATH, AUDIT_LOG_BATCH_SIZE, AUDIT_LOG_FLUSH_SECONDS, AUDIT_LOG_MAX_BUFFER,
+                           AUDIT_LOG_MAX_ATTEMPTS)
+
 def add_inventory_log(inventory_id, action, old_q, new_q, changed_by="Admin"):
-    supabase.table("inventory_logs").insert({
+    audit_log.enqueue("inventory_logs", {
         "inventory_id": inventory_id,
         "action": action,
         "old_quantity": old_q,
         "new_quantity": new_q,
         "changed_by": changed_by,
         "changed_at": now_iso()
-    }).execute()
+    })
 
 def add_request_log(request_id, action, old_status, new_status, changed_by="Admin"):
-    supabase.table("request_logs").insert({
+    audit_log.enqueue("request_logs", {
         "request_id": request_id,
         "action": action,
         "old_status": old_status,
         "new_status": new_status,
         "changed_by": changed_by,
         "changed_at": now_iso()
-    }).execute()
+    })
+
+# -------------------------
+# Inventory Adjustments
+# -------------------------
+INVENTORY_ACTIONS = {"set": "UPDATE", "add": "ADD", "remove": "REMOVE"}
+INVENTORY_CAS_RETRIES = 5
+INVENTORY_CONFLICT_KEY = "hospital_name,blood_type"
+
+# Inventory is partitioned by hospital; rows without one belong here
+DEFAULT_HOSPITAL = os.environ.get("DEFAULT_HOSPITAL", "City General Hospital")
+INVENTORY_TOTALS_REBUILD_SECONDS = int(os.environ.get("INVENTORY_TOTALS_REBUILD_SECONDS", "300"))
+
+class InventoryTotals:
+    """Stock per (hospital, blood type) plus running totals across hospitals.
+
+    Loaded once, then every inventory write reports its new quantity through
+    record(), so the admin summary and dashboards never scan the table.
+    start() reloads every INVENTORY_TOTALS_REBUILD_SECONDS to pick up writes
+    made outside this process, and passes any drift on to the allocation
+    engine and the stock alerts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stock = {}    # (hospital, blood_type) -> quantity
+        self._by_type = {}  # blood_type -> quantity over all hospitals
+        self._built = False
+        self._touched = None  # partitions record()ed while a rebuild is loading
+        self._checker = None
+
+    def rebuild(self, page_size=1000):
+        """Reload every partition. Returns [(hospital, blood_type, quantity)] that had drifted."""
+        with self._lock:
+            self._touched = set()
+        stock = {}
+        last_id = None
+        while True:
+            q = supabase.table('inventory').select('id, hospital_name, blood_type, quantity').order('id').limit(page_size)
+            if last_id is not None:
+                q = q.gt('id', last_id)
+            rows = q.execute().data or []
+            for row in rows:
+                stock[(row.get('hospital_name') or DEFAULT_HOSPITAL, row['blood_type'])] = int(row.get('quantity') or 0)
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1]['id']
+
+        with self._lock:
+            # A write recorded while we were reading is newer than what we read
+            for key in self._touched:
+                if key in self._stock:
+                    stock[key] = self._stock[key]
+            drifted = [(h, t, q) for (h, t), q in stock.items()
+                       if self._built and self._stock.get((h, t)) != q]
+            by_type = {}
+            for (_, blood_type), quantity in stock.items():
+                by_type[blood_type] = by_type.get(blood_type, 0) + quantity
+            self._stock, self._by_type, self._built, self._touched = stock, by_type, True, None
+        print(f"DEBUG: Inventory totals built for {len({h for h, _ in stock})} hospitals, {len(drifted)} drifted")
+        return drifted
+
+    def start(self):
+        """Build now and keep reconciling in a background thread"""
+        self.rebuild()
+        if self._checker is None:
+            def loop():
+                while True:
+                    time.sleep(INVENTORY_TOTALS_REBUILD_SECONDS)
+                    try:
+                        for hospital, blood_type, quantity in self.rebuild():
+                            allocation_engine.set_stock(hospital, blood_type, quantity)
+                            stock_alerts.observe(hospital, blood_type, quantity)
+                    except Exception as e:
+                        print(f"ERROR reconciling inventory totals: {e}")
+            self._checker = threading.Thread(target=loop, daemon=True)
+            self._checker.start()
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def record(self, hospital, blood_type, quantity):
+        """(hospital, blood_type) now holds quantity units"""
+        if not self._built:
+            return
+        key = (hospital or DEFAULT_HOSPITAL, blood_type)
+        with self._lock:
+            if self._touched is not None:
+                self._touched.add(key)
+            delta = int(quantity) - self._stock.get(key, 0)
+            self._stock[key] = int(quantity)
+            self._by_type[blood_type] = self._by_type.get(blood_type, 0) + delta
+
+    def partitions(self):
+        self._ensure_built()
+        with self._lock:
+            return dict(self._stock)
+
+    def by_type(self):
+        self._ensure_built()
+        with self._lock:
+            return dict(self._by_type)
+
+    def hospital(self, hospital):
+        """{blood_type: quantity} for one hospital"""
+        self._ensure_built()
+        with self._lock:
+            return {t: q for (h, t), q in self._stock.items() if h == hospital}
+
+    def hospitals(self):
+        self._ensure_built()
+        with self._lock:
+            return sorted({h for h, _ in self._stock})
+
+inventory_totals = InventoryTotals()
+
+def _record_inventory_change(change):
+    """Push one applied change into the running totals and the allocation engine"""
+    hospital = change.get('hospital_name') or DEFAULT_HOSPITAL
+    inventory_totals.record(hospital, change['blood_type'], change['new_quantity'])
+    allocation_engine.set_stock(hospital, change['blood_type'], change['new_quantity'])
+    stock_alerts.observe(hospital, change['blood_type'], change['new_quantity'])
+    inventory_rollups.record(hospital, change['blood_type'], change['new_quantity'],
+                             inventory_totals.by_type().get(change['blood_type']))
+
+def _apply_inventory_action(action, old_q, qty):
+    qty = max(0, int(qty))
+    if action == "set":
+        return qty
+    if action == "add":
+        return old_q + qty
+    return max(0, old_q - qty)
+
+def adjust_inventory(action, quantity, inventory_id=None, blood_type=None, hospital_name=None,
+                     changed_by="Admin", staff_id=None):
+    """Atomically set/add/remove stock and write the matching inventory_logs row.
+
+    Runs as the adjust_inventory() database function (one round trip, row lock,
+    update and log in one transaction). Rows are addressed by inventory_id, or
+    by (hospital_name, blood_type), in which case a missing row is created.
+    If the function is not installed yet, falls back to a compare-and-swap
+    update so concurrent writers still cannot lose each other's changes.
+
+    Returns {'inventory_id', 'hospital_name', 'blood_type', 'old_quantity', 'new_quantity'}.
+    """
+    if action not in INVENTORY_ACTIONS:
+        raise ValueError(f"Unknown inventory action: {action}")
+    hospital_name = hospital_name or DEFAULT_HOSPITAL
+
+    rows = sb_rpc('adjust_inventory', {
+        'p_inventory_id': inventory_id,
+        'p_hospital_name': hospital_name,
+        'p_blood_type': blood_type,
+        'p_action': action,
+        'p_quantity': int(quantity),
+        'p_changed_by': changed_by,
+        'p_staff_id': staff_id,
+    })
+    if rows is not None:
+        change = rows[0] if isinstance(rows, list) else rows
+    else:
+        change = _adjust_inventory_cas(action, quantity, inventory_id, hospital_name, blood_type, changed_by, staff_id)
+    _record_inventory_change(change)
+    return change
+
+def _adjust_inventory_cas(action, quantity, inventory_id, hospital_name, blood_type, changed_by, staff_id):
+    for _ in range(INVENTORY_CAS_RETRIES):
+        if inventory_id is not None:
+            item = sb_single("inventory", "id,hospital_name,blood_type,quantity", id=inventory_id)
+        else:
+            item = sb_single("inventory", "id,hospital_name,blood_type,quantity",
+                             hospital_name=hospital_name, blood_type=blood_type)
+
+        if not item:
+            if blood_type is None:
+                raise LookupError(f"Inventory item {inventory_id} not found")
+            new_q = _apply_inventory_action(action, 0, quantity)
+            row = {"hospital_name": hospital_name, "blood_type": blood_type, "quantity": new_q, "updated_at": now_iso()}
+            if staff_id:
+                row["last_updated_by"] = staff_id
+            created = supabase.table("inventory").insert(row).execute().data
+            if not created:
+                continue
+            add_inventory_log(created[0]["id"], "CREATE", 0, new_q, changed_by=changed_by)
+            return {"inventory_id": created[0]["id"], "hospital_name": hospital_name, "blood_type": blood_type,
+                    "old_quantity": 0, "new_quantity": new_q}
+
+        old_q = int(item.get("quantity") or 0)
+        new_q = _apply_inventory_action(action, old_q, quantity)
+        changes = {"quantity": new_q, "updated_at": now_iso()}
+        if staff_id:
+            changes["last_updated_by"] = staff_id
+        # Only succeeds if nobody changed the row since we read it
+        q = supabase.table("inventory").update(changes).eq("id", item["id"])
+        if item.get("quantity") is None:
+            q = q.is_("quantity", "null")  # eq() would compare quantity = null, which never matches
+        else:
+            q = q.eq("quantity", item["quantity"])
+        updated = q.execute().data
+        if updated:
+            add_inventory_log(item["id"], INVENTORY_ACTIONS[action], old_q, new_q, changed_by=changed_by)
+            return {"inventory_id": item["id"], "hospital_name": item.get("hospital_name"), "blood_type": item.get("blood_type"),
+                    "old_quantity": old_q, "new_quantity": new_q}
+
+    raise RuntimeError("Inventory was changed concurrently too many times, please retry")
+
+def bulk_set_inventory(counts, hospital_name=None, changed_by="Staff", staff_id=None):
+    """Set the stock of several blood types at one hospital at once (e.g. an end-of-shift count).
+
+    counts is {blood_type: quantity}, already validated. Uses the
+    bulk_set_inventory() database function when installed (one transaction);
+    otherwise one batched read, one multi-row upsert and one multi-row log
+    insert. The upsert needs the (hospital_name, blood_type) unique index from
+    migrations.sql; without it each changed type goes through the
+    compare-and-swap path instead. Returns the list of changes that were
+    actually applied.
+    """
+    if not counts:
+        return []
+    hospital_name = hospital_name or DEFAULT_HOSPITAL
+
+    rows = sb_rpc('bulk_set_inventory', {
+        'p_items': [{'blood_type': t, 'quantity': q} for t, q in counts.items()],
+        'p_hospital_name': hospital_name,
+        'p_changed_by': changed_by,
+        'p_staff_id': staff_id,
+    })
+    if rows is not None:
+        for change in rows:
+            _record_inventory_change(change)
+        return rows
+
+    existing = {
+        row['blood_type']: row
+        for row in sb_in('inventory', 'id,blood_type,quantity', 'blood_type', list(counts), hospital_name=hospital_name)
+    }
+    updated_at = now_iso()
+    rows = []
+    for blood_type, quantity in counts.items():
+        current = existing.get(blood_type)
+        if current and int(current.get('quantity') or 0) == quantity:
+            continue  # unchanged - no write, no log row
+        row = {'hospital_name': hospital_name, 'blood_type': blood_type, 'quantity': quantity, 'updated_at': updated_at}
+        if staff_id:
+            row['last_updated_by'] = staff_id
+        rows.append(row)
+    if not rows:
+        return []
+
+    if ('inventory', INVENTORY_CONFLICT_KEY) in _missing_unique_keys:
+        return _bulk_set_inventory_cas(rows, hospital_name, changed_by, staff_id)
+    try:
+        saved = supabase.table('inventory').upsert(rows, on_conflict=INVENTORY_CONFLICT_KEY).execute().data or []
+    except Exception as e:
+        if getattr(e, 'code', None) != '42P10':
+            raise
+        print("DEBUG: inventory (hospital_name, blood_type) index not installed, using per-type updates")
+        _missing_unique_keys.add(('inventory', INVENTORY_CONFLICT_KEY))
+        return _bulk_set_inventory_cas(rows, hospital_name, changed_by, staff_id)
+
+    changes, logs = [], []
+    for row in saved:
+        old = existing.get(row['blood_type'])
+        old_q = int(old.get('quantity') or 0) if old else 0
+        changes.append({'inventory_id': row['id'], 'hospital_name': hospital_name, 'blood_type': row['blood_type'],
+                        'old_quantity': old_q, 'new_quantity': row['quantity']})
+        logs.append({
+            'inventory_id': row['id'],
+            'action': 'UPDATE' if old else 'CREATE',
+            'old_quantity': old_q,
+            'new_quantity': row['quantity'],
+            'changed_by': changed_by,
+            'changed_at': updated_at,
+        })
+    for log in logs:
+        audit_log.enqueue('inventory_logs', log)
+    for change in changes:
+        _record_inventory_change(change)
+    return changes
+
+def _bulk_set_inventory_cas(rows, hospital_name, changed_by, staff_id):
+    changes = []
+    for row in rows:
+        change = _adjust_inventory_cas('set', row['quantity'], None, hospital_name, row['blood_type'],
+                                       changed_by, staff_id)
+        _record_inventory_change(change)
+        changes.append(change)
+    return changes
+
+# -------------------------
+# Low Stock Alerts
+# -------------------------
+# Rules live in stock_thresholds; '*' matches any hospital / blood type and the
+# most specific rule wins. A level is only left once stock is back above the
+# threshold by STOCK_ALERT_MARGIN_UNITS, so a count hovering at the line does
+# not flap, and staff are notified only when a partition gets worse.
+STOCK_LOW_UNITS = int(os.environ.get("STOCK_LOW_UNITS", "5"))
+STOCK_CRITICAL_UNITS = int(os.environ.get("STOCK_CRITICAL_UNITS", "2"))
+STOCK_ALERT_MARGIN_UNITS = int(os.environ.get("STOCK_ALERT_MARGIN_UNITS", "2"))
+STOCK_LEVELS = ('ok', 'low', 'critical')
+
+def stock_level(quantity, rule, previous='ok'):
+    """'ok' / 'low' / 'critical' for quantity under rule = (low, critical, margin)"""
+    low, critical, margin = rule
+    if quantity < critical or (previous == 'critical' and quantity < critical + margin):
+        return 'critical'
+    if quantity < low or (previous != 'ok' and quantity < low + margin):
+        return 'low'
+    return 'ok'
+
+class StockAlertEngine:
+    """Current stock level per (hospital, blood type), updated on every inventory write.
+
+    observe() is called with each new quantity. When a partition crosses into
+    a worse level, the hospital's staff get one notification (edge-triggered);
+    recovering only resets the state so the next drop alerts again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rules = {}   # (hospital or '*', blood_type or '*') -> (low, critical, margin)
+        self._levels = {}  # (hospital, blood_type) -> (level, quantity)
+        self._built = False
+
+    def rebuild(self):
+        rules = {}
+        for row in sb_select('stock_thresholds', 'hospital_name, blood_type, low_units, critical_units, margin_units'):
+            rules[(row['hospital_name'], row['blood_type'])] = (
+                int(row['low_units']), int(row['critical_units']),
+                int(row['margin_units'] if row.get('margin_units') is not None else STOCK_ALERT_MARGIN_UNITS)
+            )
+        with self._lock:
+            self._rules = rules
+            # Seed from the current stock without alerting - only new crossings notify
+            self._levels = {}
+            for (hospital, blood_type), quantity in inventory_totals.partitions().items():
+                level = stock_level(quantity, self._rule(hospital, blood_type))
+                self._levels[(hospital, blood_type)] = (level, quantity)
+            self._built = True
+        print(f"DEBUG: Stock alerts built with {len(rules)} threshold rules")
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def _rule(self, hospital, blood_type):
+        for key in ((hospital, blood_type), (hospital, '*'), ('*', blood_type), ('*', '*')):
+            if key in self._rules:
+                return self._rules[key]
+        return (STOCK_LOW_UNITS, STOCK_CRITICAL_UNITS, STOCK_ALERT_MARGIN_UNITS)
+
+    def rule(self, hospital, blood_type):
+        self._ensure_built()
+        with self._lock:
+            return self._rule(hospital, blood_type)
+
+    def observe(self, hospital, blood_type, quantity):
+        """Record a new quantity; alerts the hospital's staff if the level got worse"""
+        if not self._built:
+            return
+        key = (hospital, blood_type)
+        with self._lock:
+            previous = self._levels.get(key, ('ok', None))[0]
+            level = stock_level(int(quantity), self._rule(hospital, blood_type), previous)
+            self._levels[key] = (level, int(quantity))
+        if STOCK_LEVELS.index(level) > STOCK_LEVELS.index(previous):
+            self._alert(hospital, blood_type, level, int(quantity))
+
+    def _alert(self, hospital, blood_type, level, quantity):
+        try:
+            staff = supabase.table('staff').select('user_id').eq('hospital_name', hospital).execute().data or []
+            title = f"{'Critical' if level == 'critical' else 'Low'} stock: {blood_type}"
+            message = f"{hospital} is down to {quantity} units of {blood_type}."
+            # One notification per (hospital, blood type, level): a later crossing
+            # re-sends it to staff who already have it instead of adding rows
+            related_id = f"stock:{hospital}:{blood_type}:{level}"
+            user_ids = [str(s['user_id']) for s in staff if s.get('user_id')]
+            inserted = {n['user_id'] for n in notify_users(user_ids, title, message,
+                                                           notification_type="stock", related_id=related_id)}
+            already = [u for u in user_ids if u not in inserted]
+            if already:
+                resend_notifications(related_id, "stock", user_ids=already, title=title, message=message)
+            print(f"DEBUG: {title} at {hospital} ({quantity} units), {len(staff)} staff notified")
+        except Exception as e:
+            print(f"ERROR sending stock alert: {e}")
+
+    def level(self, hospital, blood_type):
+        self._ensure_built()
+        with self._lock:
+            return self._levels.get((hospital, blood_type), ('ok', None))[0]
+
+    def active(self, hospital=None):
+        """[{'hospital_name', 'blood_type', 'level', 'quantity'}] for partitions that are not ok"""
+        self._ensure_built()
+        with self._lock:
+            return [
+                {'hospital_name': h, 'blood_type': t, 'level': level, 'quantity': quantity}
+                for (h, t), (level, quantity) in sorted(self._levels.items())
+                if level != 'ok' and (hospital is None or h == hospital)
+            ]
+
+    def set_rule(self, hospital, blood_type, low, critical, margin=None):
+        """Save a threshold rule and re-evaluate the partitions it covers"""
+        margin = STOCK_ALERT_MARGIN_UNITS if margin is None else int(margin)
+        supabase.table('stock_thresholds').upsert({
+            'hospital_name': hospital or '*',
+            'blood_type': blood_type or '*',
+            'low_units': int(low),
+            'critical_units': int(critical),
+            'margin_units': margin,
+        }, on_conflict='hospital_name,blood_type').execute()
+        self._ensure_built()
+        with self._lock:
+            self._rules[(hospital or '*', blood_type or '*')] = (int(low), int(critical), margin)
+            affected = [(k, q) for k, (_, q) in self._levels.items()
+                        if (not hospital or k[0] == hospital) and (not blood_type or k[1] == blood_type)]
+        for (h, t), quantity in affected:
+            self.observe(h, t, quantity)
+
+stock_alerts = StockAlertEngine()
+
+# -------------------------
+# Inventory History
+# -------------------------
+# Stock levels rolled up into hourly and daily buckets per (hospital, blood
+# type), plus a '*' series for the total over all hospitals. Buckets are
+# updated in memory as changes happen and upserted every
+# ROLLUP_FLUSH_SECONDS, so charts never read raw inventory_logs.
+ROLLUP_GRANULARITIES = {'hour': 3600, 'day': 86400}
+ROLLUP_FLUSH_SECONDS = float(os.environ.get("ROLLUP_FLUSH_SECONDS", "30"))
+ROLLUP_ALL_HOSPITALS = '*'
+HISTORY_HOURLY_MAX_DAYS = 31  # longer ranges are served from the daily buckets
+HISTORY_MAX_POINTS = 1000
+
+def bucket_start(at, granularity):
+    """Start of the UTC bucket containing datetime `at`"""
+    epoch = int(at.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % ROLLUP_GRANULARITIES[granularity], timezone.utc)
+
+def parse_timestamp(value):
+    """ISO string / datetime -> timezone-aware UTC datetime"""
+    if isinstance(value, datetime):
+        at = value
+    else:
+        at = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return at if at.tzinfo else at.replace(tzinfo=timezone.utc)
+
+class InventoryRollups:
+    """Open/close/min/max stock level per bucket, kept current as inventory changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = {}     # (granularity, hospital, blood_type) -> current bucket row
+        self._pending = {}  # (granularity, hospital, blood_type, bucket_start) -> row to upsert
+        self._thread = None
+
+    def record(self, hospital, blood_type, level, total=None, at=None, load=True):
+        """A new stock level for (hospital, blood_type); total is the level over all hospitals"""
+        at = at or datetime.now(timezone.utc)
+        levels = {(granularity, hospital, blood_type): int(level) for granularity in ROLLUP_GRANULARITIES}
+        if total is not None:
+            levels.update({(granularity, ROLLUP_ALL_HOSPITALS, blood_type): int(total)
+                           for granularity in ROLLUP_GRANULARITIES})
+        # First change since start-up: continue the stored bucket, if any.
+        # Read before taking the lock, so other writers never wait on the database.
+        stored = {}
+        if load:
+            with self._lock:
+                unopened = [key for key in levels if key not in self._open]
+            for key in unopened:
+                stored[key] = self._load_stored(key, bucket_start(at, key[0]).isoformat())
+        with self._lock:
+            for key, key_level in levels.items():
+                self._update(key, key_level, at, stored.get(key))
+        self._start()
+
+    @staticmethod
+    def _load_stored(key, start):
+        granularity, hospital, blood_type = key
+        rows = supabase.table('inventory_rollups').select('*')\
+            .eq('granularity', granularity).eq('hospital_name', hospital).eq('blood_type', blood_type)\
+            .lte('bucket_start', start).order('bucket_start', desc=True).limit(1).execute().data
+        if not rows:
+            return None
+        rows[0]['bucket_start'] = parse_timestamp(rows[0]['bucket_start']).isoformat()
+        return rows[0]
+
+    def _update(self, key, level, at, stored=None):
+        """Apply one level to key's open bucket; stored is its last saved bucket (call with _lock held)"""
+        start = bucket_start(at, key[0]).isoformat()
+        row = self._open.get(key) or stored
+        if row is None or row['bucket_start'] != start:
+            previous = row['close_level'] if row else level
+            row = {
+                'granularity': key[0],
+                'hospital_name': key[1],
+                'blood_type': key[2],
+                'bucket_start': start,
+                'open_level': previous,
+                'close_level': previous,
+                'min_level': previous,
+                'max_level': previous,
+                'changes': 0,
+            }
+        self._open[key] = row
+        row['close_level'] = level
+        row['min_level'] = min(row['min_level'], level)
+        row['max_level'] = max(row['max_level'], level)
+        row['changes'] += 1
+        self._pending[key + (start,)] = row
+
+    def flush(self):
+        with self._lock:
+            rows = [dict(row) for row in self._pending.values()]
+            self._pending = {}
+        for start in range(0, len(rows), 500):
+            try:
+                supabase.table('inventory_rollups').upsert(
+                    rows[start:start + 500],
+                    on_conflict='granularity,hospital_name,blood_type,bucket_start'
+                ).execute()
+            except Exception:
+                with self._lock:
+                    for row in rows[start:]:
+                        key = (row['granularity'], row['hospital_name'], row['blood_type'], row['bucket_start'])
+                        self._pending.setdefault(key, row)
+                raise
+        return len(rows)
+
+    def _start(self):
+        if self._thread is None:
+            def loop():
+                while True:
+                    time.sleep(ROLLUP_FLUSH_SECONDS)
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        print(f"ERROR flushing inventory rollups (will retry): {e}")
+            self._thread = threading.Thread(target=loop, daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def series(self, blood_type, hospital=ROLLUP_ALL_HOSPITALS, start=None, end=None, points=200):
+        """Stock level of blood_type between start and end, at most `points` points.
+
+        Picks hourly or daily buckets from the range, forward-fills quiet
+        buckets with the last level, then merges neighbouring buckets down to
+        `points` keeping each group's last level and its min/max.
+        """
+        end = end or datetime.now(timezone.utc)
+        start = start or end - timedelta(days=7)
+        granularity = 'hour' if end - start <= timedelta(days=HISTORY_HOURLY_MAX_DAYS) else 'day'
+        step = ROLLUP_GRANULARITIES[granularity]
+        first, last = bucket_start(start, granularity), bucket_start(end, granularity)
+
+        base = lambda: supabase.table('inventory_rollups')\
+            .select('bucket_start, close_level, min_level, max_level')\
+            .eq('granularity', granularity).eq('hospital_name', hospital).eq('blood_type', blood_type)
+        seed = base().lt('bucket_start', first.isoformat()).order('bucket_start', desc=True).limit(1).execute().data
+        buckets = {}
+        after = first.isoformat()
+        while True:
+            page = base().gte('bucket_start', after).lte('bucket_start', last.isoformat())\
+                .order('bucket_start').limit(1000).execute().data or []
+            for row in page:
+                buckets[int(parse_timestamp(row['bucket_start']).timestamp())] = row
+            if len(page) < 1000:
+                break
+            after = (parse_timestamp(page[-1]['bucket_start']) + timedelta(seconds=1)).isoformat()
+        with self._lock:
+            for (g, h, t, _), row in self._pending.items():
+                if (g, h, t) == (granularity, hospital, blood_type):
+                    buckets[int(parse_timestamp(row['bucket_start']).timestamp())] = dict(row)
+
+        level = seed[0]['close_level'] if seed else None
+        grid = []
+        for epoch in range(int(first.timestamp()), int(last.timestamp()) + 1, step):
+            row = buckets.get(epoch)
+            if row:
+                level = row['close_level']
+                grid.append((epoch, level, row['min_level'], row['max_level']))
+            elif level is not None:
+                grid.append((epoch, level, level, level))
+
+        points = max(1, min(int(points), HISTORY_MAX_POINTS))
+        size = -(-len(grid) // points) if grid else 1
+        series = []
+        for i in range(0, len(grid), size):
+            group = grid[i:i + size]
+            series.append({
+                't': datetime.fromtimestamp(group[0][0], timezone.utc).isoformat(),
+                'level': group[-1][1],
+                'min': min(g[2] for g in group),
+                'max': max(g[3] for g in group),
+            })
+        return {'granularity': granularity, 'bucket_seconds': step * size, 'points': series}
+
+inventory_rollups = InventoryRollups()
+
+def backfill_inventory_rollups(page_size=1000):
+    """One-time job: replay inventory_logs into inventory_rollups, oldest first"""
+    inventory = {}
+    last_id = None
+    while True:
+        q = supabase.table('inventory').select('id, hospital_name, blood_type').order('id').limit(page_size)
+        if last_id is not None:
+            q = q.gt('id', last_id)
+        rows = q.execute().data or []
+        for row in rows:
+            inventory[row['id']] = (row.get('hospital_name') or DEFAULT_HOSPITAL, row['blood_type'])
+        if len(rows) < page_size:
+            break
+        last_id = rows[-1]['id']
+
+    levels, totals = {}, {}
+    replayed = 0
+    last_id = None
+    while True:
+        q = supabase.table('inventory_logs').select('id, inventory_id, new_quantity, changed_at')\
+            .order('id').limit(page_size)
+        if last_id is not None:
+            q = q.gt('id', last_id)
+        rows = q.execute().data or []
+        for log in rows:
+            partition = inventory.get(log.get('inventory_id'))
+            if not partition or log.get('new_quantity') is None or not log.get('changed_at'):
+                continue
+            level = int(log['new_quantity'])
+            totals[partition[1]] = totals.get(partition[1], 0) + level - levels.get(partition, 0)
+            levels[partition] = level
+            inventory_rollups.record(partition[0], partition[1], level, totals[partition[1]],
+                                     at=parse_timestamp(log['changed_at']), load=False)
+            replayed += 1
+        inventory_rollups.flush()
+        if len(rows) < page_size:
+            break
+        last_id = rows[-1]['id']
+    print(f"Backfilled inventory rollups from {replayed} inventory_logs rows")
+    return replayed
+
+# -------------------------
+# Demand Forecast
+# -------------------------
+# Daily units requested per (hospital, blood type), from urgent_request,
+# smoothed into a forecast daily demand. A background job pulls only the rows
+# added since the last refresh and re-smooths the in-memory daily series, and
+# reloads everything every FORECAST_REBUILD_SECONDS so edited or deleted
+# requests drop out; days-of-supply is worked out from the live totals
+# whenever it is read.
+FORECAST_REFRESH_SECONDS = int(os.environ.get("FORECAST_REFRESH_SECONDS", "900"))
+FORECAST_REBUILD_SECONDS = int(os.environ.get("FORECAST_REBUILD_SECONDS", "21600"))
+FORECAST_ALPHA = float(os.environ.get("FORECAST_ALPHA", "0.2"))  # exponential smoothing weight of the newest day
+FORECAST_WINDOW_DAYS = 28
+FORECAST_HORIZON_DAYS = 7
+DAYS_OF_SUPPLY_WARNING = 3
+
+class DemandForecaster:
+    """Cached per-blood-type demand forecast, refreshed by a batch job."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._daily = {}      # (hospital, blood_type) -> {day ordinal: units requested}
+        self._last_id = None  # newest urgent_request id already counted
+        self._rates = {}      # (hospital, blood_type) -> forecast row
+        self._generated_at = None
+        self._rebuilt_at = 0
+        self._thread = None
+
+    @staticmethod
+    def _load(daily, last_id, page_size=1000):
+        """Add urgent_request rows after last_id to daily. Returns (rows loaded, newest id)."""
+        loaded = 0
+        while True:
+            q = supabase.table('urgent_request')\
+                .select('id, blood_type, units_needed, requested_at, hospital_name').order('id').limit(page_size)
+            if last_id is not None:
+                q = q.gt('id', last_id)
+            rows = q.execute().data or []
+            for row in rows:
+                blood_type = normalize_blood_type(row.get('blood_type'))
+                if not blood_type or not row.get('requested_at'):
+                    continue
+                day = parse_timestamp(row['requested_at']).date().toordinal()
+                units = int(row.get('units_needed') or 0)
+                for hospital in (row.get('hospital_name') or DEFAULT_HOSPITAL, ROLLUP_ALL_HOSPITALS):
+                    series = daily.setdefault((hospital, blood_type), {})
+                    series[day] = series.get(day, 0) + units
+            loaded += len(rows)
+            if rows:
+                last_id = rows[-1]['id']
+            if len(rows) < page_size:
+                return loaded, last_id
+
+    @staticmethod
+    def _smooth(daily, today):
+        """(smoothed daily rate, 7-day mean, 28-day mean) of a sparse {day: units} series up to today"""
+        first = min(daily)
+        level = sum(daily.get(d, 0) for d in range(first, first + 7)) / 7.0
+        for day in range(first, today + 1):
+            level += FORECAST_ALPHA * (daily.get(day, 0) - level)
+        recent = [daily.get(d, 0) for d in range(today - FORECAST_WINDOW_DAYS + 1, today + 1)]
+        return level, sum(recent[-7:]) / 7.0, sum(recent) / float(FORECAST_WINDOW_DAYS)
+
+    def refresh(self, full=False):
+        """Pull the requests added since the last refresh, or all of them with full=True"""
+        started = time.time()
+        with self._refresh_lock:
+            if full or self._last_id is None:
+                # From scratch, so edited and deleted requests leave the series
+                daily, last_id = {}, None
+            else:
+                daily, last_id = self._daily, self._last_id
+            loaded, last_id = self._load(daily, last_id)
+            today = date.today().toordinal()
+            rates = {}
+            for key, series in daily.items():
+                smoothed, week, month = self._smooth(series, today)
+                rates[key] = {
+                    'daily_forecast': round(smoothed, 2),
+                    'avg_7d': round(week, 2),
+                    'avg_28d': round(month, 2),
+                    'history_days': today - min(series) + 1,
+                }
+            self._daily, self._last_id = daily, last_id
+            if full:
+                self._rebuilt_at = time.time()
+            with self._lock:
+                self._rates, self._generated_at = rates, now_iso()
+        print(f"DEBUG: Demand forecast {'rebuilt' if full else 'refreshed'} ({loaded} requests, {len(rates)} series) "
+              f"in {(time.time() - started) * 1000:.0f} ms")
+
+    def forecast(self, hospital=ROLLUP_ALL_HOSPITALS):
+        """One row per blood type: forecast demand against current stock.
+
+        Never loads on the request thread; until the first refresh lands every
+        rate reads as zero.
+        """
+        if self._thread is None:
+            self._spawn()  # not started at startup (e.g. under a WSGI server)
+        stock = inventory_totals.by_type() if hospital == ROLLUP_ALL_HOSPITALS else inventory_totals.hospital(hospital)
+        with self._lock:
+            rates = {t: r for (h, t), r in self._rates.items() if h == hospital}
+        rows = []
+        for blood_type in BLOOD_TYPES:
+            rate = rates.get(blood_type, {'daily_forecast': 0.0, 'avg_7d': 0.0, 'avg_28d': 0.0, 'history_days': 0})
+            units = stock.get(blood_type, 0)
+            days = round(units / rate['daily_forecast'], 1) if rate['daily_forecast'] > 0 else None
+            rows.append(dict(rate,
+                             blood_type=blood_type,
+                             stock=units,
+                             days_of_supply=days,
+                             horizon_demand=round(rate['daily_forecast'] * FORECAST_HORIZON_DAYS, 1),
+                             at_risk=days is not None and days < DAYS_OF_SUPPLY_WARNING))
+        return rows
+
+    @property
+    def generated_at(self):
+        return self._generated_at
+
+    def start(self):
+        """Build the forecast now, then keep it fresh in a background thread"""
+        try:
+            self.refresh(full=True)
+        except Exception as e:
+            print(f"ERROR building demand forecast: {e}")
+        self._spawn()
+
+    def _spawn(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            def loop():
+                while True:
+                    try:
+                        self.refresh(full=time.time() - self._rebuilt_at >= FORECAST_REBUILD_SECONDS)
+                    except Exception as e:
+                        print(f"ERROR refreshing demand forecast: {e}")
+                    time.sleep(FORECAST_REFRESH_SECONDS)
+            self._thread = threading.Thread(target=loop, daemon=True)
+            self._thread.start()
+
+demand_forecaster = DemandForecaster()
+
+# -------------------------
+# Blood Unit Lots
+# -------------------------
+UNIT_SHELF_LIFE_DAYS = int(os.environ.get("UNIT_SHELF_LIFE_DAYS", "42"))
+UNIT_EXPIRY_WARNING_DAYS = int(os.environ.get("UNIT_EXPIRY_WARNING_DAYS", "7"))
+UNIT_EXPIRY_SWEEP_SECONDS = int(os.environ.get("UNIT_EXPIRY_SWEEP_SECONDS", "3600"))
+
+class UnitIndex:
+    """Available blood units per (hospital, blood type), kept in expiry-ordered heaps.
+
+    Each heap holds (expires_at, unit_id) so the first unit to expire is always
+    on top (FEFO): taking n units costs O(n log m), and "expiring within N
+    days" only visits the units that match. Units that leave the available
+    pool are dropped from the id map straight away and their heap entries are
+    skipped when they surface. Per-partition totals are kept alongside, so the
+    inventory pages never have to count lots.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heaps = {}   # (hospital, blood_type) -> [(expires_at, unit_id)]
+        self._units = {}   # unit id -> ((hospital, blood_type), expires_at), available units only
+        self._totals = {}  # (hospital, blood_type) -> available units
+        self._built = False
+        self._sweeper = None
+
+    def rebuild(self, page_size=1000):
+        heaps, units = {}, {}
+        last_id = None
+        while True:
+            q = supabase.table('blood_units').select('id, hospital_name, blood_type, expires_at')\
+                .eq('status', 'available').order('id').limit(page_size)
+            if last_id is not None:
+                q = q.gt('id', last_id)
+            rows = q.execute().data or []
+            for row in rows:
+                key = (row.get('hospital_name') or DEFAULT_HOSPITAL, row['blood_type'])
+                expires_at = str(row['expires_at'])[:10]
+                units[row['id']] = (key, expires_at)
+                heaps.setdefault(key, []).append((expires_at, row['id']))
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1]['id']
+
+        for heap in heaps.values():
+            heapq.heapify(heap)
+        totals = {k: len(h) for k, h in heaps.items()}
+        with self._lock:
+            self._heaps, self._units, self._totals, self._built = heaps, units, totals, True
+        print(f"DEBUG: Unit index built with {len(units)} available units")
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def _discard(self, unit_id):
+        unit = self._units.pop(unit_id, None)
+        if unit:
+            self._totals[unit[0]] -= 1
+        return unit
+
+    def _push(self, unit_id, key, expires_at):
+        self._units[unit_id] = (key, expires_at)
+        self._totals[key] = self._totals.get(key, 0) + 1
+        heap = self._heaps.setdefault(key, [])
+        heapq.heappush(heap, (expires_at, unit_id))
+        if len(heap) > 2 * self._totals[key] + 64:
+            # Mostly dead entries - rebuild this heap from the live units
+            heap[:] = [(e, u) for u, (k, e) in self._units.items() if k == key]
+            heapq.heapify(heap)
+
+    def _live(self, key, entry):
+        return self._units.get(entry[1]) == (key, entry[0])
+
+    def apply(self, row):
+        """Record the current state of a blood_units row (after insert/update)"""
+        if not row or row.get('id') is None:
+            return
+        self._ensure_built()
+        unit_id = row['id']
+        with self._lock:
+            current = self._units.get(unit_id)
+            if row.get('status', 'available') != 'available':
+                self._discard(unit_id)
+                return
+            key = (row.get('hospital_name') or (current[0][0] if current else DEFAULT_HOSPITAL),
+                   row.get('blood_type', current[0][1] if current else None))
+            expires_at = str(row.get('expires_at', current[1] if current else ''))[:10]
+            if current == (key, expires_at):
+                return
+            self._discard(unit_id)
+            self._push(unit_id, key, expires_at)
+
+    def take(self, hospital, blood_type, count, today=None):
+        """Pop up to `count` unexpired units of one hospital, first-expiring first.
+
+        Returns (taken, expired) lists of (expires_at, unit_id); expired units
+        found on top of the heap along the way are removed as well.
+        """
+        self._ensure_built()
+        today = (today or date.today()).isoformat()
+        key = (hospital, blood_type)
+        taken, expired = [], []
+        with self._lock:
+            heap = self._heaps.get(key, [])
+            while heap and len(taken) < count:
+                entry = heapq.heappop(heap)
+                if not self._live(key, entry):
+                    continue
+                self._discard(entry[1])
+                (expired if entry[0] < today else taken).append(entry)
+        return taken, expired
+
+    def put_back(self, hospital, blood_type, entries):
+        """Return units from take() that could not be used after all"""
+        with self._lock:
+            for expires_at, unit_id in entries:
+                if unit_id not in self._units:
+                    self._push(unit_id, (hospital, blood_type), expires_at)
+
+    def pop_expired(self, today=None):
+        """Remove every unit past its expiry date. Returns {(hospital, blood_type): [unit_id]}"""
+        self._ensure_built()
+        today = (today or date.today()).isoformat()
+        expired = {}
+        with self._lock:
+            for key, heap in self._heaps.items():
+                while heap and heap[0][0] < today:
+                    entry = heapq.heappop(heap)
+                    if self._live(key, entry):
+                        self._discard(entry[1])
+                        expired.setdefault(key, []).append(entry[1])
+        return expired
+
+    def expiring_within(self, days, blood_type=None, hospital=None, today=None):
+        """[(expires_at, unit_id, blood_type)] for units expiring in the next `days` days, soonest first.
+
+        Units already past expiry that the sweep has not retired yet are left out.
+        """
+        self._ensure_built()
+        today = today or date.today()
+        cutoff = (today + timedelta(days=days)).isoformat()
+        today = today.isoformat()
+        result = []
+        with self._lock:
+            for key, heap in self._heaps.items():
+                if (hospital and key[0] != hospital) or (blood_type and key[1] != blood_type):
+                    continue
+                # Heap order means a child can only match if its parent does,
+                # so the walk never leaves the matching part of the heap
+                seen, stack = set(), [0]
+                while stack:
+                    i = stack.pop()
+                    if i >= len(heap) or heap[i][0] > cutoff:
+                        continue
+                    if heap[i][0] >= today and self._live(key, heap[i]) and heap[i][1] not in seen:
+                        seen.add(heap[i][1])
+                        result.append((heap[i][0], heap[i][1], key[1]))
+                    stack.extend((2 * i + 1, 2 * i + 2))
+        result.sort()
+        return result
+
+    def totals(self, hospital=None):
+        """{blood_type: available units} for one hospital, or summed over all of them"""
+        self._ensure_built()
+        totals = {}
+        with self._lock:
+            for (name, blood_type), n in self._totals.items():
+                if n and (hospital is None or name == hospital):
+                    totals[blood_type] = totals.get(blood_type, 0) + n
+        return totals
+
+    def start(self):
+        """Build now and retire expired units in a background thread"""
+        self.rebuild()
+        if self._sweeper is None:
+            def loop():
+                while True:
+                    try:
+                        expire_units()
+                    except Exception as e:
+                        print(f"ERROR expiring blood units: {e}")
+                    time.sleep(UNIT_EXPIRY_SWEEP_SECONDS)
+            self._sweeper = threading.Thread(target=loop, daemon=True)
+            self._sweeper.start()
+
+unit_index = UnitIndex()
+
+def _set_unit_status(unit_ids, status, request_id=None):
+    """Move available units to a new status. Returns the rows that actually changed."""
+    changes = {'status': status, 'updated_at': now_iso()}
+    if request_id is not None:
+        changes['request_id'] = request_id
+    updated = []
+    for start in range(0, len(unit_ids), 200):
+        chunk = unit_ids[start:start + 200]
+        # Only rows still available, so two writers cannot hand out the same unit
+        updated.extend(supabase.table('blood_units').update(changes)
+                       .in_('id', chunk).eq('status', 'available').execute().data or [])
+    return updated
+
+def receive_units(blood_type, count, hospital_name=None, collected_at=None, expires_at=None,
+                  source_event_id=None, changed_by="Staff", staff_id=None):
+    """Register `count` units of one lot at a hospital and add them to its stock. Returns the new blood_units rows."""
+    hospital_name = hospital_name or DEFAULT_HOSPITAL
+    collected_at = collected_at or date.today().isoformat()
+    if not expires_at:
+        expires_at = (date.fromisoformat(collected_at[:10]) + timedelta(days=UNIT_SHELF_LIFE_DAYS)).isoformat()
+    row = {
+        'hospital_name': hospital_name,
+        'blood_type': blood_type,
+        'collected_at': collected_at,
+        'expires_at': expires_at,
+        'source_event_id': source_event_id,
+        'status': 'available',
+    }
+    rows = supabase.table('blood_units').insert([dict(row) for _ in range(count)]).execute().data or []
+    for unit in rows:
+        unit_index.apply(unit)
+    if rows:
+        adjust_inventory('add', len(rows), blood_type=blood_type, hospital_name=hospital_name,
+                         changed_by=changed_by, staff_id=staff_id)
+    return rows
+
+def allocate_units(blood_type, count, hospital_name=None, request_id=None, changed_by="Staff", staff_id=None):
+    """Hand out up to `count` units of blood_type from one hospital, first-expiring first (FEFO).
+
+    Expired units met on the way are retired. Returns the allocated rows,
+    which may be fewer than asked for if stock runs out.
+    """
+    hospital_name = hospital_name or DEFAULT_HOSPITAL
+    allocated = _claim_units(blood_type, count, hospital_name, request_id)
+    if allocated:
+        adjust_inventory('remove', len(allocated), blood_type=blood_type, hospital_name=hospital_name,
+                         changed_by=changed_by, staff_id=staff_id)
+    return allocated
+
+def _claim_units(blood_type, count, hospital_name, request_id=None):
+    """allocate_units() without the inventory count change"""
+    allocated = []
+    while len(allocated) < count:
+        taken, expired = unit_index.take(hospital_name, blood_type, count - len(allocated))
+        try:
+            if expired:
+                _retire_units(hospital_name, blood_type, [unit_id for _, unit_id in expired], 'expired')
+            if not taken:
+                break
+            rows = _set_unit_status([unit_id for _, unit_id in taken], 'allocated', request_id)
+        except Exception:
+            # The index no longer lists them, but the writes may not have happened:
+            # put them back (a unit that did change is skipped by the next take)
+            unit_index.put_back(hospital_name, blood_type, taken + expired)
+            raise
+        if len(rows) < len(taken):
+            # Changed elsewhere since the index was built - they are gone, try the next ones
+            print(f"DEBUG: {len(taken) - len(rows)} {blood_type} units were no longer available")
+        allocated.extend(rows)
+    return allocated
+
+def _retire_units(hospital_name, blood_type, unit_ids, status, changed_by="System"):
+    rows = _set_unit_status(unit_ids, status)
+    if rows:
+        adjust_inventory('remove', len(rows), blood_type=blood_type, hospital_name=hospital_name,
+                         changed_by=changed_by)
+    return rows
+
+def expire_units(today=None):
+    """Mark every available unit past its expiry date as expired. Returns {(hospital, blood_type): count}."""
+    retired = {}
+    for (hospital, blood_type), unit_ids in unit_index.pop_expired(today).items():
+        rows = _retire_units(hospital, blood_type, unit_ids, 'expired')
+        retired[(hospital, blood_type)] = len(rows)
+        print(f"DEBUG: Expired {len(rows)} {blood_type} units at {hospital}")
+    return retired
+
+def lot_summary(hospital):
+    """({blood_type: tracked units}, {blood_type: units expiring soon}) for one hospital"""
+    expiring = {}
+    for _, _, blood_type in unit_index.expiring_within(UNIT_EXPIRY_WARNING_DAYS, hospital=hospital):
+        expiring[blood_type] = expiring.get(blood_type, 0) + 1
+    return unit_index.totals(hospital), expiring
+
+# -------------------------
+# Request Allocation Engine
+# -------------------------
+# Pending urgent requests are served in (urgency, requested_at) order and each
+# takes compatible stock greedily, exact type first. The result is a proposal
+# (nothing leaves inventory until the request is fulfilled) that tells staff
+# which requests stock can cover and how many units are still short.
+URGENCY_RANK = {'High': 0, 'Medium': 1, 'Low': 2}
+
+class AllocationEngine:
+    """Greedy allocation of inventory to Pending requests, updated incrementally.
+
+    Each hospital's requests draw only on that hospital's stock, so every
+    hospital is its own partition. Within a partition we keep, for every
+    request in priority order, the stock left *before* it (one small tuple
+    per request). A change only replays the greedy pass from the first
+    request it can affect, and stops as soon as the stock left over matches
+    what the next request saw last time - from there on nothing changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}    # request id -> (hospital, sort key, compatible types, units_needed, blood_type)
+        self._partitions = {}  # hospital -> {'order': [sort keys], 'before': [stock tuples]}
+        self._result = {}      # request id -> ({blood_type: units}, shortfall)
+        self._built = False
+        self.version = 0       # bumped on every change, for caches built on top of the allocation
+
+    @staticmethod
+    def _key(row):
+        return (URGENCY_RANK.get(row.get('urgency_level'), URGENCY_RANK['Medium']),
+                str(row.get('requested_at') or ''), row['id'])
+
+    def rebuild(self):
+        stock = {}
+        for (hospital, blood_type), quantity in inventory_totals.partitions().items():
+            if blood_type in BLOOD_TYPE_BITS:
+                stock.setdefault(hospital, [0] * len(BLOOD_TYPES))[BLOOD_TYPES.index(blood_type)] = quantity
+        pending = supabase.table('urgent_request')\
+            .select('id, blood_type, units_needed, urgency_level, requested_at, hospital_name')\
+            .eq('status', 'Pending').execute().data or []
+
+        with self._lock:
+            self._requests = {row['id']: self._entry(row) for row in pending}
+            self._partitions = {}
+            for hospital in set(stock) | {entry[0] for entry in self._requests.values()}:
+                order = sorted(entry[1] for entry in self._requests.values() if entry[0] == hospital)
+                self._partitions[hospital] = {
+                    'order': order,
+                    'before': [tuple(stock.get(hospital, [0] * len(BLOOD_TYPES)))] + [None] * len(order),
+                }
+            self._result = {}
+            for part in self._partitions.values():
+                self._replay(part, 0)
+            self._built = True
+            self.version += 1
+        print(f"DEBUG: Allocation engine built with {len(pending)} pending requests "
+              f"across {len(self._partitions)} hospitals")
+
+    def _entry(self, row):
+        return (row.get('hospital_name') or DEFAULT_HOSPITAL, self._key(row),
+                compatible_donor_types(row.get('blood_type')), max(int(row.get('units_needed') or 0), 0),
+                row.get('blood_type'))
+
+    def _partition(self, hospital):
+        return self._partitions.setdefault(hospital, {'order': [], 'before': [(0,) * len(BLOOD_TYPES)]})
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def _replay(self, part, start):
+        """Re-run the greedy pass for one hospital from position start (call with _lock held)"""
+        order, before = part['order'], part['before']
+        for i in range(start, len(order)):
+            request_id = order[i][-1]
+            _, _, types, units_needed, _ = self._requests[request_id]
+            stock = list(before[i])
+            taken, needed = {}, units_needed
+            for blood_type in types:
+                if not needed:
+                    break
+                slot = BLOOD_TYPES.index(blood_type)
+                units = min(stock[slot], needed)
+                if units:
+                    stock[slot] -= units
+                    taken[blood_type] = units
+                    needed -= units
+            self._result[request_id] = (taken, needed)
+
+            left = tuple(stock)
+            if before[i + 1] == left:
+                return  # everything after this request is unchanged
+            before[i + 1] = left
+
+    def set_stock(self, hospital, blood_type, quantity):
+        """Inventory for (hospital, blood_type) is now quantity"""
+        if not self._built or blood_type not in BLOOD_TYPE_BITS:
+            return
+        slot = BLOOD_TYPES.index(blood_type)
+        with self._lock:
+            part = self._partition(hospital)
+            order, before = part['order'], part['before']
+            delta = int(quantity) - before[0][slot]
+            if not delta:
+                return
+            # Requests that cannot use this type see the same change further down the line
+            first = next((i for i, key in enumerate(order)
+                          if blood_type in self._requests[key[-1]][2]), len(order))
+            for i in range(first + 1):
+                stock = list(before[i])
+                stock[slot] += delta
+                before[i] = tuple(stock)
+            self._replay(part, first)
+            self.version += 1
+
+    def upsert_request(self, row):
+        """Add or update a Pending request (any other status removes it)"""
+        if not self._built or not row or row.get('id') is None:
+            return
+        if row.get('status', 'Pending') != 'Pending':
+            self.remove_request(row['id'])
+            return
+        with self._lock:
+            self._remove(row['id'])
+            entry = self._entry(row)
+            self._requests[row['id']] = entry
+            part = self._partition(entry[0])
+            position = bisect.bisect_left(part['order'], entry[1])
+            part['order'].insert(position, entry[1])
+            part['before'].insert(position, part['before'][position])
+            self._replay(part, position)
+            self.version += 1
+
+    def remove_request(self, request_id):
+        if not self._built:
+            return
+        with self._lock:
+            self._remove(request_id)
+
+    def _remove(self, request_id):
+        entry = self._requests.pop(request_id, None)
+        if entry is None:
+            return
+        part = self._partitions[entry[0]]
+        position = bisect.bisect_left(part['order'], entry[1])
+        del part['order'][position]
+        del part['before'][position + 1]
+        self._result.pop(request_id, None)
+        self._replay(part, position)
+        self.version += 1
+
+    def allocation(self, request_id):
+        """{'hospital_name', 'allocations': {blood_type: units}, 'shortfall'} for a Pending request, else None"""
+        self._ensure_built()
+        with self._lock:
+            result = self._result.get(request_id)
+            if result is None:
+                return None
+            return {'hospital_name': self._requests[request_id][0],
+                    'allocations': dict(result[0]), 'shortfall': result[1]}
+
+    def shortfall(self, request_id, default=None):
+        allocation = self.allocation(request_id)
+        return allocation['shortfall'] if allocation else default
+
+    def pending_count(self, hospital=None):
+        """Number of Pending requests, at one hospital or everywhere"""
+        self._ensure_built()
+        with self._lock:
+            return sum(1 for entry in self._requests.values() if hospital is None or entry[0] == hospital)
+
+    def snapshot(self, hospital=None):
+        """Pending requests in priority order with their proposed allocation, per hospital"""
+        self._ensure_built()
+        hospitals = {}
+        with self._lock:
+            for name, part in self._partitions.items():
+                if hospital and name != hospital:
+                    continue
+                rows = []
+                for key in part['order']:
+                    request_id = key[-1]
+                    taken, shortfall = self._result[request_id]
+                    rows.append({
+                        'request_id': request_id,
+                        'blood_type': self._requests[request_id][4],
+                        'units_needed': self._requests[request_id][3],
+                        'allocations': dict(taken),
+                        'shortfall': shortfall,
+                    })
+                hospitals[name] = {
+                    'requests': rows,
+                    'unallocated_stock': dict(zip(BLOOD_TYPES, part['before'][-1])),
+                    'total_shortfall': sum(row['shortfall'] for row in rows),
+                }
+        return {'hospitals': hospitals,
+                'total_shortfall': sum(h['total_shortfall'] for h in hospitals.values())}
+
+allocation_engine = AllocationEngine()
+
+def consume_allocation(request_id, changed_by="Staff", staff_id=None):
+    """Mark a Pending request Fulfilled and take its proposed allocation out of its hospital's stock.
+
+    The request is claimed first (Pending -> Fulfilled), so two staff
+    fulfilling it at once cannot both take stock. Tracked lots are used
+    first-expiring first; any remainder comes off the untracked inventory
+    count. If taking stock fails part-way, the lots and counts already taken
+    are given back and the request goes back to Pending. Returns
+    {blood_type: units}; raises LookupError if the request is not pending and
+    ValueError if stock does not cover it.
+    """
+    allocation = allocation_engine.allocation(request_id)
+    if allocation is None:
+        raise LookupError(f"Request {request_id} is not pending")
+    if allocation['shortfall']:
+        raise ValueError(f"Not enough compatible stock: {allocation['shortfall']} units short")
+
+    claimed = supabase.table('urgent_request').update({'status': 'Fulfilled', 'handled_by': staff_id})\
+        .eq('id', request_id).eq('status', 'Pending').execute().data
+    if not claimed:
+        raise LookupError(f"Request {request_id} is not pending")
+
+    hospital = allocation['hospital_name']
+    removed = {}  # blood_type -> units already off the inventory count
+    try:
+        for blood_type, units in allocation['allocations'].items():
+            _claim_units(blood_type, units, hospital, request_id)
+            adjust_inventory('remove', units, blood_type=blood_type, hospital_name=hospital,
+                             changed_by=changed_by, staff_id=staff_id)
+            removed[blood_type] = units
+    except Exception:
+        _undo_consume(request_id, hospital, removed, changed_by, staff_id)
+        raise
+    allocation_engine.remove_request(request_id)
+    return allocation['allocations']
+
+def _undo_consume(request_id, hospital, removed, changed_by, staff_id):
+    """Give back what a failed consume_allocation() took and reopen the request"""
+    try:
+        released = supabase.table('blood_units').update({'status': 'available', 'request_id': None, 'updated_at': now_iso()})\
+            .eq('request_id', request_id).eq('status', 'allocated').execute().data or []
+        for unit in released:
+            unit_index.apply(unit)
+        for blood_type, units in removed.items():
+            adjust_inventory('add', units, blood_type=blood_type, hospital_name=hospital,
+                             changed_by=changed_by, staff_id=staff_id)
+        supabase.table('urgent_request').update({'status': 'Pending', 'handled_by': None})\
+            .eq('id', request_id).eq('status', 'Fulfilled').execute()
+    except Exception as e:
+        print(f"ERROR undoing fulfilment of request {request_id}, stock needs a manual check: {e}")
+
+# -------------------------
+# Transfer Recommender
+# -------------------------
+# Moves surplus stock between hospitals to cover shortfalls the allocation
+# engine cannot fill locally. Travel times come from a local JSON table:
+#   {"City General Hospital": {"St. Mary's": 25, ...}, ...}
+# (a pair listed one way is used both ways; unknown pairs cost TRANSFER_DEFAULT_MINUTES).
+HOSPITAL_DISTANCES_PATH = os.environ.get(
+    "HOSPITAL_DISTANCES_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "hospital_distances.json")
+)
+TRANSFER_DEFAULT_MINUTES = int(os.environ.get("TRANSFER_DEFAULT_MINUTES", "120"))
+TRANSFER_RESERVE_UNITS = int(os.environ.get("TRANSFER_RESERVE_UNITS", "2"))  # never ship a hospital below this
+TRANSFER_SUBSTITUTE_MINUTES = 15  # extra cost of sending a compatible instead of the exact type
+
+_distances = {'mtime': None, 'table': {}}
+
+def load_hospital_distances():
+    """{(from_hospital, to_hospital): minutes}, re-read only when the file changes"""
+    try:
+        mtime = os.path.getmtime(HOSPITAL_DISTANCES_PATH)
+    except OSError:
+        return {}
+    if mtime != _distances['mtime']:
+        with open(HOSPITAL_DISTANCES_PATH) as f:
+            raw = json.load(f)
+        table = {}
+        for a, row in raw.items():
+            for b, minutes in row.items():
+                table[(a, b)] = float(minutes)
+                table.setdefault((b, a), float(minutes))
+        _distances['table'], _distances['mtime'] = table, mtime
+    return _distances['table']
+
+def min_cost_flow(supply, demand, arcs):
+    """Cheapest way to move units from supply nodes to demand nodes.
+
+    supply / demand are {node: units}; arcs is [(supply node, demand node,
+    cost per unit)]. Primal-dual: Dijkstra on reduced costs sets the node
+    potentials, then flow is pushed along every zero reduced-cost path before
+    the next Dijkstra. Returns {(src, dst): units}.
+    """
+    nodes = ['_source', '_sink'] + list(supply) + list(demand)
+    index = {node: i for i, node in enumerate(nodes)}
+    graph = [[] for _ in nodes]  # per node: [to, capacity, cost, reverse edge index]
+
+    def add_edge(u, v, capacity, cost):
+        graph[u].append([v, capacity, cost, len(graph[v])])
+        graph[v].append([u, 0, -cost, len(graph[u]) - 1])
+
+    for node, units in supply.items():
+        add_edge(0, index[node], units, 0)
+    for node, units in demand.items():
+        add_edge(index[node], 1, units, 0)
+    arc_edges = []
+    for src, dst, cost in arcs:
+        arc_edges.append((src, dst, index[src], len(graph[index[src]])))
+        add_edge(index[src], index[dst], sum(demand.values()), cost)
+
+    potential = [0.0] * len(nodes)  # all arc costs start non-negative
+    while True:
+        # Dijkstra on reduced costs, then fold the distances into the potentials
+        dist = [float('inf')] * len(nodes)
+        dist[0] = 0.0
+        queue = [(0.0, 0)]
+        while queue:
+            d, u = heapq.heappop(queue)
+            if d > dist[u]:
+                continue
+            for v, capacity, cost, _ in graph[u]:
+                nd = d + cost + potential[u] - potential[v]
+                if capacity > 0 and nd < dist[v] - 1e-9:
+                    dist[v] = nd
+                    heapq.heappush(queue, (nd, v))
+        if dist[1] == float('inf'):
+            break
+        for v in range(len(nodes)):
+            if dist[v] < float('inf'):
+                potential[v] += dist[v]
+
+        # Push flow along every zero reduced-cost path before the next Dijkstra
+        pointer = [0] * len(nodes)
+        while True:
+            path, seen, u = [], {0}, 0
+            while u != 1:
+                edges = graph[u]
+                while pointer[u] < len(edges):
+                    v, capacity, cost, _ = edges[pointer[u]]
+                    if capacity > 0 and v not in seen and abs(cost + potential[u] - potential[v]) < 1e-9:
+                        break
+                    pointer[u] += 1
+                if pointer[u] == len(edges):
+                    if not path:
+                        break
+                    u = path.pop()  # dead end - back up and skip this edge
+                    pointer[u] += 1
+                    continue
+                path.append(u)
+                u = edges[pointer[u]][0]
+                seen.add(u)
+            if u != 1:
+                break
+            push = min(graph[w][pointer[w]][1] for w in path)
+            for w in path:
+                edge = graph[w][pointer[w]]
+                edge[1] -= push
+                graph[edge[0]][edge[3]][1] += push
+
+    flows = {}
+    for src, dst, u, i in arc_edges:
+        sent = graph[index[dst]][graph[u][i][3]][1]
+        if sent:
+            flows[(src, dst)] = flows.get((src, dst), 0) + sent
+    return flows
+
+class TransferRecommender:
+    """Suggested transfers from hospitals with spare stock to hospitals that are short.
+
+    Demand is each hospital's unmet shortfall per requested blood type,
+    supply is the stock the allocation engine left unallocated (minus
+    TRANSFER_RESERVE_UNITS per type). The result is cached and only
+    recomputed when the allocation or the distance table changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._result = None
+
+    def recommend(self):
+        with self._lock:
+            distances = load_hospital_distances()
+            key = (allocation_engine.version, _distances['mtime'])
+            if key == self._key:
+                return self._result
+
+            started = time.perf_counter()
+            snapshot = allocation_engine.snapshot()
+            key = (allocation_engine.version, _distances['mtime'])
+
+            supply, demand = {}, {}
+            for hospital, part in snapshot['hospitals'].items():
+                for blood_type, units in part['unallocated_stock'].items():
+                    spare = units - TRANSFER_RESERVE_UNITS
+                    if spare > 0:
+                        supply[(hospital, blood_type)] = spare
+                for row in part['requests']:
+                    if row['shortfall'] and row['blood_type'] in BLOOD_TYPE_BITS:
+                        node = (hospital, row['blood_type'])
+                        demand[node] = demand.get(node, 0) + row['shortfall']
+
+            arcs = []
+            for to_hospital, needed_type in demand:
+                for from_hospital, blood_type in supply:
+                    if from_hospital != to_hospital and can_donate(blood_type, needed_type):
+                        minutes = distances.get((from_hospital, to_hospital), TRANSFER_DEFAULT_MINUTES)
+                        if blood_type != needed_type:
+                            minutes += TRANSFER_SUBSTITUTE_MINUTES
+                        arcs.append(((from_hospital, blood_type), (to_hospital, needed_type), minutes))
+
+            flows = min_cost_flow(supply, demand, arcs) if arcs else {}
+
+            transfers, covered = [], {}
+            for ((from_hospital, blood_type), (to_hospital, needed_type)), units in flows.items():
+                transfers.append({
+                    'from_hospital': from_hospital,
+                    'to_hospital': to_hospital,
+                    'blood_type': blood_type,
+                    'for_blood_type': needed_type,
+                    'units': units,
+                    'travel_minutes': distances.get((from_hospital, to_hospital), TRANSFER_DEFAULT_MINUTES),
+                })
+                node = (to_hospital, needed_type)
+                covered[node] = covered.get(node, 0) + units
+            transfers.sort(key=lambda t: (t['to_hospital'], t['for_blood_type'], t['travel_minutes']))
+
+            unmet = [
+                {'hospital_name': h, 'blood_type': t, 'units': units - covered.get((h, t), 0)}
+                for (h, t), units in sorted(demand.items()) if units > covered.get((h, t), 0)
+            ]
+            self._result = {
+                'transfers': transfers,
+                'unmet': unmet,
+                'units_moved': sum(t['units'] for t in transfers),
+                'computed_in_ms': round((time.perf_counter() - started) * 1000, 2),
+            }
+            self._key = key
+            return self._result
+
+transfer_recommender = TransferRecommender()
+
+# -------------------------
+# Donor Recall Planner
+# -------------------------
+# Instead of alerting every eligible donor, rank them by how likely they are
+# to actually donate and alert just enough of them to cover units_needed.
+# If the request is still Pending when a wave's window runs out, the next
+# (larger) wave goes out automatically.
+MIN_DONATION_INTERVAL_DAYS = 56
+RECALL_FATIGUE_WINDOW_DAYS = 30
+RECALL_TARGET_MARGIN = 1.5
+RECALL_MAX_WAVES = 5
+RECALL_WAVE_SECONDS = {'High': 15 * 60, 'Medium': 60 * 60, 'Low': 4 * 60 * 60}
+
+_recall_plans = {}
+_recall_lock = threading.Lock()
+
+def parse_date(value):
+    """Parse a date/datetime column (ISO string or datetime) into a date"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).date()
+    except ValueError:
+        try:
+            return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+        except ValueError:
+            return None
+
+def _recall_history(user_ids):
+    """Batched lookups of registrations, attendance and recent alerts per donor user_id"""
+    history = {u: {'registered': 0, 'attended': 0, 'alerts': 0} for u in user_ids}
+    if not user_ids:
+        return history
+
+    for r in sb_in('registrations', 'donor_id', 'donor_id', user_ids):
+        h = history.get(str(r.get('donor_id')))
+        if h:
+            h['registered'] += 1
+
+    for a in sb_in('attendance', 'donor_id', 'donor_id', user_ids):
+        h = history.get(str(a.get('donor_id')))
+        if h:
+            h['attended'] += 1
+
+    # Only alerts inside the fatigue window, filtered in the database
+    since = (datetime.now(timezone.utc) - timedelta(days=RECALL_FATIGUE_WINDOW_DAYS)).isoformat()
+    for start in range(0, len(user_ids), 200):
+        recent = supabase.table('notifications').select('user_id')\
+            .in_('user_id', user_ids[start:start + 200])\
+            .eq('notification_type', 'alert').gte('created_at', since)\
+            .execute().data or []
+        for n in recent:
+            h = history.get(str(n.get('user_id')))
+            if h:
+                h['alerts'] += 1
+
+    return history
+
+def recall_score(donor, history, today=None):
+    """Estimated probability (0-1) that an alerted donor turns up and donates"""
+    today = today or datetime.now().date()
+
+    last_donation = parse_date(donor.get('last_donation_date'))
+    days_since = (today - last_donation).days if last_donation else None
+    if days_since is not None and days_since < MIN_DONATION_INTERVAL_DAYS:
+        return 0.0
+
+    # Attendance rate with a prior, so donors with no history start around 0.3
+    show_rate = (history['attended'] + 0.6) / (history['registered'] + 2)
+    show_rate = min(show_rate, 1.0)
+
+    # Donors who gave in the last few months are the most likely to come back
+    if days_since is None:
+        recency = 0.8
+    elif days_since <= 180:
+        recency = 1.0
+    elif days_since <= 365:
+        recency = 0.85
+    else:
+        recency = 0.7
+
+    fatigue = 1.0 / (1.0 + 0.5 * history['alerts'])
+    return round(show_rate * recency * fatigue, 4)
+
+def rank_recall_candidates(donors, exclude_user_ids=(), exact_type=None):
+    """Return [(score, donor)] for donors worth alerting, best first.
+
+    With exact_type set, donors of exactly that type come before merely
+    compatible ones regardless of score.
+    """
+    exclude = set(str(u) for u in exclude_user_ids)
+    candidates = {}
+    for donor in donors:
+        user_id = donor.get('user_id')
+        if user_id and str(user_id) not in exclude:
+            candidates[str(user_id)] = donor
+
+    history = _recall_history(list(candidates))
+    today = datetime.now().date()
+    ranked = []
+    for user_id, donor in candidates.items():
+        score = recall_score(donor, history[user_id], today)
+        if score > 0:
+            ranked.append((score, donor))
+    ranked.sort(key=lambda item: (exact_type is not None and item[1].get('blood_type') != exact_type, -item[0]))
+    return ranked
+
+def _take_wave(ranked, start, target_yield):
+    """Slice ranked[start:] until the expected yield reaches target_yield"""
+    end = start
+    expected = 0.0
+    while end < len(ranked) and expected < target_yield:
+        expected += ranked[end][0]
+        end += 1
+    return end, expected
+
+def start_recall(request_id, units_needed, urgency_level, donors, title, message, exact_type=None):
+    """Plan a recall for a new urgent request and send the first wave.
+
+    units_needed is only the starting point - each wave re-reads the
+    request's shortfall from the allocation engine.
+    """
+    already = supabase.table('notifications')\
+        .select('user_id')\
+        .eq('related_id', str(request_id))\
+        .eq('notification_type', 'alert')\
+        .execute().data or []
+
+    plan = {
+        'request_id': str(request_id),
+        'units_needed': max(int(units_needed or 0), 0),
+        'urgency_level': urgency_level or 'Medium',
+        'ranked': rank_recall_candidates(donors, [n['user_id'] for n in already], exact_type),
+        'next_index': 0,
+        'expected_yield': 0.0,
+        'wave': 0,
+        'notified': 0,
+        'title': title,
+        'message': message,
+        'timer': None,
+    }
+    with _recall_lock:
+        _drop_recall_plan(request_id)
+        _recall_plans[str(request_id)] = plan
+
+    return send_recall_wave(request_id)
+
+def send_recall_wave(request_id, notify_all=False):
+    """Notify the next wave of donors for request_id.
+
+    Each wave aims for RECALL_TARGET_MARGIN x units_needed expected donors,
+    doubling per wave. Returns the notification rows created in this wave.
+    """
+    # Only recruit for what stock cannot cover
+    needed = allocation_engine.shortfall(int(request_id), default=None)
+
+    with _recall_lock:
+        plan = _recall_plans.get(str(request_id))
+        if not plan:
+            return []
+        if needed is None or plan['next_index'] >= len(plan['ranked']):
+            # No longer pending, or nobody left to ask - the plan is finished
+            _drop_recall_plan(request_id)
+            return []
+        plan['units_needed'] = needed
+        if not notify_all and plan['units_needed'] == 0:
+            # Covered by stock for now - check again later in case that changes
+            _schedule_recall_escalation(plan)
+            return []
+
+        plan['wave'] += 1
+        if notify_all:
+            end = len(plan['ranked'])
+            expected = sum(score for score, _ in plan['ranked'][plan['next_index']:])
+        else:
+            target = plan['units_needed'] * RECALL_TARGET_MARGIN * (2 ** (plan['wave'] - 1))
+            end, expected = _take_wave(plan['ranked'], plan['next_index'],
+                                       max(target - plan['expected_yield'], 0.01))
+        wave = [donor for _, donor in plan['ranked'][plan['next_index']:end]]
+        plan['next_index'] = end
+        plan['expected_yield'] += expected
+        wave_number = plan['wave']
+
+    notified = notify_users(
+        [d.get('user_id') for d in wave],
+        title=plan['title'],
+        message=plan['message'],
+        notification_type="alert",
+        related_id=str(request_id)
+    )
+
+    with _recall_lock:
+        plan['notified'] += len(notified)
+        more_left = plan['next_index'] < len(plan['ranked'])
+        if more_left and wave_number < RECALL_MAX_WAVES:
+            _schedule_recall_escalation(plan)
+        elif _recall_plans.get(str(request_id)) is plan:
+            _drop_recall_plan(request_id)  # last wave sent
+
+    print(f"DEBUG: Recall wave {wave_number} for request {request_id}: "
+          f"{len(notified)} donors, expected yield {plan['expected_yield']:.2f}/{plan['units_needed']}")
+    return notified
+
+def _drop_recall_plan(request_id):
+    """Forget a recall plan and its pending escalation (call with _recall_lock held)"""
+    plan = _recall_plans.pop(str(request_id), None)
+    if plan and plan.get('timer'):
+        plan['timer'].cancel()
+
+def _schedule_recall_escalation(plan):
+    """Send the next wave later if the request is still Pending by then (call with _recall_lock held)"""
+    if plan.get('timer'):
+        plan['timer'].cancel()
+    delay = RECALL_WAVE_SECONDS.get(plan['urgency_level'], RECALL_WAVE_SECONDS['Medium'])
+    timer = threading.Timer(delay, _escalate_recall, args=(plan['request_id'],))
+    timer.daemon = True
+    plan['timer'] = timer
+    timer.start()
+
+def _escalate_recall(request_id):
+    try:
+        req = sb_single('urgent_request', 'id,status', id=request_id)
+        if not req or req.get('status') != 'Pending':
+            with _recall_lock:
+                _drop_recall_plan(request_id)
+            return
+        send_recall_wave(request_id)
+    except Exception as e:
+        print(f"ERROR escalating recall for request {request_id}: {e}")
+
+def recall_status(request_id):
+    """Summary of the recall plan for request_id (None if there is no active plan)"""
+    with _recall_lock:
+        plan = _recall_plans.get(str(request_id))
+        if not plan:
+            return None
+        return {
+            'wave': plan['wave'],
+            'donors_notified': plan['notified'],
+            'donors_remaining': len(plan['ranked']) - plan['next_index'],
+            'expected_yield': round(plan['expected_yield'], 2),
+            'units_needed': plan['units_needed'],
+        }
+
+# -------------------------
+# Streaming Export
+# -------------------------
+# Whole-table CSV / JSONL downloads. Rows are read a page at a time and
+# written out as they arrive, so a million-row export neither waits for the
+# last page nor holds the table in memory.
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+EXPORT_TABLES = {
+    # table: (roles allowed, columns that may be filtered with ?column=value)
+    'donors': (('admin', 'staff'), ('blood_type', 'eligibility_status')),
+    'urgent_request': (('admin', 'staff'), ('status', 'blood_type', 'hospital_name')),
+    'blood_units': (('admin', 'staff'), ('status', 'blood_type', 'hospital_name')),
+    'registrations': (('admin', 'organizer'), ('event_id', 'status')),
+    'notifications': (('admin',), ('user_id', 'notification_type')),
+    'inventory_logs': (('admin',), ('inventory_id', 'action')),
+    'request_logs': (('admin',), ('request_id', 'action')),
+}
+
+def _export_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+def export_rows(table, fmt, filters=None):
+    """Generator of CSV / JSONL text chunks, one chunk per page of rows"""
+    rows = sb_iter(table, page_size=EXPORT_PAGE_SIZE, **(filters or {}))
+    if fmt == 'jsonl':
+        chunk = []
+        for row in rows:
+            chunk.append(json.dumps(row, default=str))
+            if len(chunk) >= EXPORT_PAGE_SIZE:
+                yield '\n'.join(chunk) + '\n'
+                chunk = []
+        if chunk:
+            yield '\n'.join(chunk) + '\n'
+        return
+
+    buffer = StringIO()
+    writer = None
+    written = 0
+    for row in rows:
+        if writer is None:
+            # Header from the first row; PostgREST returns the same keys for every row
+            writer = csv.DictWriter(buffer, fieldnames=list(row), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow({k: _export_value(v) for k, v in row.items()})
+        written += 1
+        if written % EXPORT_PAGE_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+# -------------------------
+# Donor Import
+# -------------------------
+# Bulk version of add_donor for partner rosters. The CSV is read row by row
+# and handled DONOR_IMPORT_BATCH_SIZE rows at a time: one lookup each for
+# existing donors and users, then one multi-row insert each for the new users
+# and donors. A batch the database rejects is retried row by row, so a bad row
+# only fails itself. Emails are stored as supplied (login matches them
+# exactly) but compared ignoring case. Rows already on file are
+# skipped, so a failed import can simply be uploaded again.
+DONOR_IMPORT_BATCH_SIZE = int(os.environ.get("DONOR_IMPORT_BATCH_SIZE", "500"))
+DONOR_IMPORT_MAX_ERRORS = 1000
+DONOR_IMPORT_TEMP_PASSWORD = "TempPassword123"
+DONOR_IMPORT_COLUMNS = {
+    # accepted header -> donors column
+    'donor_name': 'donor_name', 'name': 'donor_name', 'full_name': 'donor_name',
+    'email': 'email', 'email_address': 'email',
+    'blood_type': 'blood_type', 'blood_group': 'blood_type',
+    'age': 'age',
+    'eligibility_status': 'eligibility_status', 'eligible': 'eligibility_status',
+    'medical_history': 'medical_history',
+}
+# No quotes, backslashes or pattern characters, so an email can go into an ilike filter as is
+EMAIL_PATTERN = re.compile(r'^[^@\s"\\*%]+@[^@\s"\\*%]+\.[^@\s"\\*%]+$')
+
+def _parse_import_row(raw):
+    """CSV row -> (email, donor fields, None) or (email, None, error message)"""
+    row = {}
+    for key, value in raw.items():
+        column = DONOR_IMPORT_COLUMNS.get((key or '').strip().lower().replace(' ', '_'))
+        if column and value is not None:
+            row[column] = value.strip()
+
+    if not row.get('donor_name') or not row.get('email') or not row.get('blood_type'):
+        return row.get('email', ''), None, 'Missing donor_name, email or blood_type'
+    if not EMAIL_PATTERN.match(row['email']):
+        return row['email'], None, f"Invalid email: {row['email']}"
+    blood_type = normalize_blood_type(row['blood_type'])
+    if not blood_type:
+        return row['email'], None, f"Invalid blood type: {row['blood_type']}"
+
+    eligible = row.get('eligibility_status', '').lower() in ('true', 'yes', 'y', '1', 'eligible')
+    donor = {
+        'donor_name': row['donor_name'],
+        'email': row['email'],
+        'blood_type': blood_type,
+        'eligibility_status': eligible,
+        'medical_history': row.get('medical_history', ''),
+        'disqualification_reason': '' if eligible else 'Pending verification',
+    }
+    if row.get('age'):
+        try:
+            age = int(row['age'])
+        except ValueError:
+            return row['email'], None, f"Invalid age: {row['age']}"
+        if not 0 < age < 130:
+            return row['email'], None, f"Invalid age: {row['age']}"
+        donor['age'] = age
+    return row['email'], donor, None
+
+def _emails_on_file(table, columns, emails, chunk_size=100):
+    """Rows of table whose email is one of emails, ignoring case"""
+    emails = list(dict.fromkeys(email.lower() for email in emails))
+    wanted = set(emails)
+    rows = []
+    for start in range(0, len(emails), chunk_size):
+        chunk = emails[start:start + chunk_size]
+        # ilike without % is a case-insensitive equals; '_' still matches any
+        # character, hence the re-check below
+        data = supabase.table(table).select(columns)\
+            .or_(','.join(f'email.ilike."{email}"' for email in chunk)).execute().data or []
+        rows.extend(r for r in data if (r.get('email') or '').lower() in wanted)
+    return rows
+
+def _import_donor_batch(batch, report, password_hash):
+    """Insert one batch of (line, donor) pairs, recording skips and errors in report"""
+    emails = [donor['email'] for _, donor in batch]
+    existing_donors = {d['email'].lower() for d in _emails_on_file('donors', 'email', emails)}
+    users = {u['email'].lower(): u['id'] for u in _emails_on_file('users', 'id, email', emails)}
+
+    fresh = []
+    for line, donor in batch:
+        if donor['email'].lower() in existing_donors:
+            report['skipped'] += 1
+        else:
+            fresh.append((line, donor))
+    if not fresh:
+        return
+
+    created_at = datetime.now().isoformat()
+    try:
+        _insert_donors(fresh, users, report, password_hash, created_at)
+    except Exception as e:
+        if len(fresh) == 1:
+            _import_error(report, fresh[0][0], fresh[0][1]['email'], str(e))
+            return
+        print(f"ERROR importing donor batch at line {fresh[0][0]}, retrying row by row: {e}")
+        for line, donor in fresh:
+            try:
+                _insert_donors([(line, donor)], users, report, password_hash, created_at)
+            except Exception as e:
+                _import_error(report, line, donor['email'], str(e))
+
+def _insert_donors(fresh, users, report, password_hash, created_at):
+    """Insert users (where missing) and donors for (line, donor) pairs; users is updated as they are created"""
+    new_users = [{
+        'email': donor['email'],
+        'password': password_hash,
+        'role': 'donor',
+        'status': 'active',
+        'created_at': created_at,
+    } for _, donor in fresh if donor['email'].lower() not in users]
+    if new_users:
+        created = supabase.table('users').insert(new_users).execute().data or []
+        for user in created:
+            users[user['email'].lower()] = user['id']
+        # Counted now: these users stay even if the donors insert below fails
+        report['users_created'] += len(created)
+
+    rows = [dict(donor, user_id=users[donor['email'].lower()], created_at=created_at) for _, donor in fresh]
+    inserted = supabase.table('donors').insert(rows).execute().data or []
+    for donor in inserted:
+        donor_index.apply(donor)
+    report['imported'] += len(inserted)
+
+def _import_error(report, line, email, error):
+    report['failed'] += 1
+    if len(report['errors']) < DONOR_IMPORT_MAX_ERRORS:
+        report['errors'].append({'line': line, 'email': email, 'error': error})
+
+def import_donors(lines):
+    """Import donors from an iterable of CSV text lines (header first)"""
+    started = time.time()
+    report = {'rows': 0, 'imported': 0, 'skipped': 0, 'failed': 0, 'users_created': 0, 'errors': []}
+    password_hash = hash_password(DONOR_IMPORT_TEMP_PASSWORD)
+    seen = set()
+    batch = []
+
+    reader = csv.DictReader(lines)
+    for raw in reader:
+        report['rows'] += 1
+        line = reader.line_num
+        email, donor, error = _parse_import_row(raw)
+        if error:
+            _import_error(report, line, email, error)
+            continue
+        if donor['email'].lower() in seen:
+            _import_error(report, line, donor['email'], 'Duplicate email in file')
+            continue
+        seen.add(donor['email'].lower())
+        batch.append((line, donor))
+        if len(batch) >= DONOR_IMPORT_BATCH_SIZE:
+            _import_donor_batch(batch, report, password_hash)
+            batch = []
+    if batch:
+        _import_donor_batch(batch, report, password_hash)
+
+    elapsed = time.time() - started
+    report['seconds'] = round(elapsed, 2)
+    report['rows_per_second'] = round(report['rows'] / elapsed) if elapsed > 0 else report['rows']
+    report['errors_truncated'] = report['failed'] > len(report['errors'])
+    print(f"DEBUG: Donor import: {report['imported']} imported, {report['skipped']} skipped, "
+          f"{report['failed']} failed in {report['seconds']}s")
+    return report
+
+# -------------------------
+# Event Cache
+# -------------------------
+# Event rows change rarely but are read on most organizer and donor pages,
+# often one per registration or report. EventCache serves them by id from
+# memory for EVENT_CACHE_TTL_SECONDS and fetches every miss of a get_many()
+# in one in_() query. save_event / update_event_status invalidate directly.
+# The trigger-kept counter columns change on every sign-up, so they are not
+# cached; with_event_counts() fills them in fresh where a page needs them.
+EVENT_CACHE_TTL_SECONDS = int(os.environ.get("EVENT_CACHE_TTL_SECONDS", "300"))
+
+def _event_key(event_id):
+    try:
+        return int(event_id)
+    except (TypeError, ValueError):
+        return event_id
+
+class EventCache:
+    """Read-through cache of events rows keyed by id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}  # event id -> (row, loaded_at)
+        self._generation = 0  # bumped by invalidate(), so a fetch that raced one is not kept
+
+    def get_many(self, event_ids):
+        """{id: event row} for the ids that exist; callers get their own copies"""
+        keys = list(dict.fromkeys(_event_key(i) for i in event_ids if i is not None))
+        now = time.time()
+        found, misses = {}, []
+        with self._lock:
+            for key in keys:
+                cached = self._rows.get(key)
+                if cached and now - cached[1] < EVENT_CACHE_TTL_SECONDS:
+                    found[key] = cached[0]
+                else:
+                    misses.append(key)
+            generation = self._generation
+        if misses:
+            rows = sb_in('events', '*', 'id', misses)
+            with self._lock:
+                keep = generation == self._generation
+                for row in rows:
+                    row = {k: v for k, v in row.items() if k not in EVENT_COUNTER_COLUMNS}
+                    if keep:
+                        self._rows[_event_key(row['id'])] = (row, now)
+                    found[_event_key(row['id'])] = row
+        return {key: dict(row) for key, row in found.items()}
+
+    def get(self, event_id):
+        return self.get_many([event_id]).get(_event_key(event_id))
+
+    def invalidate(self, event_id=None):
+        with self._lock:
+            if event_id is None:
+                self._rows.clear()
+            else:
+                self._rows.pop(_event_key(event_id), None)
+            self._generation += 1
+
+event_cache = EventCache()
+
+# -------------------------
+# Upcoming Events
+# -------------------------
+# The donor booking page lists the same upcoming events for everyone, so the
+# list is fetched once (filtered in the database: has an organizer, not
+# cancelled, not past) with the per-event flags worked out, and shared until
+# it expires, the date rolls over, or an organizer saves or changes an event.
+# Sign-ups, promotions and freed places also drop it, since they move is_full.
+# Only the "already registered" overlay is per donor.
+UPCOMING_EVENTS_TTL_SECONDS = int(os.environ.get("UPCOMING_EVENTS_TTL_SECONDS", "120"))
+
+class UpcomingEvents:
+    """Shared, read-only list of events donors can still sign up for."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = None
+        self._day = None
+        self._loaded_at = 0
+        self._generation = 0  # bumped by invalidate(), so a load that raced one is not kept
+
+    def _load(self, today):
+        events = supabase.table('events').select('*')\
+            .not_.is_('organizer_id', 'null')\
+            .or_('status.is.null,status.neq.Cancelled')\
+            .gte('event_date', today.isoformat())\
+            .order('event_date').execute().data or []
+        for event in events:
+            capacity = event_capacity(event)
+            event['is_past'] = False
+            event['is_cancelled'] = False
+            event['is_full'] = capacity is not None and (event.get('registration_count') or 0) >= capacity
+        print(f"DEBUG: Loaded {len(events)} upcoming events")
+        return events
+
+    def get(self):
+        today = date.today()
+        with self._lock:
+            fresh = self._events is not None and self._day == today \
+                and time.time() - self._loaded_at < UPCOMING_EVENTS_TTL_SECONDS
+            if fresh:
+                return self._events
+            generation = self._generation
+        events = self._load(today)
+        with self._lock:
+            if generation == self._generation:
+                self._events, self._day, self._loaded_at = events, today, time.time()
+        return events
+
+    def invalidate(self):
+        with self._lock:
+            self._events = None
+            self._generation += 1
+
+upcoming_events = UpcomingEvents()
+
+# -------------------------
+# Event Reservations
+# -------------------------
+# Sign-ups go through reserve_registration(), which checks for a duplicate,
+# checks event and time-slot capacity and inserts in one call. Capacity is
+# events.capacity, else target_goal; unset means unlimited. When full, the
+# donor joins the event's waitlist, and a waitlisted donor is promoted (and
+# notified) as soon as a place frees up through a no-show or cancellation.
+# Waitlisted and cancelled sign-ups hold no place, so they can only be
+# cancelled; getting a place back goes through reserve / promote again.
+REGISTRATION_ACTIVE_STATUSES = ('Pending', 'Confirmed', 'Attended')
+REGISTRATION_FREED_STATUSES = ('No-show', 'Cancelled')
+REGISTRATION_UNPLACED_STATUSES = ('Waitlisted', 'Cancelled')
+
+def event_capacity(event):
+    return int(event.get('capacity') or 0) or int(event.get('target_goal') or 0) or None
+
+def reserve_registration(event_id, donor_id, slot_start=None):
+    """Register donor_id for event_id, or put them on its waitlist.
+
+    Returns {registration_id, outcome, status, slot_start, waitlist_position}
+    where outcome is 'reserved', 'waitlisted', 'duplicate', 'not_found' or
+    'no_such_slot'. Without a slot_start, an event that has slots books the
+    earliest slot with room (or waitlists if all are full). A donor who
+    cancelled earlier signs up again on the same row. Atomic through the reserve_registration() database function; the
+    fallback below is not, so install the migration.
+    """
+    rows = sb_rpc('reserve_registration', {'p_event_id': event_id, 'p_donor_id': donor_id, 'p_slot_start': slot_start})
+    if rows is not None:
+        reservation = rows[0] if rows else {'outcome': 'not_found'}
+        if reservation['outcome'] == 'reserved':
+            upcoming_events.invalidate()
+            if reservation.get('slot_start'):
+                slot_index.book(event_id, reservation['slot_start'])
+        return reservation
+
+    event = sb_single('events', '*', id=event_id)
+    if not event:
+        return {'outcome': 'not_found'}
+    registrations = list(sb_iter('registrations', 'id, donor_id, status, slot_start, waitlist_position', event_id=event_id))
+    cancelled = None
+    for r in registrations:
+        if str(r['donor_id']) == str(donor_id):
+            if r.get('status') != 'Cancelled':
+                return dict(r, registration_id=r['id'], outcome='duplicate')
+            cancelled = r
+
+    active = [r for r in registrations if r.get('status') in REGISTRATION_ACTIVE_STATUSES]
+    capacity = event_capacity(event)
+    has_room = capacity is None or len(active) < capacity
+    booked = {}
+    for r in active:
+        if r.get('slot_start'):
+            at = parse_timestamp(r['slot_start'])
+            booked[at] = booked.get(at, 0) + 1
+    if slot_start:
+        slot = sb_single('event_slots', 'capacity', event_id=event_id, slot_start=slot_start)
+        if not slot:
+            return {'outcome': 'no_such_slot'}
+        has_room = has_room and booked.get(parse_timestamp(slot_start), 0) < slot['capacity']
+    else:
+        slots = supabase.table('event_slots').select('slot_start, capacity')\
+            .eq('event_id', event_id).order('slot_start').execute().data or []
+        if slots:
+            # Slotted event: earliest slot with room, or the waitlist
+            slot_start = next((s['slot_start'] for s in slots
+                               if booked.get(parse_timestamp(s['slot_start']), 0) < s['capacity']), None)
+            has_room = has_room and slot_start is not None
+
+    row = {
+        'event_id': event_id,
+        'donor_id': donor_id,
+        'slot_start': slot_start,
+        'status': 'Pending' if has_room else 'Waitlisted',
+        'waitlist_position': None,
+        'registered_at': datetime.now().isoformat(),
+    }
+    if not has_room:
+        row['waitlist_position'] = max([r.get('waitlist_position') or 0 for r in registrations
+                                        if r.get('status') == 'Waitlisted'] or [0]) + 1
+    if cancelled:
+        # One row per donor per event: signing up again reuses the cancelled one
+        inserted = supabase.table('registrations').update(row).eq('id', cancelled['id']).execute().data[0]
+    else:
+        inserted = supabase.table('registrations').insert(row).execute().data[0]
+    if has_room:
+        upcoming_events.invalidate()
+        if slot_start:
+            slot_index.book(event_id, slot_start)
+    return {
+        'registration_id': inserted['id'],
+        'outcome': 'reserved' if has_room else 'waitlisted',
+        'status': row['status'],
+        'slot_start': slot_start,
+        'waitlist_position': row.get('waitlist_position'),
+    }
+
+def promote_waitlist(event_id):
+    """Move waitlisted donors into freed places, in waitlist order, and tell them"""
+    upcoming_events.invalidate()  # called whenever a place frees up, which may un-fill the event
+    promoted = sb_rpc('promote_waitlist', {'p_event_id': event_id})
+    if promoted is None:
+        event = sb_single('events', '*', id=event_id)
+        if not event:
+            return []
+        registrations = list(sb_iter('registrations', 'id, donor_id, status, slot_start, waitlist_position', event_id=event_id))
+        capacity = event_capacity(event)
+        taken = sum(1 for r in registrations if r.get('status') in REGISTRATION_ACTIVE_STATUSES)
+        waiting = sorted((r for r in registrations if r.get('status') == 'Waitlisted'),
+                         key=lambda r: (r.get('waitlist_position') or 0, r['id']))
+        room = len(waiting) if capacity is None else max(0, capacity - taken)
+        promoted = []
+        for r in waiting[:room]:
+            # Slot capacity is only enforced by the database function
+            supabase.table('registrations').update({'status': 'Pending', 'waitlist_position': None}).eq('id', r['id']).execute()
+            promoted.append({'registration_id': r['id'], 'donor_id': r['donor_id'], 'slot_start': r.get('slot_start')})
+
+    if promoted:
+        slot_index.invalidate(event_id)
+        print(f"DEBUG: Promoted {len(promoted)} donors from the waitlist of event {event_id}")
+        event = event_cache.get(event_id) or {}
+        notify_users([p['donor_id'] for p in promoted],
+                     "You're off the waitlist",
+                     f"A place opened up at {event.get('event_name', 'the blood drive')} on "
+                     f"{event.get('event_date', '')} and you are now registered.",
+                     notification_type="event", related_id=f"waitlist:{event_id}")
+    return promoted
+
+# -------------------------
+# Event Slots
+# -------------------------
+# An event can be split into SLOT_MINUTES-long slots, each taking as many
+# donors as there are chairs. Slot times are the event's local wall-clock
+# times, stored as UTC. SlotIndex keeps each event's slots as a sorted list
+# with booked counts, so "nearest free slot" is a bisect plus a short walk
+# outwards instead of a query per page view.
+SLOT_MINUTES = int(os.environ.get("SLOT_MINUTES", "30"))
+SLOT_INDEX_TTL_SECONDS = int(os.environ.get("SLOT_INDEX_TTL_SECONDS", "60"))
+EXPECTED_SHOW_RATE = float(os.environ.get("EXPECTED_SHOW_RATE", "0.8"))  # used until an organizer has history
+
+def event_start(event, at_time=None):
+    """UTC datetime of the event's date at at_time (HH:MM), default its event_time"""
+    clock = (at_time or event.get('event_time') or '00:00')[:5]
+    return datetime.strptime(f"{event['event_date']} {clock}", '%Y-%m-%d %H:%M').replace(tzinfo=timezone.utc)
+
+class SlotIndex:
+    """Sorted slot starts and booked counts per event, reloaded after SLOT_INDEX_TTL_SECONDS."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}  # event_id -> {'starts': [epoch], 'capacity': [int], 'booked': [int], 'waitlisted': [int], 'loaded_at'}
+
+    def _load(self, event_id):
+        slots = supabase.table('event_slots').select('slot_start, capacity')\
+            .eq('event_id', event_id).order('slot_start').execute().data or []
+        starts = [int(parse_timestamp(row['slot_start']).timestamp()) for row in slots]
+        entry = {
+            'starts': starts,
+            'capacity': [int(row['capacity']) for row in slots],
+            'booked': [0] * len(slots),
+            'waitlisted': [0] * len(slots),
+            'loaded_at': time.time(),
+        }
+        if slots:
+            for r in sb_iter('registrations', 'id, slot_start, status', event_id=event_id):
+                if not r.get('slot_start'):
+                    continue
+                i = bisect.bisect_left(starts, int(parse_timestamp(r['slot_start']).timestamp()))
+                if i < len(starts) and starts[i] == int(parse_timestamp(r['slot_start']).timestamp()):
+                    if r.get('status') in REGISTRATION_ACTIVE_STATUSES:
+                        entry['booked'][i] += 1
+                    elif r.get('status') == 'Waitlisted':
+                        entry['waitlisted'][i] += 1
+        with self._lock:
+            self._events[event_id] = entry
+        return entry
+
+    def _entry(self, event_id):
+        with self._lock:
+            entry = self._events.get(event_id)
+        if entry is None or time.time() - entry['loaded_at'] > SLOT_INDEX_TTL_SECONDS:
+            entry = self._load(event_id)
+        return entry
+
+    def invalidate(self, event_id):
+        with self._lock:
+            self._events.pop(event_id, None)
+
+    def book(self, event_id, slot_start, delta=1):
+        """A registration took (or, with delta=-1, released) a place in a slot"""
+        epoch = int(parse_timestamp(slot_start).timestamp())
+        with self._lock:
+            entry = self._events.get(event_id)
+            if entry:
+                i = bisect.bisect_left(entry['starts'], epoch)
+                if i < len(entry['starts']) and entry['starts'][i] == epoch:
+                    entry['booked'][i] += delta
+
+    def slots(self, event_id):
+        entry = self._entry(event_id)
+        with self._lock:
+            return [{
+                'slot_start': datetime.fromtimestamp(start, timezone.utc).isoformat(),
+                'capacity': entry['capacity'][i],
+                'booked': entry['booked'][i],
+                'waitlisted': entry['waitlisted'][i],
+                'free': max(0, entry['capacity'][i] - entry['booked'][i]),
+            } for i, start in enumerate(entry['starts'])]
+
+    def nearest_free(self, event_id, at, count=3):
+        """Up to count slots with room, closest in time to datetime at first"""
+        entry = self._entry(event_id)
+        epoch = int(at.timestamp())
+        found = []
+        with self._lock:
+            starts, capacity, booked = entry['starts'], entry['capacity'], entry['booked']
+            right = bisect.bisect_left(starts, epoch)
+            left = right - 1
+            while len(found) < count and (left >= 0 or right < len(starts)):
+                # Step to whichever neighbour is closer to the requested time
+                if right >= len(starts) or (left >= 0 and epoch - starts[left] <= starts[right] - epoch):
+                    i, left = left, left - 1
+                else:
+                    i, right = right, right + 1
+                if booked[i] < capacity[i]:
+                    found.append(i)
+            return [{
+                'slot_start': datetime.fromtimestamp(starts[i], timezone.utc).isoformat(),
+                'time': datetime.fromtimestamp(starts[i], timezone.utc).strftime('%H:%M'),
+                'free': capacity[i] - booked[i],
+            } for i in found]
+
+slot_index = SlotIndex()
+
+def generate_event_slots(event_id, start_time, end_time, slot_minutes=SLOT_MINUTES, chairs=1):
+    """(Re)build an event's slots between start_time and end_time (HH:MM).
+
+    Existing slots get the new capacity; slots that fall outside the new
+    range are removed unless someone is already booked into them.
+    """
+    event = event_cache.get(event_id)
+    if not event:
+        return None
+    first, last = event_start(event, start_time), event_start(event, end_time)
+    if last <= first or slot_minutes <= 0 or chairs <= 0:
+        raise ValueError('end_time must be after start_time, and slot_minutes and chairs must be positive')
+
+    rows = []
+    at = first
+    while at + timedelta(minutes=slot_minutes) <= last:
+        rows.append({'event_id': event_id, 'slot_start': at.isoformat(), 'capacity': int(chairs)})
+        at += timedelta(minutes=slot_minutes)
+    supabase.table('event_slots').upsert(rows, on_conflict='event_id,slot_start').execute()
+
+    wanted = {row['slot_start'] for row in rows}
+    kept = []
+    slot_index.invalidate(event_id)  # fresh booked counts, so a booked slot is never deleted
+    for slot in slot_index.slots(event_id):
+        if slot['slot_start'] in wanted:
+            continue
+        if slot['booked'] or slot['waitlisted']:
+            kept.append(slot['slot_start'])
+        else:
+            supabase.table('event_slots').delete().eq('event_id', event_id).eq('slot_start', slot['slot_start']).execute()
+    slot_index.invalidate(event_id)
+    print(f"DEBUG: Event {event_id} now has {len(rows)} slots of {slot_minutes} min x {chairs} chairs")
+    return {'slots': len(rows), 'kept_booked_slots': kept}
+
+def organizer_show_rate(organizer_id):
+    """Share of registered donors who turned up at the organizer's completed events"""
+    events = with_event_counts(supabase.table('events').select('*')
+                               .eq('organizer_id', organizer_id).eq('status', 'Completed').execute().data or [])
+    registered = sum(e['registration_count'] for e in events)
+    attended = sum(e['attended_count'] for e in events)
+    return attended / registered if registered else EXPECTED_SHOW_RATE
+
+def projected_throughput(event_id, organizer_id):
+    """Per slot: places, bookings and the donors expected to actually show up"""
+    show_rate = organizer_show_rate(organizer_id)
+    projection = []
+    for slot in slot_index.slots(event_id):
+        expected = slot['booked'] * show_rate
+        projection.append(dict(slot,
+                               time=parse_timestamp(slot['slot_start']).strftime('%H:%M'),
+                               expected_donors=round(expected, 1),
+                               utilization=round(expected / slot['capacity'] * 100, 1) if slot['capacity'] else 0))
+    return {'show_rate': round(show_rate, 3), 'slots': projection,
+            'expected_total': round(sum(s['expected_donors'] for s in projection), 1)}
+
+# -------------------------
+# Event Check-in
+# -------------------------
+# Batched version of update_registration_status / mark_attendance for busy
+# drives: a queue of check-ins is resolved with one in_() lookup and written
+# with one update per target status plus bulk attendance inserts / deletes.
+REGISTRATION_STATUSES = ('Pending', 'Confirmed', 'Attended', 'No-show')
+CHECKIN_BATCH_MAX = 500
+ATTENDANCE_CONFLICT_KEY = "event_id,donor_id"
+
+def add_attendance(rows):
+    """Insert attendance rows; donors already checked in keep their original row.
+
+    Upserts against the attendance_event_donor_key index from migrations.sql.
+    Until that index exists Postgres rejects the ON CONFLICT target, so the
+    existing rows are read first and only the missing ones are inserted.
+    """
+    if not rows:
+        return
+    if ('attendance', ATTENDANCE_CONFLICT_KEY) not in _missing_unique_keys:
+        try:
+            supabase.table('attendance').upsert(rows, on_conflict=ATTENDANCE_CONFLICT_KEY,
+                                                ignore_duplicates=True).execute()
+            return
+        except Exception as e:
+            if getattr(e, 'code', None) != '42P10':
+                raise
+            print("DEBUG: attendance (event_id, donor_id) index not installed, using select-then-insert")
+            _missing_unique_keys.add(('attendance', ATTENDANCE_CONFLICT_KEY))
+    by_event = {}
+    for row in rows:
+        by_event.setdefault(row['event_id'], {})[row['donor_id']] = row
+    for event_id, by_donor in by_event.items():
+        present = {a['donor_id'] for a in sb_in('attendance', 'donor_id', 'donor_id', list(by_donor), event_id=event_id)}
+        missing = [row for donor_id, row in by_donor.items() if donor_id not in present]
+        if missing:
+            supabase.table('attendance').insert(missing).execute()
+
+def set_registration_status(registration_id, new_status):
+    """Set one registration's status and its attendance row together.
+
+    Attended upserts the (event_id, donor_id) attendance row, No-show deletes
+    it. Uses the set_registration_status() database function (one round trip,
+    one transaction) when installed. Returns {registration_id, event_id,
+    old_status, new_status}, or None if the registration does not exist.
+    Raises ValueError for a waitlisted or cancelled registration unless it is
+    being cancelled, since it holds no place to check in to.
+    """
+    rows = sb_rpc('set_registration_status', {'p_registration_id': registration_id, 'p_status': new_status})
+    if rows is not None:
+        change = rows[0] if rows else None
+    else:
+        change = _set_registration_status_fallback(registration_id, new_status)
+    if change and change['old_status'] in REGISTRATION_UNPLACED_STATUSES and new_status != 'Cancelled':
+        raise ValueError(f"Registration is {change['old_status']}; it has no place at the event")
+    if change and new_status in REGISTRATION_FREED_STATUSES and change['old_status'] in REGISTRATION_ACTIVE_STATUSES:
+        slot_index.invalidate(change['event_id'])
+        promote_waitlist(change['event_id'])
+    return change
+
+def _set_registration_status_fallback(registration_id, new_status):
+    registration = sb_single('registrations', 'id, event_id, donor_id, status', id=registration_id)
+    if not registration:
+        return None
+    old_status = registration.get('status')
+    if old_status in REGISTRATION_UNPLACED_STATUSES and new_status != 'Cancelled':
+        # Refused - reported back unchanged, like the database function does
+        return {'registration_id': registration['id'], 'event_id': registration['event_id'],
+                'old_status': old_status, 'new_status': old_status}
+    changes = {'status': new_status}
+    if old_status == 'Waitlisted':
+        changes['waitlist_position'] = None
+    supabase.table('registrations').update(changes).eq('id', registration_id).execute()
+    if new_status == 'Attended':
+        add_attendance([{
+            'event_id': registration['event_id'],
+            'donor_id': registration['donor_id'],
+            'check_in_time': datetime.now().isoformat()
+        }])
+    elif new_status == 'No-show':
+        supabase.table('attendance').delete()\
+            .eq('event_id', registration['event_id']).eq('donor_id', registration['donor_id']).execute()
+    return {
+        'registration_id': registration['id'],
+        'event_id': registration['event_id'],
+        'old_status': old_status,
+        'new_status': new_status,
+    }
+
+def apply_checkins(items, organizer_id=None):
+    """Apply [{'registration_id', 'status'}] in order; returns one result per item.
+
+    A registration listed more than once ends up with its last status.
+    With organizer_id set, registrations of other organizers' events are refused.
+    """
+    results = []
+    wanted = {}  # registration_id -> status, last one wins
+    for item in items:
+        try:
+            registration_id = int(item.get('registration_id'))
+        except (TypeError, ValueError):
+            results.append({'registration_id': item.get('registration_id'), 'success': False, 'message': 'Invalid registration_id'})
+            continue
+        status = item.get('status', 'Attended')
+        if status not in REGISTRATION_STATUSES:
+            results.append({'registration_id': registration_id, 'success': False, 'message': f'Invalid status: {status}'})
+            continue
+        wanted[registration_id] = status
+        results.append({'registration_id': registration_id, 'status': status, 'success': True})
+    if not wanted:
+        return results
+
+    registrations = {r['id']: r for r in sb_in('registrations', 'id, event_id, donor_id, status', 'id', list(wanted))}
+    if organizer_id is not None and registrations:
+        own_events = {e['id'] for e in sb_in('events', 'id', 'id', [r['event_id'] for r in registrations.values()],
+                                             organizer_id=organizer_id)}
+        registrations = {i: r for i, r in registrations.items() if r['event_id'] in own_events}
+    for result in results:
+        if result['success'] and result['registration_id'] not in registrations:
+            result.update(success=False, message='Registration not found')
+        elif result['success'] and registrations[result['registration_id']].get('status') in REGISTRATION_UNPLACED_STATUSES:
+            # No place at the event - checking in here would skip the capacity check
+            result.update(success=False, message=f"Registration is {registrations[result['registration_id']]['status']}")
+    wanted = {i: s for i, s in wanted.items()
+              if i in registrations and registrations[i].get('status') not in REGISTRATION_UNPLACED_STATUSES}
+
+    by_status = {}
+    for registration_id, status in wanted.items():
+        by_status.setdefault(status, []).append(registration_id)
+    for status, ids in by_status.items():
+        for start in range(0, len(ids), 200):
+            supabase.table('registrations').update({'status': status}).in_('id', ids[start:start + 200]).execute()
+
+    # Attendance follows the final status: Attended adds a row, No-show removes it
+    attended = [registrations[i] for i in by_status.get('Attended', [])]
+    if attended:
+        check_in_time = datetime.now().isoformat()
+        rows = {(r['event_id'], r['donor_id']): {'event_id': r['event_id'], 'donor_id': r['donor_id'],
+                                                 'check_in_time': check_in_time} for r in attended}
+        # Donors already checked in keep their original check_in_time
+        add_attendance(list(rows.values()))
+
+    no_shows = {}
+    for registration_id in by_status.get('No-show', []):
+        r = registrations[registration_id]
+        no_shows.setdefault(r['event_id'], []).append(r['donor_id'])
+    for event_id, donor_ids in no_shows.items():
+        supabase.table('attendance').delete().eq('event_id', event_id).in_('donor_id', donor_ids).execute()
+
+    # Places freed by no-shows go to the waitlist
+    freed_events = {registrations[i]['event_id'] for i in by_status.get('No-show', [])
+                    if registrations[i].get('status') in REGISTRATION_ACTIVE_STATUSES}
+    for event_id in freed_events:
+        slot_index.invalidate(event_id)
+        promote_waitlist(event_id)
+
+    print(f"DEBUG: Applied {len(wanted)} check-ins ({', '.join(f'{s}: {len(i)}' for s, i in by_status.items())})")
+    return results
+
+# -------------------------
+# Kiosk Sync
+# -------------------------
+# The kiosk page keeps the event roster and an append-only journal of
+# check-ins in the browser, so a check-in never waits for the network. The
+# journal is pushed here in batches. Each entry carries a client-made
+# entry_id, so re-sending a batch is harmless. When several kiosks touch the
+# same registration, the entry with the latest recorded_at wins (ties go to
+# the larger entry_id), whatever order they arrive in.
+KIOSK_SYNC_BATCH_MAX = 200
+
+def _journal_key(entry):
+    return (parse_timestamp(entry['recorded_at']), str(entry['entry_id']))
+
+def sync_kiosk_journal(entries, device_id, organizer_id=None):
+    """Apply a batch of kiosk journal entries; returns one outcome per entry"""
+    outcomes = {}
+    valid = []
+    for entry in entries:
+        entry_id = str(entry.get('entry_id') or '')
+        try:
+            if not entry_id:
+                raise ValueError('entry_id is required')
+            if entry.get('status') not in REGISTRATION_STATUSES:
+                raise ValueError(f"Invalid status: {entry.get('status')}")
+            row = {
+                'entry_id': entry_id,
+                'registration_id': int(entry['registration_id']),
+                'status': entry['status'],
+                'recorded_at': parse_timestamp(entry['recorded_at']).isoformat(),
+                'device_id': device_id,
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            outcomes[entry_id] = {'entry_id': entry_id, 'outcome': 'rejected', 'message': str(e)}
+            continue
+        valid.append(row)
+
+    known = {j['entry_id'] for j in sb_in('checkin_journal', 'entry_id', 'entry_id', [r['entry_id'] for r in valid])}
+    fresh = {}
+    for row in valid:
+        if row['entry_id'] in known:
+            outcomes[row['entry_id']] = {'entry_id': row['entry_id'], 'outcome': 'duplicate'}
+        else:
+            fresh[row['entry_id']] = row
+    if not fresh:
+        return [outcomes[str(e.get('entry_id') or '')] for e in entries]
+
+    # Newest entry per registration, over what is already journalled and this batch
+    latest = {}
+    journalled = sb_in('checkin_journal', 'entry_id, registration_id, recorded_at', 'registration_id',
+                       [r['registration_id'] for r in fresh.values()])
+    for row in journalled + list(fresh.values()):
+        current = latest.get(row['registration_id'])
+        if current is None or _journal_key(row) > _journal_key(current):
+            latest[row['registration_id']] = row
+
+    winners = [row for row in latest.values() if row['entry_id'] in fresh]
+    applied = apply_checkins([{'registration_id': r['registration_id'], 'status': r['status']} for r in winners],
+                             organizer_id=organizer_id)
+    refused = {r['registration_id']: r.get('message') for r in applied if not r['success']}
+
+    synced_at = now_iso()
+    journal_rows = []
+    for entry_id, row in fresh.items():
+        if row['registration_id'] in refused:
+            outcomes[entry_id] = {'entry_id': entry_id, 'outcome': 'rejected', 'message': refused[row['registration_id']]}
+            continue
+        won = latest[row['registration_id']]['entry_id'] == entry_id
+        outcomes[entry_id] = {'entry_id': entry_id, 'outcome': 'applied' if won else 'superseded'}
+        journal_rows.append(dict(row, applied=won, synced_at=synced_at))
+    if journal_rows:
+        # Written last: if this fails the kiosk re-sends and the (idempotent) apply simply runs again
+        supabase.table('checkin_journal').upsert(journal_rows, on_conflict='entry_id', ignore_duplicates=True).execute()
+
+    print(f"DEBUG: Kiosk {device_id} synced {len(fresh)} entries ({len(winners)} applied)")
+    return [outcomes[str(e.get('entry_id') or '')] for e in entries]
+
+def kiosk_roster(event_id):
+    """Registrations holding a place at an event, with the donor details the kiosk searches on"""
+    registrations = [r for r in sb_iter('registrations', 'id, donor_id, status', event_id=event_id)
+                     if r.get('status') not in REGISTRATION_UNPLACED_STATUSES]
+    donors = {d['user_id']: d for d in sb_in('donors', 'user_id, donor_name, blood_type, email', 'user_id',
+                                             [r['donor_id'] for r in registrations])}
+    roster = []
+    for r in registrations:
+        donor = donors.get(r['donor_id'], {})
+        roster.append({
+            'registration_id': r['id'],
+            'status': r['status'],
+            'donor_name': donor.get('donor_name') or 'Unknown donor',
+            'blood_type': donor.get('blood_type'),
+            'email': donor.get('email'),
+        })
+    return sorted(roster, key=lambda r: r['donor_name'].lower())
+
+# -------------------------
+# Event Counters
+# -------------------------
+# events.registration_count / confirmed_count / attended_count are kept by
+# triggers on registrations and attendance (see migrations.sql), so every
+# writer - donor sign-up, status changes, batch and kiosk check-ins - moves
+# them and event lists are a single query. A periodic reconcile repairs any
+# drift, e.g. from rows edited with triggers disabled.
+EVENT_COUNTER_COLUMNS = ('registration_count', 'confirmed_count', 'attended_count', 'waitlist_count')
+EVENT_COUNTER_RECONCILE_SECONDS = int(os.environ.get("EVENT_COUNTER_RECONCILE_SECONDS", "3600"))
+
+_event_counter_thread = None
+
+def with_event_counts(events):
+    """Fill in counters on event rows that lack them (migration not applied yet)"""
+    missing = [e for e in events if any(c not in e for c in EVENT_COUNTER_COLUMNS)]
+    if missing:
+        ids = [e['id'] for e in missing]
+        counts = {i: dict.fromkeys(EVENT_COUNTER_COLUMNS, 0) for i in ids}
+        for r in sb_in('registrations', 'event_id, status', 'event_id', ids):
+            if r.get('status') == 'Waitlisted':
+                counts[r['event_id']]['waitlist_count'] += 1
+                continue
+            if r.get('status') == 'Cancelled':
+                continue
+            counts[r['event_id']]['registration_count'] += 1
+            if r.get('status') == 'Confirmed':
+                counts[r['event_id']]['confirmed_count'] += 1
+        for a in sb_in('attendance', 'event_id', 'event_id', ids):
+            counts[a['event_id']]['attended_count'] += 1
+        for e in missing:
+            e.update(counts[e['id']])
+    return events
+
+def reconcile_event_counters():
+    """Recount every event's counters in the database; returns how many were wrong"""
+    fixed = sb_rpc('reconcile_event_counters', {})
+    if fixed is None:
+        return None
+    if fixed:
+        print(f"DEBUG: Reconciled counters on {fixed} events")
+    return fixed
+
+def start_event_counter_reconciler():
+    global _event_counter_thread
+    if _event_counter_thread is None:
+        def loop():
+            while True:
+                try:
+                    if reconcile_event_counters() is None:
+                        return  # function not installed, nothing to reconcile
+                except Exception as e:
+                    print(f"ERROR reconciling event counters: {e}")
+                time.sleep(EVENT_COUNTER_RECONCILE_SECONDS)
+        _event_counter_thread = threading.Thread(target=loop, daemon=True)
+        _event_counter_thread.start()
 
 # ========== ROLE-BASED ACCESS CONTROL ==========
 def role_required(required_role):
@@ -289,6 +3630,7 @@ def login():
                     session['staff_id'] = staff_response.data[0]['id']
                     session['staff_name'] = staff_response.data[0].get('staff_name', 'Staff')
                     session['full_name'] = staff_response.data[0].get('staff_name', 'Staff')
+                    session['hospital_name'] = staff_response.data[0].get('hospital_name') or DEFAULT_HOSPITAL
             
             elif user['role'] == 'donor':
                 donor_response = supabase.table('donors').select('*').eq('user_id', user['id']).execute()
@@ -364,6 +3706,11 @@ def register():
         if not role:
             errors.append("Please select a role")
         
+        # Store blood types in canonical form ("A+", "O-") so donor lookups stay exact matches
+        blood_type = request.form.get("blood_type", "").strip()
+        if role == 'donor' and blood_type and blood_type != 'Unknown' and not normalize_blood_type(blood_type):
+            errors.append("Please select a valid blood type")
+        
         if errors:
             for error in errors:
                 flash(error, "error")
@@ -404,7 +3751,7 @@ def register():
                     'user_id': user_id,
                     'donor_name': full_name,
                     'email': email,
-                    'blood_type': request.form.get("blood_type", "Unknown"),
+                    'blood_type': normalize_blood_type(blood_type) or 'Unknown',
                     'eligibility_status': False,
                     'disqualification_reason': 'Pending verification',
                     'created_at': now_iso()
@@ -418,7 +3765,9 @@ def register():
                 if medical_history:
                     donor_data['medical_history'] = medical_history
                 
-                supabase.table('donors').insert(donor_data).execute()
+                donor_result = supabase.table('donors').insert(donor_data).execute()
+                if donor_result.data:
+                    donor_index.apply(donor_result.data[0])
                 print(f"DEBUG: Donor record created")
             
             elif role == 'staff':
@@ -587,46 +3936,129 @@ def blood_management():
         item_id = int(request.form.get("id"))
         qty = int(request.form.get("quantity"))
 
-        item = sb_single("inventory", "*", id=item_id)
-        if item:
-            old_q = int(item.get("quantity") or 0)
+        if action in INVENTORY_ACTIONS:
+            try:
+                adjust_inventory(action, qty, inventory_id=item_id, changed_by=session.get('full_name', 'Admin'))
+            except LookupError:
+                flash('Inventory item not found', 'error')
+            except RuntimeError as e:
+                # Compare-and-swap kept losing to other writers - nothing was changed
+                flash(f'Conflict: {e}', 'error')
 
-            if action == "set":
-                new_q = max(0, qty)
-                supabase.table("inventory").update({
-                    "quantity": new_q,
-                    "updated_at": now_iso()
-                }).eq("id", item_id).execute()
-                add_inventory_log(item_id, "UPDATE", old_q, new_q, changed_by=session.get('full_name', 'Admin'))
+        return redirect(url_for("blood_management"))
 
-            elif action == "add":
-                new_q = old_q + max(0, qty)
-                supabase.table("inventory").update({
-                    "quantity": new_q,
-                    "updated_at": now_iso()
-                }).eq("id", item_id).execute()
-                add_inventory_log(item_id, "ADD", old_q, new_q, changed_by=session.get('full_name', 'Admin'))
+    # One hospital at a time (?hospital=...), or every partition
+    hospital = request.args.get("hospital") or None
+    q = supabase.table("inventory").select("*").order("hospital_name").order("blood_type")
+    if hospital:
+        q = q.eq("hospital_name", hospital)
+    inventory = q.execute().data or []
+
+    summaries = {}
+    for item in inventory:
+        name = item.get("hospital_name") or DEFAULT_HOSPITAL
+        if name not in summaries:
+            summaries[name] = lot_summary(name)
+        tracked, expiring = summaries[name]
+        item["tracked_units"] = tracked.get(item["blood_type"], 0)
+        item["expiring_soon"] = expiring.get(item["blood_type"], 0)
+        item["stock_level"] = stock_alerts.level(name, item["blood_type"])
+    low_stock = [i for i in inventory if i["stock_level"] != "ok"]
+    return render_template("blood_management.html", inventory=inventory, low_stock=low_stock,
+                           hospitals=inventory_totals.hospitals(), selected_hospital=hospital,
+                           expiry_warning_days=UNIT_EXPIRY_WARNING_DAYS)
+
+@app.route("/admin/transfers")
+@role_required('admin')
+def transfers():
+    recommendation = transfer_recommender.recommend()
+    return render_template("transfers.html", **recommendation)
 
-            elif action == "remove":
-                new_q = max(0, old_q - max(0, qty))
-                supabase.table("inventory").update({
-                    "quantity": new_q,
-                    "updated_at": now_iso()
-                }).eq("id", item_id).execute()
-                add_inventory_log(item_id, "REMOVE", old_q, new_q, changed_by=session.get('full_name', 'Admin'))
+@app.route("/api/transfers")
+@role_required('admin')
+def get_transfers():
+    """Suggested cross-hospital transfers for current shortfalls"""
+    try:
+        return jsonify({'success': True, **transfer_recommender.recommend()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        return redirect(url_for("blood_management"))
+@app.route("/api/stock/thresholds", methods=["GET", "POST"])
+@role_required('admin')
+def stock_thresholds():
+    """List threshold rules, or save one: {"hospital_name"?, "blood_type"?, "low_units", "critical_units", "margin_units"?}"""
+    try:
+        if request.method == "GET":
+            rules = sb_select("stock_thresholds", "*")
+            return jsonify({'success': True, 'rules': rules,
+                            'defaults': {'low_units': STOCK_LOW_UNITS, 'critical_units': STOCK_CRITICAL_UNITS,
+                                         'margin_units': STOCK_ALERT_MARGIN_UNITS}})
+
+        data = request.get_json() or {}
+        blood_type = None
+        if data.get('blood_type') not in (None, '', '*'):
+            blood_type = normalize_blood_type(data['blood_type'])
+            if not blood_type:
+                return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+        try:
+            low = int(data.get('low_units'))
+            critical = int(data.get('critical_units'))
+            margin = int(data['margin_units']) if data.get('margin_units') is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Thresholds must be numbers'}), 400
+        if critical < 0 or low < critical or (margin is not None and margin < 0):
+            return jsonify({'success': False, 'error': 'Need 0 <= critical_units <= low_units and margin_units >= 0'}), 400
+
+        hospital = data.get('hospital_name') if data.get('hospital_name') not in (None, '', '*') else None
+        stock_alerts.set_rule(hospital, blood_type, low, critical, margin)
+        return jsonify({'success': True, 'message': 'Threshold saved', 'alerts': stock_alerts.active()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-    inventory = sb_select("inventory", "*", order=("blood_type", False))
-    low_stock = [i for i in inventory if int(i.get("quantity") or 0) < 2]
-    return render_template("blood_management.html", inventory=inventory, low_stock=low_stock)
+@app.route("/api/forecast")
+@role_required('admin')
+def get_demand_forecast():
+    hospital = request.args.get('hospital') or ROLLUP_ALL_HOSPITALS
+    try:
+        return jsonify({
+            'success': True,
+            'generated_at': demand_forecaster.generated_at,
+            'horizon_days': FORECAST_HORIZON_DAYS,
+            'forecast': demand_forecaster.forecast(hospital),
+        })
+    except Exception as e:
+        print(f"ERROR building demand forecast: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route("/admin/blood_requests", methods=["GET", "POST"])
+@app.route("/api/inventory/history")
 @role_required('admin')
-def blood_requests():
+def get_inventory_history():
+    """?blood_type=A%2B&hospital=...&start=ISO&end=ISO&points=200 - stock level series from the rollups"""
+    try:
+        blood_type = normalize_blood_type(request.args.get('blood_type'))
+        if not blood_type:
+            return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+        try:
+            end = parse_timestamp(request.args['end']) if request.args.get('end') else None
+            start = parse_timestamp(request.args['start']) if request.args.get('start') else None
+            points = int(request.args.get('points', 200))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'start/end must be ISO dates and points a number'}), 400
+        if start and end and start >= end:
+            return jsonify({'success': False, 'error': 'start must be before end'}), 400
+
+        hospital = request.args.get('hospital') or ROLLUP_ALL_HOSPITALS
+        return jsonify({'success': True, 'blood_type': blood_type, 'hospital_name': hospital,
+                        **inventory_rollups.series(blood_type, hospital, start, end, points)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route("/admin/blood_requests", methods=["GET", "POST"])
+@role_required('admin')
+def blood_requests():
     if request.method == "POST":
         requester = request.form.get("requester", "").strip()
-        blood_type = request.form.get("blood_type", "").strip()
+        blood_type = normalize_blood_type(request.form.get("blood_type", "")) or ""
         quantity_ml = int(request.form.get("quantity_ml", "0"))
 
         if requester and blood_type and quantity_ml > 0:
@@ -634,6 +4066,7 @@ def blood_requests():
                 "requester": requester,
                 "blood_type": blood_type,
                 "units_needed": quantity_ml // 450,  # Convert ml to units
+                "hospital_name": request.form.get("hospital_name") or DEFAULT_HOSPITAL,
                 "status": "Pending",
                 "requested_at": now_iso()
             }).execute().data
@@ -641,6 +4074,7 @@ def blood_requests():
             # get new id for logging
             new_id = inserted[0]["id"] if inserted else None
             if new_id:
+                allocation_engine.upsert_request(inserted[0])
                 add_request_log(new_id, "CREATE", "-", "Pending", changed_by=session.get('full_name', 'Admin'))
 
         return redirect(url_for("blood_requests"))
@@ -657,7 +4091,9 @@ def update_request_status(req_id, new_status):
     req = sb_single("urgent_request", "id,status", id=req_id)
     if req:
         old = req.get("status")
-        supabase.table("urgent_request").update({"status": new_status}).eq("id", req_id).execute()
+        updated = supabase.table("urgent_request").update({"status": new_status}).eq("id", req_id).execute().data
+        if updated:
+            allocation_engine.upsert_request(updated[0])
         add_request_log(req_id, "STATUS", old, new_status, changed_by=session.get('full_name', 'Admin'))
 
     return redirect(url_for("blood_requests"))
@@ -666,6 +4102,7 @@ def update_request_status(req_id, new_status):
 @role_required('admin')
 def delete_request(req_id):
     supabase.table("urgent_request").delete().eq("id", req_id).execute()
+    allocation_engine.remove_request(req_id)
     add_request_log(req_id, "DELETE", "-", "-", changed_by=session.get('full_name', 'Admin'))
     return redirect(url_for("blood_requests"))
 
@@ -679,8 +4116,18 @@ def analytics():
 
     pending_requests = supabase.table("urgent_request").select("*").eq("status", "Pending").execute().data
 
+    try:
+        forecast = demand_forecaster.forecast()
+    except Exception as e:
+        print(f"ERROR loading demand forecast: {e}")
+        forecast = []
+
     return render_template(
         "analytics.html",
+        blood_types=BLOOD_TYPES,
+        forecast=forecast,
+        forecast_generated_at=demand_forecaster.generated_at,
+        horizon_days=FORECAST_HORIZON_DAYS,
         counts=counts,
         inv_logs=inv_logs,
         req_logs=req_logs,
@@ -700,26 +4147,32 @@ def staff_dashboard():
             return redirect(url_for('logout'))
         
         staff_details = staff_response.data[0]
-        hospital_name = staff_details.get('hospital_name', 'Hospital')
+        hospital_name = staff_details.get('hospital_name') or DEFAULT_HOSPITAL
         
-        inventory_response = supabase.table('inventory').select('*').execute()
-        total_units = sum(item['quantity'] for item in inventory_response.data) if inventory_response.data else 0
+        # This hospital's stock, from the running totals
+        total_units = sum(inventory_totals.hospital(hospital_name).values())
         
-        requests_response = supabase.table('urgent_request').select('*', count='exact').eq('status', 'Pending').execute()
-        pending_requests = len(requests_response.data)
+        # Pending requests at this hospital, from the allocation engine
+        pending_requests = allocation_engine.pending_count(hospital_name)
         
         donors_response = supabase.table('donors').select('*', count='exact').execute()
         total_donors = len(donors_response.data)
         
+        # Cached by the forecast job, only the stock side is live
+        forecast = demand_forecaster.forecast(hospital_name)
+        
     except Exception as e:
         total_units = 0
         pending_requests = 0
         total_donors = 0
+        forecast = []
         hospital_name = 'Hospital'
         staff_details = {'staff_name': 'Staff'}
     
     return render_template('staff_dashboard.html', 
                          total_units=total_units,
+                         forecast=forecast,
+                         horizon_days=FORECAST_HORIZON_DAYS,
                          pending_requests=pending_requests,
                          total_donors=total_donors,
                          staff_name=staff_details.get('staff_name', 'Staff'),
@@ -733,30 +4186,43 @@ def view_inventory():
         # First, get all blood types that should exist
         blood_types = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
         
-        # Get existing inventory
-        response = supabase.table('inventory').select('*').order('blood_type').execute()
+        # Get this hospital's inventory
+        hospital_name = session.get('hospital_name') or DEFAULT_HOSPITAL
+        response = supabase.table('inventory').select('*').eq('hospital_name', hospital_name).order('blood_type').execute()
         inventory_data = response.data if response.data else []
         
         # Create a dictionary for quick lookup
         inventory_dict = {item['blood_type']: item for item in inventory_data}
         
+        # Lot totals and expiry counts come from the unit index, not from scanning blood_units
+        tracked, expiring = lot_summary(hospital_name)
+        
         # Build the final inventory list with all blood types
         inventory = []
         for blood_type in blood_types:
             if blood_type in inventory_dict:
-                inventory.append(inventory_dict[blood_type])
+                item = inventory_dict[blood_type]
             else:
                 # Create placeholder for missing blood types
-                inventory.append({
+                item = {
                     'blood_type': blood_type,
                     'quantity': 0,
                     'updated_at': None,
                     'id': None
-                })
+                }
+            item['tracked_units'] = tracked.get(blood_type, 0)
+            item['expiring_soon'] = expiring.get(blood_type, 0)
+            if item['id']:
+                item['stock_level'] = stock_alerts.level(hospital_name, blood_type)
+            else:
+                item['stock_level'] = stock_level(0, stock_alerts.rule(hospital_name, blood_type))
+            inventory.append(item)
         
         return render_template('update_inventory.html', 
                              inventory=inventory,
-                             blood_types=blood_types)
+                             blood_types=blood_types,
+                             hospital_name=hospital_name,
+                             expiry_warning_days=UNIT_EXPIRY_WARNING_DAYS)
         
     except Exception as e:
         print(f"Error loading inventory: {e}")
@@ -784,31 +4250,19 @@ def update_inventory():
         except ValueError:
             return jsonify({'success': False, 'error': 'Quantity must be a number'}), 400
         
-        # Get current quantity for logging
-        existing = supabase.table('inventory').select('*').eq('blood_type', blood_type).execute()
-        
-        if existing.data:
-            old_quantity = existing.data[0].get('quantity', 0)
-            # Update existing record
-            response = supabase.table('inventory').update({
-                'quantity': quantity,
-                'last_updated_by': session.get('staff_id'),
-                'updated_at': datetime.now().isoformat()
-            }).eq('blood_type', blood_type).execute()
-            
-            # Log the change
-            print(f"Inventory update: {blood_type} changed from {old_quantity} to {quantity} units")
-            
-        else:
-            # Create new record
-            response = supabase.table('inventory').insert({
-                'blood_type': blood_type,
-                'quantity': quantity,
-                'last_updated_by': session.get('staff_id'),
-                'updated_at': datetime.now().isoformat()
-            }).execute()
-            
-            print(f"Inventory update: {blood_type} created with {quantity} units")
+        blood_type = normalize_blood_type(blood_type)
+        if not blood_type:
+            return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+        
+        # Same atomic path as the admin page: update (or create) and log in one call
+        change = adjust_inventory(
+            'set', quantity,
+            blood_type=blood_type,
+            hospital_name=session.get('hospital_name') or DEFAULT_HOSPITAL,
+            changed_by=session.get('staff_name', 'Staff'),
+            staff_id=session.get('staff_id')
+        )
+        print(f"Inventory update: {blood_type} changed from {change['old_quantity']} to {change['new_quantity']} units")
         
         return jsonify({
             'success': True, 
@@ -819,6 +4273,168 @@ def update_inventory():
         print(f"Error updating inventory: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/staff/inventory/bulk-update', methods=['POST'])
+@role_required('staff')
+def bulk_update_inventory():
+    """Record a full stock count: {"items": [{"blood_type": "A+", "quantity": 12}, ...]}"""
+    try:
+        data = request.get_json() or {}
+        items = data.get('items') or []
+        
+        if not items:
+            return jsonify({'success': False, 'error': 'No inventory items provided'}), 400
+        
+        # Validate the whole count before writing anything
+        counts = {}
+        errors = {}
+        for item in items:
+            raw_type = item.get('blood_type')
+            blood_type = normalize_blood_type(raw_type)
+            if not blood_type:
+                errors[str(raw_type)] = 'Invalid blood type'
+                continue
+            try:
+                quantity = int(item.get('quantity'))
+            except (TypeError, ValueError):
+                errors[blood_type] = 'Quantity must be a number'
+                continue
+            if quantity < 0:
+                errors[blood_type] = 'Quantity cannot be negative'
+            elif blood_type in counts:
+                errors[blood_type] = 'Blood type listed more than once'
+            else:
+                counts[blood_type] = quantity
+        
+        if errors:
+            return jsonify({'success': False, 'error': 'Invalid stock count', 'errors': errors}), 400
+        
+        changes = bulk_set_inventory(
+            counts,
+            hospital_name=session.get('hospital_name') or DEFAULT_HOSPITAL,
+            changed_by=session.get('staff_name', 'Staff'),
+            staff_id=session.get('staff_id')
+        )
+        print(f"Inventory bulk update: {len(changes)} of {len(counts)} blood types changed")
+        
+        return jsonify({
+            'success': True,
+            'message': f'Inventory updated: {len(changes)} of {len(counts)} blood types changed',
+            'changes': changes
+        })
+        
+    except Exception as e:
+        print(f"Error bulk updating inventory: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/staff/inventory/units', methods=['POST'])
+@role_required('staff')
+def receive_blood_units():
+    """Register a lot: {"blood_type", "units", "collected_at"?, "expires_at"?, "source_event_id"?}"""
+    try:
+        data = request.get_json() or {}
+        blood_type = normalize_blood_type(data.get('blood_type'))
+        if not blood_type:
+            return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+        
+        try:
+            units = int(data.get('units'))
+            collected_at = date.fromisoformat(data['collected_at'][:10]).isoformat() if data.get('collected_at') else None
+            expires_at = date.fromisoformat(data['expires_at'][:10]).isoformat() if data.get('expires_at') else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Units must be a number and dates YYYY-MM-DD'}), 400
+        if units <= 0:
+            return jsonify({'success': False, 'error': 'Units must be at least 1'}), 400
+        if collected_at and expires_at and expires_at < collected_at:
+            return jsonify({'success': False, 'error': 'Expiry date is before collection date'}), 400
+        
+        rows = receive_units(
+            blood_type, units,
+            hospital_name=session.get('hospital_name') or DEFAULT_HOSPITAL,
+            collected_at=collected_at,
+            expires_at=expires_at,
+            source_event_id=data.get('source_event_id'),
+            changed_by=session.get('staff_name', 'Staff'),
+            staff_id=session.get('staff_id')
+        )
+        return jsonify({
+            'success': True,
+            'message': f'{len(rows)} {blood_type} units received',
+            'unit_ids': [row['id'] for row in rows],
+            'expires_at': rows[0]['expires_at'] if rows else expires_at
+        })
+        
+    except Exception as e:
+        print(f"Error receiving blood units: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/staff/inventory/units/allocate', methods=['POST'])
+@role_required('staff')
+def allocate_blood_units():
+    """Allocate units first-expiring first: {"blood_type", "units", "request_id"?}"""
+    try:
+        data = request.get_json() or {}
+        blood_type = normalize_blood_type(data.get('blood_type'))
+        if not blood_type:
+            return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+        try:
+            units = int(data.get('units'))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Units must be a number'}), 400
+        if units <= 0:
+            return jsonify({'success': False, 'error': 'Units must be at least 1'}), 400
+        
+        rows = allocate_units(
+            blood_type, units,
+            hospital_name=session.get('hospital_name') or DEFAULT_HOSPITAL,
+            request_id=data.get('request_id'),
+            changed_by=session.get('staff_name', 'Staff'),
+            staff_id=session.get('staff_id')
+        )
+        return jsonify({
+            'success': True,
+            'allocated': len(rows),
+            'shortfall': units - len(rows),
+            'units': [{'id': row['id'], 'expires_at': row['expires_at']} for row in rows]
+        })
+        
+    except Exception as e:
+        print(f"Error allocating blood units: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/stock/alerts')
+@role_required('staff')
+def get_stock_alerts():
+    """Blood types currently below their low / critical threshold at the staff member's hospital"""
+    try:
+        hospital_name = session.get('hospital_name') or DEFAULT_HOSPITAL
+        return jsonify({'success': True, 'alerts': stock_alerts.active(hospital_name)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/inventory/expiring')
+@role_required('staff')
+def get_expiring_units():
+    """Available units expiring within ?days= (default UNIT_EXPIRY_WARNING_DAYS), optionally for one ?blood_type="""
+    try:
+        days = int(request.args.get('days', UNIT_EXPIRY_WARNING_DAYS))
+        blood_type = None
+        if request.args.get('blood_type'):
+            blood_type = normalize_blood_type(request.args['blood_type'])
+            if not blood_type:
+                return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+        
+        units = unit_index.expiring_within(days, blood_type, hospital=session.get('hospital_name') or DEFAULT_HOSPITAL)
+        return jsonify({
+            'success': True,
+            'days': days,
+            'count': len(units),
+            'units': [{'id': unit_id, 'blood_type': bt, 'expires_at': expires_at} for expires_at, unit_id, bt in units]
+        })
+    except ValueError:
+        return jsonify({'success': False, 'error': 'days must be a number'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/staff/donors', methods=['GET'])
 @role_required('staff')
 def donor_list():
@@ -857,6 +4473,10 @@ def add_donor():
         if not all([donor_name, email, blood_type]):
             return jsonify({'success': False, 'error': 'Missing required fields'}), 400
         
+        blood_type = normalize_blood_type(blood_type)
+        if not blood_type:
+            return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+        
         existing_donor = supabase.table('donors').select('*').eq('email', email).execute()
         if existing_donor.data:
             return jsonify({'success': False, 'error': 'Donor with this email already exists'}), 400
@@ -895,6 +4515,8 @@ def add_donor():
             donor_data['age'] = int(age)
         
         donor_response = supabase.table('donors').insert(donor_data).execute()
+        if donor_response.data:
+            donor_index.apply(donor_response.data[0])
         
         return jsonify({
             'success': True, 
@@ -905,6 +4527,22 @@ def add_donor():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/staff/donors/import', methods=['POST'])
+@role_required('staff')
+def import_donor_csv():
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'success': False, 'error': 'No CSV file uploaded'}), 400
+    try:
+        lines = TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        report = import_donors(lines)
+        return jsonify(dict(report, success=True))
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'success': False, 'error': f'Could not read CSV: {e}'}), 400
+    except Exception as e:
+        print(f"ERROR importing donors: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/staff/requests', methods=['GET'])
 @role_required('staff')
 def view_requests():
@@ -923,13 +4561,13 @@ def view_requests():
 @role_required('staff')
 def create_request():
     staff_id = session.get('staff_id')
-    hospital_name = 'City General Hospital'
+    hospital_name = session.get('hospital_name') or DEFAULT_HOSPITAL
     
     if staff_id:
         try:
             staff_response = supabase.table('staff').select('*').eq('id', staff_id).execute()
             if staff_response.data:
-                hospital_name = staff_response.data[0].get('hospital_name', 'City General Hospital')
+                hospital_name = staff_response.data[0].get('hospital_name') or hospital_name
         except Exception as e:
             pass
     
@@ -947,7 +4585,7 @@ def create_request():
     
     elif request.method == 'POST':
         try:
-            blood_type = request.form.get('blood_type')
+            blood_type = normalize_blood_type(request.form.get('blood_type'))
             units_needed = int(request.form.get('units_needed', 0))
             urgency_level = request.form.get('urgency_level')
             notes = request.form.get('notes', '')
@@ -972,58 +4610,49 @@ def create_request():
             if response.data:
                 request_id = response.data[0]['id']
                 print(f"DEBUG: Created urgent request ID: {request_id}")
+                allocation_engine.upsert_request(response.data[0])
                 
                 # ========== NOTIFY MATCHING DONORS ==========
                 try:
-                    # Get all eligible donors with matching blood type
-                    donors_response = supabase.table('donors')\
-                        .select('user_id, donor_name, blood_type, eligibility_status')\
-                        .eq('blood_type', blood_type)\
-                        .eq('eligibility_status', True)\
-                        .execute()
+                    # Get all eligible donors whose blood type can supply this request
+                    compatible_donors = find_compatible_donors(blood_type)
                     
-                    donors_notified = 0
+                    # Build the message once - it is the same for every matching donor
+                    notification_message = f"URGENT: {hospital_name} needs {units_needed} units of {blood_type} blood."
                     
-                    if donors_response.data:
-                        for donor in donors_response.data:
-                            donor_user_id = donor.get('user_id')
-                            donor_name = donor.get('donor_name', 'Donor')
-                            
-                            if donor_user_id:
-                                # Create notification for each matching donor
-                                notification_message = f"URGENT: {hospital_name} needs {units_needed} units of {blood_type} blood."
-                                
-                                if urgency_level == 'High':
-                                    notification_message += " This is a CRITICAL emergency!"
-                                elif urgency_level == 'Medium':
-                                    notification_message += " Required for scheduled procedure."
-                                
-                                if patient_info:
-                                    notification_message += f" For: {patient_info}"
-                                
-                                if notes:
-                                    notification_message += f" Notes: {notes}"
-                                
-                                # Use the create_notification helper function
-                                notification = create_notification(
-                                    user_id=donor_user_id,
-                                    title=f"Urgent Blood Request ({blood_type})",
-                                    message=notification_message,
-                                    notification_type="alert",  # Use "alert" for urgent notifications
-                                    related_id=str(request_id)  # Link to the request
-                                )
-                                
-                                if notification:
-                                    donors_notified += 1
-                                    print(f"DEBUG: Notified donor {donor_name} ({donor_user_id})")
+                    if urgency_level == 'High':
+                        notification_message += " This is a CRITICAL emergency!"
+                    elif urgency_level == 'Medium':
+                        notification_message += " Required for scheduled procedure."
+                    
+                    if patient_info:
+                        notification_message += f" For: {patient_info}"
+                    
+                    if notes:
+                        notification_message += f" Notes: {notes}"
+                    
+                    # Alert only the best-ranked donors needed to cover units_needed;
+                    # further waves go out automatically while the request stays Pending
+                    notified = start_recall(
+                        request_id,
+                        units_needed,
+                        urgency_level,
+                        compatible_donors,
+                        title=f"Urgent Blood Request ({blood_type})",
+                        message=notification_message,
+                        exact_type=blood_type if DONOR_MATCH_MODE == 'exact_first' else None
+                    )
+                    donors_notified = len(notified)
                     
                     print(f"DEBUG: Successfully notified {donors_notified} donors for blood type {blood_type}")
                     
                     # Add success message with notification count
                     if donors_notified > 0:
                         flash(f'Urgent blood request created successfully! Notified {donors_notified} matching donors.', 'success')
+                    elif allocation_engine.shortfall(request_id) == 0:
+                        flash('Urgent blood request created successfully! Compatible stock covers it, so no donors were alerted yet.', 'success')
                     else:
-                        flash('Urgent blood request created successfully! No eligible donors with matching blood type found.', 'info')
+                        flash('Urgent blood request created successfully! No eligible donors with a compatible blood type found.', 'info')
                     
                 except Exception as notify_error:
                     print(f"DEBUG: Error notifying donors: {notify_error}")
@@ -1048,28 +4677,19 @@ def create_request():
 def get_donor_count_by_blood_type(blood_type):
     """Get count of eligible donors by blood type (simplified)"""
     try:
+        blood_type = normalize_blood_type(blood_type) or blood_type
         print(f"DEBUG: Counting donors with blood type: {blood_type}")
         
-        # Try different query approaches
-        response = supabase.table('donors')\
-            .select('id')\
-            .eq('blood_type', blood_type)\
-            .eq('eligibility_status', True)\
-            .execute()
-        
-        print(f"DEBUG: Response: {response}")
-        
-        count = 0
-        if hasattr(response, 'data') and response.data:
-            count = len(response.data)
-        elif hasattr(response, 'count'):
-            count = response.count
+        # Answered from the in-memory index - no database round trip
+        count = donor_index.count(blood_type)
+        compatible_count = sum(donor_index.count(t) for t in compatible_donor_types(blood_type, 'compatible'))
             
-        print(f"DEBUG: Count = {count}")
+        print(f"DEBUG: Count = {count} (compatible: {compatible_count})")
         
         return jsonify({
             'success': True,
             'count': count,
+            'compatible_count': compatible_count,
             'blood_type': blood_type
         })
         
@@ -1083,6 +4703,14 @@ def get_donor_count_by_blood_type(blood_type):
             'error': str(e),
             'count': 0
         }), 500
+
+@app.route('/api/donors/eligible/<blood_type>')
+@role_required('staff')
+def get_eligible_donor_ids(blood_type):
+    """Ids of eligible donors of a blood type, from the in-memory index"""
+    blood_type = normalize_blood_type(blood_type) or blood_type
+    donor_ids = donor_index.members(blood_type)
+    return jsonify({'success': True, 'blood_type': blood_type, 'count': len(donor_ids), 'donor_ids': donor_ids})
         
 @app.route('/staff/donors/toggle-eligibility', methods=['POST'])
 @role_required('staff')
@@ -1105,6 +4733,7 @@ def toggle_donor_eligibility():
         response = supabase.table('donors').update(update_data).eq('id', donor_id).execute()
         
         if response.data:
+            donor_index.apply(response.data[0])
             return jsonify({'success': True, 'message': 'Donor eligibility updated'})
         else:
             return jsonify({'success': False, 'error': 'Donor not found'}), 404
@@ -1135,13 +4764,17 @@ def update_donor(donor_id):
         if 'donor_name' in data:
             update_data['donor_name'] = data['donor_name']
         if 'blood_type' in data:
-            update_data['blood_type'] = data['blood_type']
+            blood_type = normalize_blood_type(data['blood_type'])
+            if not blood_type:
+                return jsonify({'success': False, 'error': 'Invalid blood type'}), 400
+            update_data['blood_type'] = blood_type
         if 'age' in data and data['age']:
             update_data['age'] = int(data['age'])
         
         response = supabase.table('donors').update(update_data).eq('id', donor_id).execute()
         
         if response.data:
+            donor_index.apply(response.data[0])
             return jsonify({'success': True, 'message': 'Donor updated'})
         else:
             return jsonify({'success': False, 'error': 'Donor not found'}), 404
@@ -1153,15 +4786,20 @@ def update_donor(donor_id):
 @role_required('staff')
 def fulfill_request(request_id):
     try:
-        response = supabase.table('urgent_request').update({
-            'status': 'Fulfilled',
-            'handled_by': session.get('staff_id')
-        }).eq('id', request_id).execute()
-        
-        if response.data:
-            return jsonify({'success': True, 'message': 'Request fulfilled successfully'})
-        else:
-            return jsonify({'success': False, 'error': 'Request not found'}), 404
+        # Marks the request Fulfilled and takes its stock, or changes nothing
+        try:
+            used = consume_allocation(
+                request_id,
+                changed_by=session.get('staff_name', 'Staff'),
+                staff_id=session.get('staff_id')
+            )
+        except LookupError:
+            return jsonify({'success': False, 'error': 'Only pending requests can be fulfilled'}), 409
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e),
+                            'allocation': allocation_engine.allocation(request_id)}), 409
+        print(f"DEBUG: Request {request_id} fulfilled from stock: {used}")
+        return jsonify({'success': True, 'message': 'Request fulfilled successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -1173,6 +4811,7 @@ def cancel_request(request_id):
             'status': 'Cancelled',
             'handled_by': session.get('staff_id')
         }).eq('id', request_id).execute()
+        allocation_engine.remove_request(request_id)
         
         if response.data:
             return jsonify({'success': True, 'message': 'Request cancelled successfully'})
@@ -1198,13 +4837,21 @@ def get_request_details(request_id):
                 staff_response = supabase.table('staff').select('*').eq('id', request_data['handled_by']).execute()
                 if staff_response.data:
                     request_data['staff_name'] = staff_response.data[0].get('staff_name', 'Staff')
-                    request_data['hospital_name'] = staff_response.data[0].get('hospital_name', 'City General Hospital')
+                    request_data['hospital_name'] = staff_response.data[0].get('hospital_name') or DEFAULT_HOSPITAL
                 else:
                     request_data['staff_name'] = session.get('staff_name', 'Staff')
-                    request_data['hospital_name'] = session.get('hospital_name', 'City General Hospital')
+                    request_data['hospital_name'] = session.get('hospital_name') or DEFAULT_HOSPITAL
             else:
                 request_data['staff_name'] = session.get('staff_name', 'Staff')
-                request_data['hospital_name'] = session.get('hospital_name', 'City General Hospital')
+                request_data['hospital_name'] = session.get('hospital_name') or DEFAULT_HOSPITAL
+            
+            # Stock that could fill this request, exact type first
+            request_data['compatible_types'] = compatible_donor_types(request_data.get('blood_type'))
+            request_data['inventory_sources'] = find_inventory_sources(
+                request_data.get('blood_type'),
+                hospital_name=request_data.get('hospital_name') or DEFAULT_HOSPITAL
+            )
+            request_data['allocation'] = allocation_engine.allocation(request_data['id'])
             
             return jsonify({'success': True, 'request': request_data})
         else:
@@ -1212,6 +4859,15 @@ def get_request_details(request_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
     
+@app.route('/api/allocations')
+@role_required('staff')
+def get_allocations():
+    """Proposed stock allocation for every Pending request, with shortfalls (?hospital= for one hospital)"""
+    try:
+        return jsonify({'success': True, **allocation_engine.snapshot(request.args.get('hospital'))})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/staff/requests/<int:request_id>/notify', methods=['POST'])
 @role_required('staff')
 def notify_donors(request_id):
@@ -1231,123 +4887,101 @@ def notify_donors(request_id):
         request_data = request_response.data[0]
         blood_type = request_data['blood_type']
         units_needed = request_data.get('units_needed', 0)
-        hospital_name = request_data.get('hospital_name', 'Hospital')
+        hospital_name = request_data.get('hospital_name') or DEFAULT_HOSPITAL
         urgency_level = request_data.get('urgency_level', 'Medium')
         notes = request_data.get('notes', '')
         
         print(f"DEBUG: Found request - Blood type: {blood_type}, Units: {units_needed}, Hospital: {hospital_name}")
         
-        # FIRST: Check what donors exist with ANY blood type
-        all_donors_test = supabase.table('donors').select('id, donor_name, blood_type, eligibility_status, user_id').limit(5).execute()
-        print(f"DEBUG: Sample donors in database: {all_donors_test.data}")
-        
-        # SECOND: Try different ways to query for the blood type
-        print(f"DEBUG: Attempting to find donors with blood type: '{blood_type}'")
-        
-        # Try exact match first
-        donors_response = supabase.table('donors')\
-            .select('id, user_id, donor_name, blood_type, eligibility_status, email')\
-            .eq('blood_type', blood_type)\
-            .eq('eligibility_status', True)\
-            .execute()
-        
-        print(f"DEBUG: Exact match query result: Found {len(donors_response.data) if donors_response.data else 0} donors")
+        # An explicit resend bumps the counter on existing rows instead of inserting new ones;
+        # otherwise a manual press sends the next recall wave ("all" alerts every remaining donor)
+        payload = request.get_json(silent=True) or {}
+        resend = bool(payload.get('resend'))
+        notify_all = bool(payload.get('all'))
+        match_mode = payload.get('match') if payload.get('match') in DONOR_MATCH_MODES else DONOR_MATCH_MODE
         
-        # If no exact matches, try case-insensitive
-        if not donors_response.data or len(donors_response.data) == 0:
-            print(f"DEBUG: Trying case-insensitive search for '{blood_type}'")
-            
-            # Get all donors and filter manually
-            all_donors = supabase.table('donors').select('id, user_id, donor_name, blood_type, eligibility_status, email').execute()
-            
-            if all_donors.data:
-                matching_donors = []
-                for donor in all_donors.data:
-                    donor_blood_type = donor.get('blood_type', '').strip().upper()
-                    search_blood_type = blood_type.strip().upper()
-                    
-                    # Check for different blood type formats
-                    is_match = (
-                        donor_blood_type == search_blood_type or
-                        donor_blood_type.replace('+', ' POSITIVE') == search_blood_type.replace('+', ' POSITIVE') or
-                        donor_blood_type.replace('-', ' NEGATIVE') == search_blood_type.replace('-', ' NEGATIVE')
-                    )
-                    
-                    if is_match and donor.get('eligibility_status') == True:
-                        matching_donors.append(donor)
-                
-                print(f"DEBUG: Manual filtering found {len(matching_donors)} matching donors")
-                donors_response.data = matching_donors
+        # One indexed in_() lookup over every compatible blood type
+        donors = find_compatible_donors(blood_type, match_mode)
+        print(f"DEBUG: Found {len(donors)} eligible donors compatible with '{blood_type}' (mode={match_mode})")
         
         donors_notified = 0
+        donors_resent = 0
         donor_details = []
         
-        if donors_response.data and len(donors_response.data) > 0:
-            print(f"DEBUG: Processing {len(donors_response.data)} eligible donors")
+        if donors:
+            print(f"DEBUG: Processing {len(donors)} eligible donors")
             
-            for donor in donors_response.data:
-                donor_user_id = donor.get('user_id')
-                donor_name = donor.get('donor_name', 'Donor')
-                donor_blood_type = donor.get('blood_type', 'Unknown')
-                
-                print(f"DEBUG: Processing donor: {donor_name}, Blood type: {donor_blood_type}, User ID: {donor_user_id}, Eligible: {donor.get('eligibility_status')}")
-                
-                if donor_user_id:
-                    # Create the notification message
-                    notification_message = f"URGENT BLOOD REQUEST: {hospital_name} needs {units_needed} units of {blood_type} blood"
-                    
-                    if urgency_level == 'High':
-                        notification_message += " - CRITICAL EMERGENCY!"
-                    elif urgency_level == 'Medium':
-                        notification_message += " - Urgent need for scheduled procedure"
-                    else:
-                        notification_message += " - Please consider donating if available"
-                    
-                    if notes:
-                        notification_message += f"\n\nNotes: {notes}"
-                    
-                    print(f"DEBUG: Creating notification for donor {donor_name} (User ID: {donor_user_id})")
-                    
-                    # Create notification in database
-                    notification = create_notification(
-                        user_id=donor_user_id,
-                        title=f"⚠️ Urgent: {blood_type} Blood Needed",
-                        message=notification_message,
-                        notification_type="alert",
-                        related_id=str(request_id)
-                    )
-                    
-                    if notification:
-                        donors_notified += 1
-                        donor_details.append({
-                            'name': donor_name,
-                            'user_id': donor_user_id,
-                            'email': donor.get('email', 'No email'),
-                            'blood_type': donor_blood_type
-                        })
-                        print(f"DEBUG: SUCCESS - Created notification for donor: {donor_name}")
-                    else:
-                        print(f"DEBUG: FAILED - Could not create notification for donor: {donor_name}")
-                else:
-                    print(f"DEBUG: Skipping donor {donor_name} - missing user_id")
+            # Create the notification message
+            notification_message = f"URGENT BLOOD REQUEST: {hospital_name} needs {units_needed} units of {blood_type} blood"
+            
+            if urgency_level == 'High':
+                notification_message += " - CRITICAL EMERGENCY!"
+            elif urgency_level == 'Medium':
+                notification_message += " - Urgent need for scheduled procedure"
+            else:
+                notification_message += " - Please consider donating if available"
+            
+            if notes:
+                notification_message += f"\n\nNotes: {notes}"
+            
+            donors_by_user = {str(d['user_id']): d for d in donors if d.get('user_id')}
+            
+            notified = []
+            if resend:
+                resent = resend_notifications(str(request_id), "alert", user_ids=list(donors_by_user))
+                donors_resent = len(resent)
+            else:
+                # Donors who already have this alert are skipped by the planner and the upsert.
+                # No active plan (new request or restarted server): plan it and send wave 1,
+                # otherwise escalate straight to the next wave.
+                if recall_status(request_id) is None:
+                    notified = start_recall(
+                        request_id,
+                        units_needed,
+                        urgency_level,
+                        donors,
+                        title=f"⚠️ Urgent: {blood_type} Blood Needed",
+                        message=notification_message,
+                        exact_type=blood_type if match_mode == 'exact_first' else None
+                    )
+                if notify_all or not notified:
+                    notified = notified + send_recall_wave(request_id, notify_all=notify_all)
+            donors_notified = len(notified)
+            
+            for notification in notified:
+                donor = donors_by_user.get(str(notification.get('user_id')), {})
+                donor_details.append({
+                    'name': donor.get('donor_name', 'Donor'),
+                    'user_id': notification.get('user_id'),
+                    'email': donor.get('email', 'No email'),
+                    'blood_type': donor.get('blood_type', 'Unknown')
+                })
         else:
             print(f"DEBUG: No eligible donors found for blood type {blood_type}")
-            
-            # Check what blood types actually exist in the database
-            all_blood_types = supabase.table('donors').select('blood_type').execute()
-            if all_blood_types.data:
-                unique_blood_types = set([d.get('blood_type') for d in all_blood_types.data if d.get('blood_type')])
-                print(f"DEBUG: Blood types in database: {sorted(unique_blood_types)}")
+        
+        if donors_notified > 0 or donors_resent > 0:
+            message = f'Notifications sent to {donors_notified} donors compatible with {blood_type}'
+            if donors_resent > 0:
+                message += f' (re-sent to {donors_resent} previously notified donors)'
+        elif donors and allocation_engine.shortfall(request_id) == 0:
+            message = 'Compatible stock covers this request, so no donors were alerted (send with "all" to alert them anyway)'
+        elif donors:
+            message = f'All eligible donors compatible with {blood_type} were already notified for this request'
+        else:
+            message = f'No eligible donors found compatible with {blood_type}'
         
         result = {
-            'success': True if donors_notified > 0 else False, 
-            'message': f'Notifications sent to {donors_notified} donors with {blood_type} blood type' if donors_notified > 0 else f'No eligible donors found with {blood_type} blood type',
+            'success': True if donors else False, 
+            'message': message,
             'donors_notified': donors_notified,
+            'donors_resent': donors_resent,
+            'recall': recall_status(request_id),
             'donor_details': donor_details,
             'blood_type': blood_type,
+            'match_mode': match_mode,
             'debug': {
                 'request_blood_type': blood_type,
-                'total_donors_checked': len(donors_response.data) if donors_response.data else 0
+                'total_donors_checked': len(donors) if donors else 0
             }
         }
         
@@ -1384,16 +5018,13 @@ def donor_dashboard():
                 .execute()
             
             if registrations_response.data:
-                # Get event details for each registration
+                # Event details for all registrations at once
+                events = event_cache.get_many(r.get('event_id') for r in registrations_response.data)
                 for registration in registrations_response.data:
                     if registration.get('event_id'):
-                        event_response = supabase.table('events')\
-                            .select('*')\
-                            .eq('id', registration['event_id'])\
-                            .execute()
+                        event = events.get(_event_key(registration['event_id']))
                         
-                        if event_response.data:
-                            event = event_response.data[0]
+                        if event:
                             # ONLY add if event has organizer_id (not None)
                             if event.get('organizer_id') is not None:
                                 appointment = {
@@ -1459,99 +5090,69 @@ def donor_appointment():
         
         donor = donor_response.data[0]
         
-        # Get only properly created events (with organizer_id)
-        # Option 1: Try this first (simplest)
-        events_response = supabase.table('events').select('*').order('event_date').execute()
-        all_events = events_response.data if events_response.data else []
-        
-        # Filter in Python to avoid syntax issues
-        events = [event for event in all_events if event.get('organizer_id') is not None]
+        if request.method == 'POST':
+            try:
+                data = request.get_json()
+                event_id = data.get('event_id')
+                
+                if not event_id:
+                    return jsonify({'success': False, 'error': 'Event ID required'}), 400
+                
+                # Duplicate check, capacity check and insert in one call (user_id from session)
+                reservation = reserve_registration(int(event_id), session['user_id'], data.get('slot_start'))
+                outcome = reservation['outcome']
+                
+                if outcome == 'duplicate':
+                    return jsonify({'success': False, 'error': 'Already registered for this event'}), 400
+                if outcome == 'not_found':
+                    return jsonify({'success': False, 'error': 'Event not found'}), 404
+                if outcome == 'no_such_slot':
+                    return jsonify({'success': False, 'error': 'That time slot does not exist'}), 400
+                if outcome == 'waitlisted':
+                    return jsonify({'success': True, 'waitlisted': True,
+                                    'waitlist_position': reservation['waitlist_position'],
+                                    'message': f"This drive is full. You are #{reservation['waitlist_position']} on the waitlist."})
+                
+                return jsonify({'success': True, 'message': 'Successfully registered for event!'})
+                
+            except Exception as e:
+                print(f"Error registering for event: {e}")
+                return jsonify({'success': False, 'error': str(e)}), 500
         
-        print(f"DEBUG: Found {len(events)} events with organizer_id")
+        # Upcoming events with an organizer, shared across donors
+        events = [dict(event) for event in upcoming_events.get()]
         
         # Get existing registrations for this donor
         registered_event_ids = []
+        registration_ids = {}
+        waitlist_positions = {}
         try:
             # Use session['user_id'] (which is users.id) to check registrations
             registrations_response = supabase.table('registrations')\
-                .select('event_id')\
+                .select('id, event_id, status, waitlist_position')\
                 .eq('donor_id', session['user_id'])\
                 .execute()
             
             if registrations_response.data:
-                registered_event_ids = [reg['event_id'] for reg in registrations_response.data]
+                # A cancelled sign-up does not count - the donor may register again
+                registration_ids = {reg['event_id']: reg['id'] for reg in registrations_response.data
+                                    if reg.get('status') != 'Cancelled'}
+                registered_event_ids = list(registration_ids)
+                waitlist_positions = {reg['event_id']: reg.get('waitlist_position')
+                                      for reg in registrations_response.data if reg.get('status') == 'Waitlisted'}
         except Exception as e:
             print(f"Note: Could not fetch registrations: {e}")
             registered_event_ids = []
         
         print(f"DEBUG: Already registered for event IDs: {registered_event_ids}")
         
-        # Determine which events are registerable
-        today = datetime.now().date()
+        # Per-donor overlay; past/cancelled events are already filtered out
         for event in events:
-            # Parse event date
-            event_date = None
-            if event.get('event_date'):
-                if isinstance(event['event_date'], str):
-                    try:
-                        event_date = datetime.strptime(event['event_date'], '%Y-%m-%d').date()
-                    except:
-                        event_date = None
-                elif isinstance(event['event_date'], datetime):
-                    event_date = event['event_date'].date()
-            
-            # Check if event is in past
-            is_past = False
-            if event_date:
-                is_past = event_date < today
-            
-            # Check if event is cancelled
-            is_cancelled = event.get('status') == 'Cancelled'
-            
-            # Check if already registered
             already_registered = event['id'] in registered_event_ids
-            
-            # Can register if: not past, not cancelled, not already registered, and eligible
-            event['can_register'] = (not is_past and 
-                                   not is_cancelled and 
-                                   not already_registered and 
-                                   donor.get('eligibility_status', False))
-            
-            event['is_past'] = is_past
-            event['is_cancelled'] = is_cancelled
             event['already_registered'] = already_registered
-        
-        if request.method == 'POST':
-            try:
-                data = request.get_json()
-                event_id = data.get('event_id')
-                
-                if not event_id:
-                    return jsonify({'success': False, 'error': 'Event ID required'}), 400
-                
-                # Check if already registered
-                existing_registration = supabase.table('registrations')\
-                    .select('*')\
-                    .eq('donor_id', session['user_id'])\
-                    .eq('event_id', event_id)\
-                    .execute()
-                
-                if existing_registration.data:
-                    return jsonify({'success': False, 'error': 'Already registered for this event'}), 400
-                
-                # Create registration using user_id from session
-                registration_response = supabase.table('registrations').insert({
-                    'donor_id': session['user_id'],
-                    'event_id': event_id,
-                    'status': 'Pending',
-                    'registered_at': datetime.now().isoformat()
-                }).execute()
-                
-                return jsonify({'success': True, 'message': 'Successfully registered for event!'})
-                
-            except Exception as e:
-                print(f"Error registering for event: {e}")
-                return jsonify({'success': False, 'error': str(e)}), 500
+            event['registration_id'] = registration_ids.get(event['id'])
+            event['waitlist_position'] = waitlist_positions.get(event['id'])
+            event['can_register'] = not already_registered and donor.get('eligibility_status', False)
         
         return render_template('appointment.html',
                              donor=donor,
@@ -1563,6 +5164,24 @@ def donor_appointment():
         flash('Error loading appointment page', 'error')
         return redirect(url_for('donor_dashboard'))
 
+@app.route('/donor/registrations/<int:registration_id>/cancel', methods=['POST'])
+@role_required('donor')
+def cancel_registration(registration_id):
+    """Donor cancels their own sign-up (or leaves the waitlist); a freed place goes to the waitlist"""
+    try:
+        registration = sb_single('registrations', 'id, donor_id, status', id=registration_id)
+        if not registration or str(registration['donor_id']) != str(session['user_id']):
+            return jsonify({'success': False, 'error': 'Registration not found'}), 404
+        if registration.get('status') in ('Attended', 'No-show', 'Cancelled'):
+            return jsonify({'success': False, 'error': f"Registration is already {registration['status']}"}), 409
+        
+        set_registration_status(registration_id, 'Cancelled')
+        return jsonify({'success': True, 'message': 'Your registration has been cancelled'})
+    
+    except Exception as e:
+        print(f"Error cancelling registration: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/donor/eligibility')
 @role_required('donor')
 def donor_eligibility():
@@ -1849,36 +5468,22 @@ def organizer_dashboard():
     try:
         organizer_id = session.get('organizer_id') or session.get('user_id')
         
-        # Get events created by this organizer
+        # Get events created by this organizer, counters included
         events_response = supabase.table('events').select('*').eq('organizer_id', organizer_id).execute()
+        with_event_counts(events_response.data or [])
         total_events = len(events_response.data) if events_response.data else 0
         
         # Get total registrations across all events
-        total_registrations = 0
-        if events_response.data:
-            for event in events_response.data:
-                reg_response = supabase.table('registrations').select('*', count='exact').eq('event_id', event['id']).execute()
-                if reg_response.data:
-                    total_registrations += len(reg_response.data)
+        total_registrations = sum(e['registration_count'] for e in events_response.data or [])
         
         # Get total attendance
-        total_attendance = 0
-        if events_response.data:
-            for event in events_response.data:
-                attendance_response = supabase.table('attendance').select('*', count='exact').eq('event_id', event['id']).execute()
-                if attendance_response.data:
-                    total_attendance += len(attendance_response.data)
+        total_attendance = sum(e['attended_count'] for e in events_response.data or [])
         
         # Blood units collected
         blood_units_collected = total_attendance
         
         # Recent events
-        recent_events = []
-        if events_response.data:
-            for event in events_response.data[:5]:
-                reg_count_response = supabase.table('registrations').select('*', count='exact').eq('event_id', event['id']).execute()
-                event['registration_count'] = len(reg_count_response.data) if reg_count_response.data else 0
-                recent_events.append(event)
+        recent_events = list(events_response.data[:5]) if events_response.data else []
         
         # Upcoming events
         upcoming_events = []
@@ -1896,8 +5501,6 @@ def organizer_dashboard():
                         event_date = event['event_date'].date()
                 
                 if event_date and event_date >= today and event.get('status') == 'Upcoming':
-                    reg_count_response = supabase.table('registrations').select('*', count='exact').eq('event_id', event['id']).execute()
-                    event['registration_count'] = len(reg_count_response.data) if reg_count_response.data else 0
                     upcoming_events.append(event)
         
         # Statistics
@@ -1937,11 +5540,7 @@ def manage_events():
         organizer_id = session.get('organizer_id') or session.get('user_id')
         
         events_response = supabase.table('events').select('*').eq('organizer_id', organizer_id).execute()
-        events = events_response.data if events_response.data else []
-        
-        for event in events:
-            reg_count_response = supabase.table('registrations').select('*', count='exact').eq('event_id', event['id']).execute()
-            event['registration_count'] = len(reg_count_response.data) if reg_count_response.data else 0
+        events = with_event_counts(events_response.data if events_response.data else [])
         
         return render_template('manage_events.html', events=events)
     
@@ -1954,14 +5553,12 @@ def manage_events():
 @role_required('organizer')
 def view_event(event_id):
     try:
-        event_response = supabase.table('events').select('*').eq('id', event_id).execute()
+        event = event_cache.get(event_id)
         
-        if not event_response.data:
+        if not event:
             flash('Event not found', 'error')
             return redirect(url_for('manage_events'))
         
-        event = event_response.data[0]
-        
         registrations_response = supabase.table('registrations').select('*').eq('event_id', event_id).execute()
         registrations = registrations_response.data if registrations_response.data else []
         
@@ -1996,6 +5593,9 @@ def save_event():
         else:
             supabase.table('events').insert(event_data).execute()
             flash('Event created successfully!', 'success')
+        upcoming_events.invalidate()
+        if event_id:
+            event_cache.invalidate(event_id)
         
         return redirect(url_for('manage_events'))
     
@@ -2004,6 +5604,59 @@ def save_event():
         flash('Error saving event', 'error')
         return redirect(url_for('manage_events'))
 
+@app.route('/organizer/event/<int:event_id>/schedule', methods=['GET', 'POST'])
+@role_required('organizer')
+def event_schedule(event_id):
+    organizer_id = session.get('organizer_id') or session.get('user_id')
+    event = event_cache.get(event_id)
+    if not event or str(event.get('organizer_id')) != str(organizer_id):
+        flash('Event not found', 'error')
+        return redirect(url_for('manage_events'))
+
+    if request.method == 'POST':
+        try:
+            result = generate_event_slots(event_id,
+                                          request.form.get('start_time') or event.get('event_time'),
+                                          request.form.get('end_time'),
+                                          int(request.form.get('slot_minutes') or SLOT_MINUTES),
+                                          int(request.form.get('chairs') or 1))
+            flash(f"Schedule saved: {result['slots']} slots", 'success')
+            if result['kept_booked_slots']:
+                flash(f"{len(result['kept_booked_slots'])} slots outside the new hours were kept because donors are booked in them", 'warning')
+        except (TypeError, ValueError) as e:
+            flash(f'Invalid schedule: {e}', 'error')
+        except Exception as e:
+            print(f"Save schedule error: {e}")
+            flash('Error saving schedule', 'error')
+        return redirect(url_for('event_schedule', event_id=event_id))
+
+    try:
+        projection = projected_throughput(event_id, organizer_id)
+    except Exception as e:
+        print(f"Event schedule error: {e}")
+        flash('Error loading schedule', 'error')
+        projection = {'show_rate': EXPECTED_SHOW_RATE, 'slots': [], 'expected_total': 0}
+    if request.args.get('format') == 'json':
+        return jsonify(dict(projection, success=True))
+    return render_template('event_schedule.html', event=event, projection=projection, slot_minutes=SLOT_MINUTES)
+
+@app.route('/api/events/<int:event_id>/slots')
+@role_required('donor')
+def suggest_event_slots(event_id):
+    """Nearest free slots to ?near=HH:MM (default the event's start time)"""
+    try:
+        event = event_cache.get(event_id)
+        if not event:
+            return jsonify({'success': False, 'error': 'Event not found'}), 404
+        count = max(1, min(int(request.args.get('count', 3)), 20))
+        suggestions = slot_index.nearest_free(event_id, event_start(event, request.args.get('near')), count)
+        return jsonify({'success': True, 'has_slots': bool(slot_index.slots(event_id)), 'slots': suggestions})
+    except ValueError:
+        return jsonify({'success': False, 'error': 'near must be HH:MM'}), 400
+    except Exception as e:
+        print(f"Suggest slots error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/event/<int:event_id>/status', methods=['POST'])
 @role_required('organizer')
 def update_event_status(event_id):
@@ -2015,6 +5668,8 @@ def update_event_status(event_id):
             return jsonify({'success': False, 'message': 'Invalid status'})
         
         supabase.table('events').update({'status': new_status}).eq('id', event_id).execute()
+        upcoming_events.invalidate()
+        event_cache.invalidate(event_id)
         
         return jsonify({'success': True, 'message': 'Event status updated'})
     
@@ -2066,9 +5721,7 @@ def view_registrations():
                     registrations.append(registration_data)
                 
                 # Get event details
-                event_response = supabase.table('events').select('*').eq('id', event_id).execute()
-                if event_response.data:
-                    selected_event = event_response.data[0]
+                selected_event = event_cache.get(event_id)
                 
                 # Calculate statistics
                 total_registrations_count = len(registrations_response.data)
@@ -2132,64 +5785,21 @@ def update_registration_status(registration_id):
         
         print(f"DEBUG: Request data - new_status={new_status}, event_id={event_id}")
         
-        if not new_status or new_status not in ['Pending', 'Confirmed', 'Attended', 'No-show']:
+        if not new_status or new_status not in ['Pending', 'Confirmed', 'Attended', 'No-show', 'Cancelled']:
             print(f"DEBUG: Invalid status: {new_status}")
             return jsonify({'success': False, 'message': 'Invalid status'}), 400
         
-        # Get the registration to find event_id and donor_id
-        print(f"DEBUG: Looking for registration with ID: {registration_id}")
-        registration_response = supabase.table('registrations')\
-            .select('*')\
-            .eq('id', registration_id)\
-            .execute()
-        
-        print(f"DEBUG: Registration response: {registration_response}")
+        # Registration status and attendance row in one call; cancelling promotes the waitlist
+        try:
+            change = set_registration_status(registration_id, new_status)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 409
         
-        if not registration_response.data:
+        if not change:
             print(f"DEBUG: Registration not found for ID: {registration_id}")
             return jsonify({'success': False, 'message': 'Registration not found'}), 404
         
-        registration = registration_response.data[0]
-        event_id = registration['event_id']
-        donor_id = registration['donor_id']
-        
-        print(f"DEBUG: Found registration - event_id={event_id}, donor_id={donor_id}, current_status={registration.get('status')}")
-        
-        # Update the registration status
-        result = supabase.table('registrations')\
-            .update({'status': new_status})\
-            .eq('id', registration_id)\
-            .execute()
-        
-        print(f"DEBUG: Update result: {result}")
-        
-        # Handle attendance records
-        if new_status == 'Attended':
-            print(f"DEBUG: Creating attendance record for event={event_id}, donor={donor_id}")
-            # Check if attendance already exists
-            attendance_response = supabase.table('attendance').select('*')\
-                .eq('event_id', event_id)\
-                .eq('donor_id', donor_id)\
-                .execute()
-            
-            if not attendance_response.data:
-                # Create attendance record
-                attendance_result = supabase.table('attendance').insert({
-                    'event_id': event_id,
-                    'donor_id': donor_id,
-                    'check_in_time': datetime.now().isoformat()
-                }).execute()
-                print(f"DEBUG: Attendance created: {attendance_result}")
-        
-        elif new_status == 'No-show':
-            print(f"DEBUG: Removing attendance record for event={event_id}, donor={donor_id}")
-            # Delete attendance record if exists
-            delete_result = supabase.table('attendance').delete()\
-                .eq('event_id', event_id)\
-                .eq('donor_id', donor_id)\
-                .execute()
-            print(f"DEBUG: Attendance delete result: {delete_result}")
-        
+        print(f"DEBUG: Registration {registration_id} (event={change['event_id']}) was {change['old_status']}")
         print(f"DEBUG: Successfully updated registration {registration_id} to {new_status}")
         return jsonify({'success': True, 'message': 'Registration status updated successfully'})
     
@@ -2203,30 +5813,77 @@ def update_registration_status(registration_id):
 @role_required('organizer')
 def mark_attendance(registration_id):
     try:
-        registration_response = supabase.table('registrations').select('*').eq('id', registration_id).execute()
-        
-        if not registration_response.data:
+        if not set_registration_status(registration_id, 'Attended'):
             return jsonify({'success': False, 'message': 'Registration not found'})
         
-        registration = registration_response.data[0]
-        
-        attendance_response = supabase.table('attendance').select('*').eq('event_id', registration['event_id']).eq('donor_id', registration['donor_id']).execute()
-        
-        if not attendance_response.data:
-            supabase.table('attendance').insert({
-                'event_id': registration['event_id'],
-                'donor_id': registration['donor_id'],
-                'check_in_time': datetime.now().isoformat()
-            }).execute()
-            
-            supabase.table('registrations').update({'status': 'Attended'}).eq('id', registration_id).execute()
-        
         return jsonify({'success': True, 'message': 'Attendance marked successfully'})
     
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
     except Exception as e:
         print(f"Mark attendance error: {e}")
         return jsonify({'success': False, 'message': 'Error marking attendance'})
 
+@app.route('/organizer/check-in/batch', methods=['POST'])
+@role_required('organizer')
+def batch_check_in():
+    """Body: {"items": [{"registration_id": 12, "status": "Attended"}, ...]}"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'message': 'items must be a non-empty list'}), 400
+    if len(items) > CHECKIN_BATCH_MAX:
+        return jsonify({'success': False, 'message': f'At most {CHECKIN_BATCH_MAX} check-ins per batch'}), 400
+    try:
+        organizer_id = session.get('organizer_id') or session.get('user_id')
+        results = apply_checkins(items, organizer_id=organizer_id)
+        applied = sum(1 for r in results if r['success'])
+        return jsonify({'success': True, 'applied': applied, 'failed': len(results) - applied, 'results': results})
+    except Exception as e:
+        print(f"ERROR in batch_check_in: {e}")
+        return jsonify({'success': False, 'message': f'Error applying check-ins: {str(e)}'}), 500
+
+@app.route('/organizer/event/<int:event_id>/kiosk')
+@role_required('organizer')
+def event_kiosk(event_id):
+    organizer_id = session.get('organizer_id') or session.get('user_id')
+    event = event_cache.get(event_id)
+    if not event or str(event.get('organizer_id')) != str(organizer_id):
+        flash('Event not found', 'error')
+        return redirect(url_for('manage_events'))
+    return render_template('kiosk.html', event=event)
+
+@app.route('/organizer/event/<int:event_id>/roster')
+@role_required('organizer')
+def get_event_roster(event_id):
+    organizer_id = session.get('organizer_id') or session.get('user_id')
+    try:
+        event = event_cache.get(event_id)
+        if not event or str(event.get('organizer_id')) != str(organizer_id):
+            return jsonify({'success': False, 'message': 'Event not found'}), 404
+        return jsonify({'success': True, 'event_id': event_id, 'server_time': now_iso(), 'roster': kiosk_roster(event_id)})
+    except Exception as e:
+        print(f"ERROR loading kiosk roster: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/organizer/kiosk/sync', methods=['POST'])
+@role_required('organizer')
+def sync_kiosk():
+    """Body: {"device_id": "...", "entries": [{"entry_id", "registration_id", "status", "recorded_at"}]}"""
+    data = request.get_json(silent=True) or {}
+    entries = data.get('entries')
+    if not isinstance(entries, list) or not data.get('device_id'):
+        return jsonify({'success': False, 'message': 'device_id and entries are required'}), 400
+    if len(entries) > KIOSK_SYNC_BATCH_MAX:
+        return jsonify({'success': False, 'message': f'At most {KIOSK_SYNC_BATCH_MAX} entries per sync'}), 400
+    try:
+        organizer_id = session.get('organizer_id') or session.get('user_id')
+        results = sync_kiosk_journal(entries, str(data['device_id']), organizer_id=organizer_id)
+        return jsonify({'success': True, 'results': results})
+    except Exception as e:
+        print(f"ERROR in sync_kiosk: {e}")
+        return jsonify({'success': False, 'message': f'Error syncing check-ins: {str(e)}'}), 500
+
 @app.route('/organizer/track-attendance')
 @role_required('organizer')
 def track_attendance():
@@ -2238,12 +5895,9 @@ def track_attendance():
         attendance_data = []
         
         if events_response.data:
-            for event in events_response.data:
-                registrations_response = supabase.table('registrations').select('*', count='exact').eq('event_id', event['id']).execute()
-                attendance_response = supabase.table('attendance').select('*', count='exact').eq('event_id', event['id']).execute()
-                
-                total_reg = len(registrations_response.data) if registrations_response.data else 0
-                attended = len(attendance_response.data) if attendance_response.data else 0
+            for event in with_event_counts(events_response.data):
+                total_reg = event['registration_count']
+                attended = event['attended_count']
                 
                 event_data = {
                     'event_name': event['event_name'],
@@ -2277,10 +5931,11 @@ def generate_report():
         reports_response = supabase.table('event_reports').select('*').execute()
         previous_reports = reports_response.data if reports_response.data else []
         
+        report_events = event_cache.get_many(report['event_id'] for report in previous_reports)
         for report in previous_reports:
-            event_response = supabase.table('events').select('event_name').eq('id', report['event_id']).execute()
-            if event_response.data:
-                report['event_name'] = event_response.data[0]['event_name']
+            event = report_events.get(_event_key(report['event_id']))
+            if event:
+                report['event_name'] = event['event_name']
         
         preview_data = None
         selected_event_id = None
@@ -2292,11 +5947,9 @@ def generate_report():
                 selected_event_id = event_id
                 
                 # Get event details
-                event_response = supabase.table('events').select('*').eq('id', event_id).execute()
+                event = event_cache.get(event_id)
                 
-                if event_response.data:
-                    event = event_response.data[0]
-                    
+                if event:
                     # Get registrations for this event
                     registrations_response = supabase.table('registrations').select('*').eq('event_id', event_id).execute()
                     registrations = registrations_response.data if registrations_response.data else []
@@ -2367,14 +6020,12 @@ def download_report(report_id):
         
         report = report_response.data[0]
         
-        event_response = supabase.table('events').select('*').eq('id', report['event_id']).execute()
+        event = event_cache.get(report['event_id'])
         
-        if not event_response.data:
+        if not event:
             flash('Event not found', 'error')
             return redirect(url_for('generate_report'))
         
-        event = event_response.data[0]
-        
         output = StringIO()
         writer = csv.writer(output)
         
@@ -2411,6 +6062,39 @@ def download_report(report_id):
         flash('Error downloading report', 'error')
         return redirect(url_for('generate_report'))
 
+@app.route('/export/<table>')
+def export_table(table):
+    """Stream a whole table: /export/donors?format=csv&blood_type=O-"""
+    if 'user_id' not in session:
+        flash('Please login first', 'error')
+        return redirect(url_for('login'))
+    if table not in EXPORT_TABLES:
+        return jsonify({'success': False, 'error': f'Unknown export table: {table}'}), 404
+
+    roles, filterable = EXPORT_TABLES[table]
+    if session.get('role') not in roles:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': f'format must be one of {", ".join(EXPORT_FORMATS)}'}), 400
+    filters = {k: v for k, v in request.args.items() if k in filterable and v}
+
+    if session.get('role') == 'organizer':
+        # Organizers only see registrations for their own events
+        organizer_id = session.get('organizer_id') or session.get('user_id')
+        event = event_cache.get(filters.get('event_id')) if filters.get('event_id') else None
+        if not event or str(event.get('organizer_id')) != str(organizer_id):
+            return jsonify({'success': False, 'error': 'event_id of one of your events is required'}), 403
+
+    print(f"DEBUG: Exporting {table} as {fmt} with filters {filters}")
+    filename = f"bloodlink_{table}_{date.today().isoformat()}.{fmt}"
+    return Response(
+        stream_with_context(export_rows(table, fmt, filters)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 @app.route('/report/<int:report_id>', methods=['DELETE'])
 @role_required('organizer')
 def delete_report(report_id):
@@ -2423,8 +6107,35 @@ def delete_report(report_id):
         return jsonify({'success': False, 'message': 'Error deleting report'})
 
 if __name__ == '__main__':
+    if '--normalize-blood-types' in sys.argv:
+        # One-time migration: python app.py --normalize-blood-types
+        normalize_existing_blood_types()
+        sys.exit(0)
+    if '--backfill-rollups' in sys.argv:
+        # One-time job: python app.py --backfill-rollups
+        backfill_inventory_rollups()
+        sys.exit(0)
+    
     print("=== BloodLink Portal ===")
     print("Starting server...")
+    # debug=True runs this file twice: a reloader parent that only watches for
+    # changes and the child that serves requests (WERKZEUG_RUN_MAIN=true).
+    # Caches and background jobs belong to the child alone, otherwise the
+    # parent sweeps stock the child never hears about and both write the
+    # same audit spill file.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        audit_log.start()
+        donor_index.start()
+        inventory_totals.start()
+        stock_alerts.rebuild()
+        unit_index.start()
+        try:
+            allocation_engine.rebuild()
+        except Exception as e:
+            # Not fatal: the first request that needs it builds it
+            print(f"ERROR building allocation engine, will retry on first use: {e}")
+        demand_forecaster.start()
+        start_event_counter_reconciler()
     print("Open your browser to: http://localhost:5000")
     print("=" * 40)
     app.run(debug=True, port=5000)
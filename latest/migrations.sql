@@ -0,0 +1,801 @@
+-- BloodLink Portal - Supabase schema updates
+-- Run these in the Supabase SQL editor, in order. Each block is safe to re-run.
+
+-- ========== NOTIFICATIONS: one row per (user_id, related_id, notification_type) ==========
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS send_count integer NOT NULL DEFAULT 1;
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS last_sent_at timestamptz;
+
+-- Fold existing duplicates into the oldest row before adding the unique key
+WITH ranked AS (
+    SELECT id,
+           row_number() OVER (PARTITION BY user_id, related_id, notification_type ORDER BY created_at, id) AS rn,
+           count(*) OVER (PARTITION BY user_id, related_id, notification_type) AS dupes
+    FROM notifications
+    WHERE related_id IS NOT NULL
+)
+UPDATE notifications n
+SET send_count = ranked.dupes
+FROM ranked
+WHERE n.id = ranked.id AND ranked.rn = 1 AND ranked.dupes > 1;
+
+DELETE FROM notifications n
+USING (
+    SELECT id,
+           row_number() OVER (PARTITION BY user_id, related_id, notification_type ORDER BY created_at, id) AS rn
+    FROM notifications
+    WHERE related_id IS NOT NULL
+) ranked
+WHERE n.id = ranked.id AND ranked.rn > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS notifications_user_related_type_key
+    ON notifications (user_id, related_id, notification_type);
+
+-- ========== DONORS: canonical blood types ==========
+-- Existing rows are canonicalised by the app itself: python app.py --normalize-blood-types
+-- Donor matching is then a single equality / IN lookup on this index.
+CREATE INDEX IF NOT EXISTS donors_blood_type_eligible_idx
+    ON donors (blood_type, eligibility_status);
+
+-- ========== DONORS: checksum for the in-process eligible-donor index ==========
+-- Per blood type: number of eligible donors and md5 of their ids (sorted bytewise, comma separated).
+CREATE OR REPLACE FUNCTION eligible_donor_checksums()
+RETURNS TABLE (blood_type text, donor_count bigint, id_hash text)
+LANGUAGE sql STABLE AS $$
+    SELECT d.blood_type::text,
+           count(*),
+           md5(string_agg(d.id::text, ',' ORDER BY d.id::text COLLATE "C"))
+    FROM donors d
+    WHERE d.eligibility_status = true
+    GROUP BY d.blood_type;
+$$;
+
+-- ========== INVENTORY: atomic adjust + audit log ==========
+-- set/add/remove under a row lock, writing the inventory_logs row in the same transaction.
+-- Address the row by p_inventory_id, or by p_blood_type (created if missing).
+CREATE OR REPLACE FUNCTION adjust_inventory(
+    p_inventory_id bigint DEFAULT NULL,
+    p_blood_type text DEFAULT NULL,
+    p_action text DEFAULT 'set',
+    p_quantity integer DEFAULT 0,
+    p_changed_by text DEFAULT 'Admin',
+    p_staff_id bigint DEFAULT NULL
+)
+RETURNS TABLE (inventory_id bigint, blood_type text, old_quantity integer, new_quantity integer)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_id bigint;
+    v_type text;
+    v_old integer;
+    v_new integer;
+    v_qty integer := greatest(0, coalesce(p_quantity, 0));
+    v_log_action text;
+BEGIN
+    IF p_inventory_id IS NOT NULL THEN
+        SELECT i.id, i.blood_type, i.quantity INTO v_id, v_type, v_old
+        FROM inventory i WHERE i.id = p_inventory_id FOR UPDATE;
+    ELSE
+        SELECT i.id, i.blood_type, i.quantity INTO v_id, v_type, v_old
+        FROM inventory i WHERE i.blood_type = p_blood_type FOR UPDATE;
+    END IF;
+
+    IF v_id IS NULL THEN
+        IF p_blood_type IS NULL THEN
+            RAISE EXCEPTION 'Inventory item % not found', p_inventory_id;
+        END IF;
+        INSERT INTO inventory (blood_type, quantity, updated_at)
+        VALUES (p_blood_type, 0, now())
+        RETURNING id, inventory.blood_type INTO v_id, v_type;
+        v_old := 0;
+        v_log_action := 'CREATE';
+    END IF;
+
+    v_old := coalesce(v_old, 0);
+    v_new := CASE p_action
+        WHEN 'set' THEN v_qty
+        WHEN 'add' THEN v_old + v_qty
+        WHEN 'remove' THEN greatest(0, v_old - v_qty)
+    END;
+    IF v_new IS NULL THEN
+        RAISE EXCEPTION 'Unknown inventory action %', p_action;
+    END IF;
+    v_log_action := coalesce(v_log_action, CASE p_action WHEN 'set' THEN 'UPDATE' WHEN 'add' THEN 'ADD' ELSE 'REMOVE' END);
+
+    UPDATE inventory i
+    SET quantity = v_new,
+        updated_at = now(),
+        last_updated_by = coalesce(p_staff_id, i.last_updated_by)
+    WHERE i.id = v_id;
+
+    INSERT INTO inventory_logs (inventory_id, action, old_quantity, new_quantity, changed_by, changed_at)
+    VALUES (v_id, v_log_action, v_old, v_new, p_changed_by, now());
+
+    RETURN QUERY SELECT v_id, v_type, v_old, v_new;
+END;
+$$;
+
+-- ========== INVENTORY: bulk stock count ==========
+-- One row per blood type. Duplicate rows are folded into the oldest one first
+-- (quantities added up, log rows re-pointed), or the unique index cannot be built.
+-- Only runs before the per-hospital block below, which replaces this index.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'inventory' AND column_name = 'hospital_name') THEN
+        UPDATE inventory i
+        SET quantity = d.total, updated_at = now()
+        FROM (SELECT min(id) AS keep_id, sum(coalesce(quantity, 0))::integer AS total
+              FROM inventory GROUP BY blood_type HAVING count(*) > 1) d
+        WHERE i.id = d.keep_id;
+
+        UPDATE inventory_logs l
+        SET inventory_id = d.keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY blood_type) AS keep_id FROM inventory) d
+        WHERE l.inventory_id = d.id AND d.id <> d.keep_id;
+
+        DELETE FROM inventory i
+        USING (SELECT id, min(id) OVER (PARTITION BY blood_type) AS keep_id FROM inventory) d
+        WHERE i.id = d.id AND d.id <> d.keep_id;
+
+        CREATE UNIQUE INDEX IF NOT EXISTS inventory_blood_type_key ON inventory (blood_type);
+    END IF;
+END $$;
+
+-- p_items: [{"blood_type": "A+", "quantity": 12}, ...]. Unchanged types are skipped.
+CREATE OR REPLACE FUNCTION bulk_set_inventory(
+    p_items jsonb,
+    p_changed_by text DEFAULT 'Staff',
+    p_staff_id bigint DEFAULT NULL
+)
+RETURNS TABLE (inventory_id bigint, blood_type text, old_quantity integer, new_quantity integer)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+    WITH items AS (
+        SELECT x.blood_type, greatest(0, x.quantity) AS quantity
+        FROM jsonb_to_recordset(p_items) AS x(blood_type text, quantity integer)
+    ),
+    current AS (
+        SELECT i.id, i.blood_type, i.quantity
+        FROM inventory i JOIN items USING (blood_type)
+        FOR UPDATE OF i
+    ),
+    saved AS (
+        INSERT INTO inventory (blood_type, quantity, updated_at, last_updated_by)
+        SELECT items.blood_type, items.quantity, now(), p_staff_id
+        FROM items LEFT JOIN current USING (blood_type)
+        WHERE current.quantity IS DISTINCT FROM items.quantity
+        ON CONFLICT (blood_type) DO UPDATE
+            SET quantity = excluded.quantity,
+                updated_at = excluded.updated_at,
+                last_updated_by = coalesce(excluded.last_updated_by, inventory.last_updated_by)
+        RETURNING inventory.id, inventory.blood_type, inventory.quantity
+    ),
+    logged AS (
+        INSERT INTO inventory_logs (inventory_id, action, old_quantity, new_quantity, changed_by, changed_at)
+        SELECT saved.id,
+               CASE WHEN current.id IS NULL THEN 'CREATE' ELSE 'UPDATE' END,
+               coalesce(current.quantity, 0), saved.quantity, p_changed_by, now()
+        FROM saved LEFT JOIN current USING (blood_type)
+        RETURNING 1
+    )
+    SELECT saved.id, saved.blood_type::text, coalesce(current.quantity, 0), saved.quantity
+    FROM saved LEFT JOIN current USING (blood_type);
+END;
+$$;
+
+-- ========== BLOOD UNITS: lot tracking ==========
+-- One row per unit. inventory.quantity stays the per-type total and is adjusted
+-- by the app as units are received, allocated or expire.
+CREATE TABLE IF NOT EXISTS blood_units (
+    id bigserial PRIMARY KEY,
+    blood_type text NOT NULL,
+    collected_at date NOT NULL DEFAULT current_date,
+    expires_at date NOT NULL,
+    source_event_id bigint,
+    status text NOT NULL DEFAULT 'available'
+        CHECK (status IN ('available', 'allocated', 'used', 'expired', 'discarded')),
+    request_id bigint,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz
+);
+
+-- FEFO order for the units that can still be handed out
+CREATE INDEX IF NOT EXISTS blood_units_available_expiry_idx
+    ON blood_units (blood_type, expires_at) WHERE status = 'available';
+CREATE INDEX IF NOT EXISTS blood_units_request_idx ON blood_units (request_id) WHERE request_id IS NOT NULL;
+
+-- ========== INVENTORY: per-hospital partitions ==========
+-- Stock is kept per (hospital_name, blood_type). Existing rows go to the default
+-- hospital (DEFAULT_HOSPITAL in the app, 'City General Hospital' unless overridden).
+ALTER TABLE inventory ADD COLUMN IF NOT EXISTS hospital_name text;
+UPDATE inventory SET hospital_name = 'City General Hospital' WHERE hospital_name IS NULL;
+ALTER TABLE inventory ALTER COLUMN hospital_name SET NOT NULL;
+
+-- Same fold as above, per (hospital_name, blood_type)
+UPDATE inventory i
+SET quantity = d.total, updated_at = now()
+FROM (SELECT min(id) AS keep_id, sum(coalesce(quantity, 0))::integer AS total
+      FROM inventory GROUP BY hospital_name, blood_type HAVING count(*) > 1) d
+WHERE i.id = d.keep_id;
+
+UPDATE inventory_logs l
+SET inventory_id = d.keep_id
+FROM (SELECT id, min(id) OVER (PARTITION BY hospital_name, blood_type) AS keep_id FROM inventory) d
+WHERE l.inventory_id = d.id AND d.id <> d.keep_id;
+
+DELETE FROM inventory i
+USING (SELECT id, min(id) OVER (PARTITION BY hospital_name, blood_type) AS keep_id FROM inventory) d
+WHERE i.id = d.id AND d.id <> d.keep_id;
+
+DROP INDEX IF EXISTS inventory_blood_type_key;
+CREATE UNIQUE INDEX IF NOT EXISTS inventory_hospital_blood_type_key
+    ON inventory (hospital_name, blood_type);
+
+ALTER TABLE blood_units ADD COLUMN IF NOT EXISTS hospital_name text;
+UPDATE blood_units SET hospital_name = 'City General Hospital' WHERE hospital_name IS NULL;
+ALTER TABLE blood_units ALTER COLUMN hospital_name SET NOT NULL;
+
+DROP INDEX IF EXISTS blood_units_available_expiry_idx;
+CREATE INDEX IF NOT EXISTS blood_units_available_hospital_expiry_idx
+    ON blood_units (hospital_name, blood_type, expires_at) WHERE status = 'available';
+
+CREATE INDEX IF NOT EXISTS urgent_request_pending_hospital_idx
+    ON urgent_request (hospital_name) WHERE status = 'Pending';
+
+-- The inventory functions now take the hospital; drop the old signatures first
+DROP FUNCTION IF EXISTS adjust_inventory(bigint, text, text, integer, text, bigint);
+DROP FUNCTION IF EXISTS bulk_set_inventory(jsonb, text, bigint);
+
+CREATE OR REPLACE FUNCTION adjust_inventory(
+    p_inventory_id bigint DEFAULT NULL,
+    p_hospital_name text DEFAULT NULL,
+    p_blood_type text DEFAULT NULL,
+    p_action text DEFAULT 'set',
+    p_quantity integer DEFAULT 0,
+    p_changed_by text DEFAULT 'Admin',
+    p_staff_id bigint DEFAULT NULL
+)
+RETURNS TABLE (inventory_id bigint, hospital_name text, blood_type text, old_quantity integer, new_quantity integer)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_id bigint;
+    v_hospital text;
+    v_type text;
+    v_old integer;
+    v_new integer;
+    v_qty integer := greatest(0, coalesce(p_quantity, 0));
+    v_log_action text;
+BEGIN
+    IF p_inventory_id IS NOT NULL THEN
+        SELECT i.id, i.hospital_name, i.blood_type, i.quantity INTO v_id, v_hospital, v_type, v_old
+        FROM inventory i WHERE i.id = p_inventory_id FOR UPDATE;
+    ELSE
+        SELECT i.id, i.hospital_name, i.blood_type, i.quantity INTO v_id, v_hospital, v_type, v_old
+        FROM inventory i
+        WHERE i.hospital_name = p_hospital_name AND i.blood_type = p_blood_type
+        FOR UPDATE;
+    END IF;
+
+    IF v_id IS NULL THEN
+        IF p_blood_type IS NULL OR p_hospital_name IS NULL THEN
+            RAISE EXCEPTION 'Inventory item % not found', p_inventory_id;
+        END IF;
+        INSERT INTO inventory (hospital_name, blood_type, quantity, updated_at)
+        VALUES (p_hospital_name, p_blood_type, 0, now())
+        RETURNING id, inventory.hospital_name, inventory.blood_type INTO v_id, v_hospital, v_type;
+        v_old := 0;
+        v_log_action := 'CREATE';
+    END IF;
+
+    v_old := coalesce(v_old, 0);
+    v_new := CASE p_action
+        WHEN 'set' THEN v_qty
+        WHEN 'add' THEN v_old + v_qty
+        WHEN 'remove' THEN greatest(0, v_old - v_qty)
+    END;
+    IF v_new IS NULL THEN
+        RAISE EXCEPTION 'Unknown inventory action %', p_action;
+    END IF;
+    v_log_action := coalesce(v_log_action, CASE p_action WHEN 'set' THEN 'UPDATE' WHEN 'add' THEN 'ADD' ELSE 'REMOVE' END);
+
+    UPDATE inventory i
+    SET quantity = v_new,
+        updated_at = now(),
+        last_updated_by = coalesce(p_staff_id, i.last_updated_by)
+    WHERE i.id = v_id;
+
+    INSERT INTO inventory_logs (inventory_id, action, old_quantity, new_quantity, changed_by, changed_at)
+    VALUES (v_id, v_log_action, v_old, v_new, p_changed_by, now());
+
+    RETURN QUERY SELECT v_id, v_hospital, v_type, v_old, v_new;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION bulk_set_inventory(
+    p_items jsonb,
+    p_hospital_name text,
+    p_changed_by text DEFAULT 'Staff',
+    p_staff_id bigint DEFAULT NULL
+)
+RETURNS TABLE (inventory_id bigint, hospital_name text, blood_type text, old_quantity integer, new_quantity integer)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+    WITH items AS (
+        SELECT x.blood_type, greatest(0, x.quantity) AS quantity
+        FROM jsonb_to_recordset(p_items) AS x(blood_type text, quantity integer)
+    ),
+    current AS (
+        SELECT i.id, i.blood_type, i.quantity
+        FROM inventory i JOIN items USING (blood_type)
+        WHERE i.hospital_name = p_hospital_name
+        FOR UPDATE OF i
+    ),
+    saved AS (
+        INSERT INTO inventory (hospital_name, blood_type, quantity, updated_at, last_updated_by)
+        SELECT p_hospital_name, items.blood_type, items.quantity, now(), p_staff_id
+        FROM items LEFT JOIN current USING (blood_type)
+        WHERE current.quantity IS DISTINCT FROM items.quantity
+        ON CONFLICT (hospital_name, blood_type) DO UPDATE
+            SET quantity = excluded.quantity,
+                updated_at = excluded.updated_at,
+                last_updated_by = coalesce(excluded.last_updated_by, inventory.last_updated_by)
+        RETURNING inventory.id, inventory.blood_type, inventory.quantity
+    ),
+    logged AS (
+        INSERT INTO inventory_logs (inventory_id, action, old_quantity, new_quantity, changed_by, changed_at)
+        SELECT saved.id,
+               CASE WHEN current.id IS NULL THEN 'CREATE' ELSE 'UPDATE' END,
+               coalesce(current.quantity, 0), saved.quantity, p_changed_by, now()
+        FROM saved LEFT JOIN current USING (blood_type)
+        RETURNING 1
+    )
+    SELECT saved.id, p_hospital_name, saved.blood_type::text, coalesce(current.quantity, 0), saved.quantity
+    FROM saved LEFT JOIN current USING (blood_type);
+END;
+$$;
+
+-- ========== INVENTORY: low-stock threshold rules ==========
+-- '*' matches any hospital / blood type; the most specific rule wins.
+-- Without a matching rule the app uses STOCK_LOW_UNITS / STOCK_CRITICAL_UNITS.
+CREATE TABLE IF NOT EXISTS stock_thresholds (
+    id bigserial PRIMARY KEY,
+    hospital_name text NOT NULL DEFAULT '*',
+    blood_type text NOT NULL DEFAULT '*',
+    low_units integer NOT NULL,
+    critical_units integer NOT NULL,
+    margin_units integer,
+    CHECK (critical_units >= 0 AND low_units >= critical_units)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS stock_thresholds_scope_key
+    ON stock_thresholds (hospital_name, blood_type);
+
+-- ========== INVENTORY: history rollups ==========
+-- Hourly / daily stock level per (hospital, blood type); hospital_name '*' is the
+-- total over all hospitals. Filled live by the app, backfill old logs once with
+--   python app.py --backfill-rollups
+CREATE TABLE IF NOT EXISTS inventory_rollups (
+    granularity text NOT NULL CHECK (granularity IN ('hour', 'day')),
+    hospital_name text NOT NULL,
+    blood_type text NOT NULL,
+    bucket_start timestamptz NOT NULL,
+    open_level integer NOT NULL,
+    close_level integer NOT NULL,
+    min_level integer NOT NULL,
+    max_level integer NOT NULL,
+    changes integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularity, hospital_name, blood_type, bucket_start)
+);
+
+-- ========== EVENTS: kiosk check-in journal ==========
+-- Every check-in synced from an event kiosk, keyed by the id the kiosk gave
+-- it, so re-sent batches are ignored. applied = it was the newest entry for
+-- its registration when synced.
+CREATE TABLE IF NOT EXISTS checkin_journal (
+    entry_id text PRIMARY KEY,
+    registration_id bigint NOT NULL,
+    status text NOT NULL,
+    recorded_at timestamptz NOT NULL,
+    device_id text,
+    applied boolean NOT NULL DEFAULT false,
+    synced_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS checkin_journal_registration_idx
+    ON checkin_journal (registration_id, recorded_at DESC);
+
+-- ========== EVENTS: one attendance row per (event_id, donor_id) ==========
+-- Keep the earliest check-in of any duplicates, then enforce it so check-ins
+-- can upsert instead of select-then-insert.
+DELETE FROM attendance a
+USING (
+    SELECT id,
+           row_number() OVER (PARTITION BY event_id, donor_id ORDER BY check_in_time, id) AS rn
+    FROM attendance
+) ranked
+WHERE a.id = ranked.id AND ranked.rn > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS attendance_event_donor_key
+    ON attendance (event_id, donor_id);
+
+-- Registration status + attendance row in one transaction.
+-- Attended upserts the attendance row (first check_in_time is kept), No-show deletes it.
+CREATE OR REPLACE FUNCTION set_registration_status(
+    p_registration_id bigint,
+    p_status text
+)
+RETURNS TABLE (registration_id bigint, event_id bigint, old_status text, new_status text)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_event_id bigint;
+    v_donor_id registrations.donor_id%TYPE;
+    v_old text;
+BEGIN
+    SELECT r.event_id, r.donor_id, r.status INTO v_event_id, v_donor_id, v_old
+    FROM registrations r WHERE r.id = p_registration_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE registrations SET status = p_status WHERE id = p_registration_id;
+
+    IF p_status = 'Attended' THEN
+        INSERT INTO attendance (event_id, donor_id, check_in_time)
+        VALUES (v_event_id, v_donor_id, now())
+        ON CONFLICT (event_id, donor_id) DO NOTHING;
+    ELSIF p_status = 'No-show' THEN
+        DELETE FROM attendance a WHERE a.event_id = v_event_id AND a.donor_id = v_donor_id;
+    END IF;
+
+    RETURN QUERY SELECT p_registration_id, v_event_id, v_old, p_status;
+END $$;
+
+-- ========== EVENTS: denormalized registration / attendance counters ==========
+ALTER TABLE events ADD COLUMN IF NOT EXISTS registration_count integer NOT NULL DEFAULT 0;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS confirmed_count integer NOT NULL DEFAULT 0;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS attended_count integer NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS registrations_event_idx ON registrations (event_id, status);
+
+CREATE OR REPLACE FUNCTION registrations_count_trigger()
+RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.event_id = NEW.event_id
+       AND OLD.status IS NOT DISTINCT FROM NEW.status THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE events
+        SET registration_count = registration_count - 1,
+            confirmed_count = confirmed_count - (COALESCE(OLD.status, '') = 'Confirmed')::int
+        WHERE id = OLD.event_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE events
+        SET registration_count = registration_count + 1,
+            confirmed_count = confirmed_count + (COALESCE(NEW.status, '') = 'Confirmed')::int
+        WHERE id = NEW.event_id;
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS registrations_count ON registrations;
+CREATE TRIGGER registrations_count
+    AFTER INSERT OR DELETE OR UPDATE OF status, event_id ON registrations
+    FOR EACH ROW EXECUTE FUNCTION registrations_count_trigger();
+
+CREATE OR REPLACE FUNCTION attendance_count_trigger()
+RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE events SET attended_count = attended_count - 1 WHERE id = OLD.event_id;
+    ELSE
+        UPDATE events SET attended_count = attended_count + 1 WHERE id = NEW.event_id;
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS attendance_count ON attendance;
+CREATE TRIGGER attendance_count
+    AFTER INSERT OR DELETE ON attendance
+    FOR EACH ROW EXECUTE FUNCTION attendance_count_trigger();
+
+-- Recount from scratch; the app runs this periodically. Returns how many events were off.
+CREATE OR REPLACE FUNCTION reconcile_event_counters()
+RETURNS integer
+LANGUAGE sql AS $$
+    WITH counts AS (
+        SELECT e.id,
+               (SELECT count(*) FROM registrations r WHERE r.event_id = e.id)::int AS registrations,
+               (SELECT count(*) FROM registrations r WHERE r.event_id = e.id AND r.status = 'Confirmed')::int AS confirmed,
+               (SELECT count(*) FROM attendance a WHERE a.event_id = e.id)::int AS attended
+        FROM events e
+    ), fixed AS (
+        UPDATE events e
+        SET registration_count = c.registrations,
+            confirmed_count = c.confirmed,
+            attended_count = c.attended
+        FROM counts c
+        WHERE e.id = c.id
+          AND (e.registration_count, e.confirmed_count, e.attended_count)
+              IS DISTINCT FROM (c.registrations, c.confirmed, c.attended)
+        RETURNING e.id
+    )
+    SELECT count(*)::int FROM fixed;
+$$;
+
+-- Backfill the counters for existing events
+SELECT reconcile_event_counters();
+
+-- ========== EVENTS: capacity, time slots, atomic reservations and waitlist ==========
+-- capacity: max active registrations (Pending / Confirmed / Attended); NULL or 0
+-- falls back to target_goal, and both unset means unlimited.
+ALTER TABLE events ADD COLUMN IF NOT EXISTS capacity integer;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS waitlist_count integer NOT NULL DEFAULT 0;
+ALTER TABLE registrations ADD COLUMN IF NOT EXISTS slot_start timestamptz;
+ALTER TABLE registrations ADD COLUMN IF NOT EXISTS waitlist_position integer;
+
+CREATE TABLE IF NOT EXISTS event_slots (
+    event_id bigint NOT NULL,
+    slot_start timestamptz NOT NULL,
+    capacity integer NOT NULL CHECK (capacity >= 0),
+    PRIMARY KEY (event_id, slot_start)
+);
+
+-- One registration per donor per event: keep the earliest
+DELETE FROM registrations r
+USING (
+    SELECT id, row_number() OVER (PARTITION BY event_id, donor_id ORDER BY registered_at, id) AS rn
+    FROM registrations
+) ranked
+WHERE r.id = ranked.id AND ranked.rn > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS registrations_event_donor_key
+    ON registrations (event_id, donor_id);
+CREATE INDEX IF NOT EXISTS registrations_event_slot_idx
+    ON registrations (event_id, slot_start) WHERE status IN ('Pending', 'Confirmed', 'Attended');
+
+-- Duplicate check + capacity check + insert under a lock on the event row,
+-- so concurrent sign-ups cannot overbook. Full events put the donor on the waitlist.
+CREATE OR REPLACE FUNCTION reserve_registration(
+    p_event_id bigint,
+    p_donor_id registrations.donor_id%TYPE,
+    p_slot_start timestamptz DEFAULT NULL
+)
+RETURNS TABLE (registration_id bigint, outcome text, status text, slot_start timestamptz, waitlist_position integer)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_event events%ROWTYPE;
+    v_existing registrations%ROWTYPE;
+    v_capacity integer;
+    v_slot_capacity integer;
+    v_needs_slot boolean;
+    v_has_room boolean;
+    v_position integer;
+    v_id bigint;
+BEGIN
+    SELECT * INTO v_event FROM events e WHERE e.id = p_event_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT NULL::bigint, 'not_found'::text, NULL::text, NULL::timestamptz, NULL::integer;
+        RETURN;
+    END IF;
+
+    -- A cancelled sign-up is not a duplicate: the donor signs up again on the same row
+    SELECT * INTO v_existing FROM registrations r WHERE r.event_id = p_event_id AND r.donor_id = p_donor_id;
+    IF FOUND AND v_existing.status IS DISTINCT FROM 'Cancelled' THEN
+        RETURN QUERY SELECT v_existing.id::bigint, 'duplicate'::text, v_existing.status, v_existing.slot_start, v_existing.waitlist_position;
+        RETURN;
+    END IF;
+
+    -- An event with slots always books into one: without a choice, the earliest
+    -- slot with room (none left means the waitlist)
+    v_needs_slot := p_slot_start IS NULL AND EXISTS (SELECT 1 FROM event_slots s WHERE s.event_id = p_event_id);
+    IF v_needs_slot THEN
+        SELECT s.slot_start INTO p_slot_start FROM event_slots s
+        WHERE s.event_id = p_event_id
+          AND (SELECT count(*) FROM registrations r
+               WHERE r.event_id = s.event_id AND r.slot_start = s.slot_start
+                 AND r.status IN ('Pending', 'Confirmed', 'Attended')) < s.capacity
+        ORDER BY s.slot_start
+        LIMIT 1;
+    END IF;
+
+    IF p_slot_start IS NOT NULL THEN
+        SELECT s.capacity INTO v_slot_capacity FROM event_slots s
+        WHERE s.event_id = p_event_id AND s.slot_start = p_slot_start;
+        IF NOT FOUND THEN
+            RETURN QUERY SELECT NULL::bigint, 'no_such_slot'::text, NULL::text, p_slot_start, NULL::integer;
+            RETURN;
+        END IF;
+    END IF;
+
+    v_capacity := COALESCE(NULLIF(v_event.capacity, 0), NULLIF(v_event.target_goal, 0));
+    v_has_room := NOT (v_needs_slot AND p_slot_start IS NULL)
+              AND (v_capacity IS NULL OR
+                   (SELECT count(*) FROM registrations r
+                    WHERE r.event_id = p_event_id AND r.status IN ('Pending', 'Confirmed', 'Attended')) < v_capacity)
+              AND (p_slot_start IS NULL OR
+                   (SELECT count(*) FROM registrations r
+                    WHERE r.event_id = p_event_id AND r.slot_start = p_slot_start
+                      AND r.status IN ('Pending', 'Confirmed', 'Attended')) < v_slot_capacity);
+
+    IF v_has_room THEN
+        INSERT INTO registrations (event_id, donor_id, status, slot_start, waitlist_position, registered_at)
+        VALUES (p_event_id, p_donor_id, 'Pending', p_slot_start, NULL, now())
+        ON CONFLICT (event_id, donor_id) DO UPDATE
+            SET status = excluded.status, slot_start = excluded.slot_start,
+                waitlist_position = excluded.waitlist_position, registered_at = excluded.registered_at
+        RETURNING id INTO v_id;
+        RETURN QUERY SELECT v_id, 'reserved'::text, 'Pending'::text, p_slot_start, NULL::integer;
+    ELSE
+        SELECT COALESCE(max(r.waitlist_position), 0) + 1 INTO v_position
+        FROM registrations r WHERE r.event_id = p_event_id AND r.status = 'Waitlisted';
+        INSERT INTO registrations (event_id, donor_id, status, slot_start, waitlist_position, registered_at)
+        VALUES (p_event_id, p_donor_id, 'Waitlisted', p_slot_start, v_position, now())
+        ON CONFLICT (event_id, donor_id) DO UPDATE
+            SET status = excluded.status, slot_start = excluded.slot_start,
+                waitlist_position = excluded.waitlist_position, registered_at = excluded.registered_at
+        RETURNING id INTO v_id;
+        RETURN QUERY SELECT v_id, 'waitlisted'::text, 'Waitlisted'::text, p_slot_start, v_position;
+    END IF;
+END $$;
+
+-- Fill freed places from the waitlist in order. A waitlisted donor gets the
+-- slot they asked for if it has room, otherwise the earliest slot that does.
+CREATE OR REPLACE FUNCTION promote_waitlist(p_event_id bigint)
+RETURNS TABLE (registration_id bigint, donor_id registrations.donor_id%TYPE, slot_start timestamptz)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_event events%ROWTYPE;
+    v_capacity integer;
+    v_taken integer;
+    v_has_slots boolean;
+    v_slot timestamptz;
+    w record;
+BEGIN
+    SELECT * INTO v_event FROM events e WHERE e.id = p_event_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    v_capacity := COALESCE(NULLIF(v_event.capacity, 0), NULLIF(v_event.target_goal, 0));
+    SELECT count(*) INTO v_taken FROM registrations r
+    WHERE r.event_id = p_event_id AND r.status IN ('Pending', 'Confirmed', 'Attended');
+    v_has_slots := EXISTS (SELECT 1 FROM event_slots s WHERE s.event_id = p_event_id);
+
+    FOR w IN
+        SELECT r.id, r.donor_id, r.slot_start FROM registrations r
+        WHERE r.event_id = p_event_id AND r.status = 'Waitlisted'
+        ORDER BY r.waitlist_position, r.id
+    LOOP
+        EXIT WHEN v_capacity IS NOT NULL AND v_taken >= v_capacity;
+        v_slot := w.slot_start;
+        IF v_has_slots THEN
+            SELECT s.slot_start INTO v_slot FROM event_slots s
+            WHERE s.event_id = p_event_id
+              AND s.capacity > (SELECT count(*) FROM registrations r
+                                WHERE r.event_id = p_event_id AND r.slot_start = s.slot_start
+                                  AND r.status IN ('Pending', 'Confirmed', 'Attended'))
+            ORDER BY (s.slot_start = w.slot_start) DESC NULLS LAST, s.slot_start
+            LIMIT 1;
+            EXIT WHEN NOT FOUND;  -- every slot is full
+        END IF;
+
+        UPDATE registrations r SET status = 'Pending', slot_start = v_slot, waitlist_position = NULL
+        WHERE r.id = w.id;
+        v_taken := v_taken + 1;
+        RETURN QUERY SELECT w.id::bigint, w.donor_id, v_slot;
+    END LOOP;
+END $$;
+
+-- Status changes now refuse waitlisted and cancelled sign-ups, which hold no
+-- place: they can only be cancelled (which also clears the waitlist position).
+-- The new status is reported back unchanged when refused.
+CREATE OR REPLACE FUNCTION set_registration_status(
+    p_registration_id bigint,
+    p_status text
+)
+RETURNS TABLE (registration_id bigint, event_id bigint, old_status text, new_status text)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_event_id bigint;
+    v_donor_id registrations.donor_id%TYPE;
+    v_old text;
+BEGIN
+    SELECT r.event_id, r.donor_id, r.status INTO v_event_id, v_donor_id, v_old
+    FROM registrations r WHERE r.id = p_registration_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    IF v_old IN ('Waitlisted', 'Cancelled') AND p_status <> 'Cancelled' THEN
+        RETURN QUERY SELECT p_registration_id, v_event_id, v_old, v_old;
+        RETURN;
+    END IF;
+
+    UPDATE registrations SET status = p_status, waitlist_position = NULL WHERE id = p_registration_id;
+
+    IF p_status = 'Attended' THEN
+        INSERT INTO attendance (event_id, donor_id, check_in_time)
+        VALUES (v_event_id, v_donor_id, now())
+        ON CONFLICT (event_id, donor_id) DO NOTHING;
+    ELSIF p_status = 'No-show' THEN
+        DELETE FROM attendance a WHERE a.event_id = v_event_id AND a.donor_id = v_donor_id;
+    END IF;
+
+    RETURN QUERY SELECT p_registration_id, v_event_id, v_old, p_status;
+END $$;
+
+-- Counters: registration_count now leaves out waitlisted and cancelled sign-ups;
+-- waitlisted ones get their own count
+CREATE OR REPLACE FUNCTION registrations_count_trigger()
+RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.event_id = NEW.event_id
+       AND OLD.status IS NOT DISTINCT FROM NEW.status THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE events
+        SET registration_count = registration_count - (COALESCE(OLD.status, '') NOT IN ('Waitlisted', 'Cancelled'))::int,
+            confirmed_count = confirmed_count - (COALESCE(OLD.status, '') = 'Confirmed')::int,
+            waitlist_count = waitlist_count - (COALESCE(OLD.status, '') = 'Waitlisted')::int
+        WHERE id = OLD.event_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE events
+        SET registration_count = registration_count + (COALESCE(NEW.status, '') NOT IN ('Waitlisted', 'Cancelled'))::int,
+            confirmed_count = confirmed_count + (COALESCE(NEW.status, '') = 'Confirmed')::int,
+            waitlist_count = waitlist_count + (COALESCE(NEW.status, '') = 'Waitlisted')::int
+        WHERE id = NEW.event_id;
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION reconcile_event_counters()
+RETURNS integer
+LANGUAGE sql AS $$
+    WITH counts AS (
+        SELECT e.id,
+               (SELECT count(*) FROM registrations r
+                WHERE r.event_id = e.id AND COALESCE(r.status, '') NOT IN ('Waitlisted', 'Cancelled'))::int AS registrations,
+               (SELECT count(*) FROM registrations r WHERE r.event_id = e.id AND r.status = 'Confirmed')::int AS confirmed,
+               (SELECT count(*) FROM registrations r WHERE r.event_id = e.id AND r.status = 'Waitlisted')::int AS waitlisted,
+               (SELECT count(*) FROM attendance a WHERE a.event_id = e.id)::int AS attended
+        FROM events e
+    ), fixed AS (
+        UPDATE events e
+        SET registration_count = c.registrations,
+            confirmed_count = c.confirmed,
+            waitlist_count = c.waitlisted,
+            attended_count = c.attended
+        FROM counts c
+        WHERE e.id = c.id
+          AND (e.registration_count, e.confirmed_count, e.waitlist_count, e.attended_count)
+              IS DISTINCT FROM (c.registrations, c.confirmed, c.waitlisted, c.attended)
+        RETURNING e.id
+    )
+    SELECT count(*)::int FROM fixed;
+$$;
+
+SELECT reconcile_event_counters();
+
+-- ========== EVENTS: slot lookups ==========
+-- event_slots (above) is written by the organizer schedule page; the app keeps
+-- an in-memory index over it and only needs the primary key plus this one.
+CREATE INDEX IF NOT EXISTS registrations_slot_status_idx
+    ON registrations (event_id, slot_start, status);
+
+-- ========== EVENTS: upcoming-events lookup for the donor booking page ==========
+CREATE INDEX IF NOT EXISTS events_upcoming_idx
+    ON events (event_date)
+    WHERE organizer_id IS NOT NULL;
@@ -71,26 +71,24 @@ $(document).ready(function() {
     updateDateTime();
     setInterval(updateDateTime, 60000); // Update every minute
     
-    // Inventory low stock warning
+    // Inventory low stock warning - the level comes from the server's threshold rules
     function checkLowStock() {
         $('.inventory-quantity').each(function() {
-            const quantity = parseInt($(this).text());
+            const level = $(this).data('stock-level');
             const row = $(this).closest('tr');
             
-            if (quantity < 5) {
+            row.removeClass('table-danger table-warning pulse');
+            if (level === 'critical') {
                 row.addClass('table-danger pulse');
-            } else if (quantity < 15) {
+            } else if (level === 'low') {
                 row.addClass('table-warning');
-            } else {
-                row.removeClass('table-danger table-warning pulse');
             }
         });
     }
     
-    // Check low stock on inventory pages
+    // Check low stock on inventory pages (levels change on save, which reloads the page)
     if ($('.inventory-quantity').length) {
         checkLowStock();
-        setInterval(checkLowStock, 30000); // Check every 30 seconds
     }
     
     // AJAX error handling
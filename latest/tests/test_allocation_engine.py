@@ -0,0 +1,106 @@
+import importlib
+import os
+import sys
+import types
+import unittest
+
+
+class FakeQuery:
+    """Just enough of the postgrest query builder for the allocation engine"""
+
+    def __init__(self, rows):
+        self._rows = list(rows)
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def eq(self, column, value):
+        self._rows = [r for r in self._rows if r.get(column) == value]
+        return self
+
+    def gt(self, column, value):
+        self._rows = [r for r in self._rows if r.get(column) > value]
+        return self
+
+    def in_(self, column, values):
+        self._rows = [r for r in self._rows if r.get(column) in values]
+        return self
+
+    def order(self, column, desc=False):
+        self._rows.sort(key=lambda r: r.get(column), reverse=desc)
+        return self
+
+    def limit(self, count):
+        self._rows = self._rows[:count]
+        return self
+
+    def execute(self):
+        return types.SimpleNamespace(data=[dict(r) for r in self._rows], count=len(self._rows))
+
+
+class FakeSupabase:
+    def __init__(self, tables=None):
+        self.tables = tables or {}
+
+    def table(self, name):
+        return FakeQuery(self.tables.get(name, []))
+
+
+def load_app():
+    os.environ.setdefault("SUPABASE_URL", "http://localhost")
+    os.environ.setdefault("SUPABASE_KEY", "test")
+    if "supabase" not in sys.modules:
+        try:
+            import supabase  # noqa: F401
+        except ImportError:
+            stub = types.ModuleType("supabase")
+            stub.Client = object
+            stub.create_client = lambda url, key: FakeSupabase()
+            sys.modules["supabase"] = stub
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return importlib.import_module("app")
+
+
+app = load_app()
+
+
+class AllocationEngineTest(unittest.TestCase):
+    def setUp(self):
+        app.supabase = FakeSupabase({
+            'inventory': [
+                {'id': 1, 'hospital_name': app.DEFAULT_HOSPITAL, 'blood_type': 'O-', 'quantity': 3},
+            ],
+            'urgent_request': [
+                {'id': 10, 'blood_type': 'A+', 'units_needed': 2, 'urgency_level': 'High',
+                 'requested_at': '2026-10-01T08:00:00+00:00', 'hospital_name': app.DEFAULT_HOSPITAL,
+                 'status': 'Pending'},
+            ],
+        })
+        app.inventory_totals.rebuild()
+        self.engine = app.AllocationEngine()
+
+    def test_rebuild_with_pending_request(self):
+        self.engine.rebuild()
+        allocation = self.engine.allocation(10)
+        self.assertEqual(allocation['allocations'], {'O-': 2})
+        self.assertEqual(allocation['shortfall'], 0)
+        self.assertEqual(self.engine.pending_count(app.DEFAULT_HOSPITAL), 1)
+
+    def test_upsert_request_replays_the_partition(self):
+        self.engine.rebuild()
+        self.engine.upsert_request({'id': 11, 'blood_type': 'B+', 'units_needed': 4, 'urgency_level': 'High',
+                                    'requested_at': '2026-10-01T07:00:00+00:00',
+                                    'hospital_name': app.DEFAULT_HOSPITAL, 'status': 'Pending'})
+        # Requested earlier, so it is served first and takes all three O- units
+        self.assertEqual(self.engine.allocation(11), {'hospital_name': app.DEFAULT_HOSPITAL,
+                                                      'allocations': {'O-': 3}, 'shortfall': 1})
+        self.assertEqual(self.engine.shortfall(10), 2)
+        self.assertEqual(self.engine.pending_count(), 2)
+
+        self.engine.upsert_request({'id': 11, 'status': 'Fulfilled'})
+        self.assertIsNone(self.engine.allocation(11))
+        self.assertEqual(self.engine.shortfall(10), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()